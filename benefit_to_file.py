@@ -1,23 +1,19 @@
 """
-Convert a JSON MA benefit file into a file containing Python dictionaries.
+Convert a JSON MA benefit file into a binary benefits snapshot (see lambda_package/snapshot.py)
+of the compiled plans (see lambda_package/calc/compiler.py). Invalid plans are reported and fail
+the conversion, unless --skip-invalid leaves them out.
 
 Run like this:
-    python benefit_to_file.py s3://picwell.sandbox.medicare/ma_benefits/cms_2018_pbps_20171005.json lambda_package/benefits_2018.py
+    python benefit_to_file.py s3://picwell.sandbox.medicare/ma_benefits/cms_2018_pbps_20171005.json lambda_package/benefits.snap
 """
 
 import argparse
-import pprint
+import sys
 
 from etltools import s3
 
-
-def benefit_to_string(plans):
-    yield 'MA_PLANS = [\n'
-
-    for plan in plans:
-        yield pprint.pformat(plan) + ',\n'
-
-    yield ']\n'
+from lambda_package.calc.compiler import compile_plans
+from lambda_package.snapshot import write_snapshot
 
 
 if __name__ == '__main__':
@@ -26,14 +22,20 @@ if __name__ == '__main__':
                                      description=__doc__)
 
     parser.add_argument('json_file', type=str, help='JSON MA benefit file')
-    parser.add_argument('py_file', type=str, help='python file')
+    parser.add_argument('snapshot_file', type=str, help='benefits snapshot file')
+    parser.add_argument('--skip-invalid', action='store_true',
+                        help='leave invalid plans out instead of failing')
 
     args = parser.parse_args()
 
-    plans = s3.read_json(args.json_file)
-    lines = benefit_to_string(plans)
+    plans, errors = compile_plans(s3.read_json(args.json_file))
+    for error in errors:
+        print error
+
+    if errors and not args.skip_invalid:
+        sys.exit('{} invalid plans'.format(len(errors)))
 
-    with open(args.py_file, 'w') as fp:
-        fp.writelines(lines)
+    with open(args.snapshot_file, 'wb') as fp:
+        write_snapshot(plans, fp)
 
 
@@ -0,0 +1,87 @@
+"""
+Compile a JSON MA benefit file into per-state shards of compiled plans (see
+lambda_package/calc/compiler.py), in the layout of the benefits that the Lambda function reads
+(BENEFITS_PATH or a [benefits_versions] path in lambda.cfg), with a manifest.
+
+All plans are validated. Invalid plans are reported and fail the compilation, unless
+--skip-invalid leaves them out.
+
+Run like this:
+    python compile_benefits.py s3://picwell.sandbox.medicare/ma_benefits/cms_2018_pbps_20171005.json s3://picwell.sandbox.analytics/junghoon/lambda_calculator_benefits
+"""
+
+import argparse
+import sys
+from datetime import datetime
+
+from etltools import s3
+
+from lambda_package.calc.compiler import (
+    COMPILER_VERSION,
+    compile_plans,
+)
+
+sys.path.append('lambda_client')
+from storage_utils import BenefitsClient, LocalBenefitsClient
+
+
+def _make_manifest(source, plans_by_state, errors):
+    return {
+        'compiler_version': COMPILER_VERSION,
+        'source': source,
+        'compiled_at': datetime.utcnow().isoformat(),
+        'plans': sum(len(plans) for plans in plans_by_state.itervalues()),
+        'equivalence_classes': len(set(plan['equivalence_class']
+                                       for plans in plans_by_state.itervalues()
+                                       for plan in plans)),
+        'skipped': errors,
+        'states': {
+            state: {
+                'plans': len(plans),
+                'equivalence_classes': len(set(plan['equivalence_class'] for plan in plans)),
+            }
+            for state, plans in plans_by_state.iteritems()
+        },
+    }
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
+                                     description=__doc__)
+
+    parser.add_argument('json_file', type=str, help='JSON MA benefit file')
+    parser.add_argument('benefit_dir', type=str, help='directory to write compiled benefits to')
+    parser.add_argument('--skip-invalid', action='store_true',
+                        help='leave invalid plans out instead of failing')
+    parser.add_argument('--profile', default=None, help='AWS profile name')
+
+    args = parser.parse_args()
+
+    plans = s3.read_json(args.json_file)
+    print '{} plans read'.format(len(plans))
+
+    compiled_plans, errors = compile_plans(plans)
+    for error in errors:
+        print error
+
+    if errors and not args.skip_invalid:
+        sys.exit('{} invalid plans'.format(len(errors)))
+
+    # Same split as prepare_benefits.py:
+    plans_by_state = {}
+    for plan in compiled_plans:
+        plans_by_state.setdefault(str(plan['picwell_id'])[-2:], []).append(plan)
+
+    manifest = _make_manifest(args.json_file, plans_by_state, errors)
+    print '{} plans in {} equivalence classes'.format(manifest['plans'],
+                                                      manifest['equivalence_classes'])
+
+    if args.benefit_dir.startswith('s3://'):
+        bucket, path = args.benefit_dir[len('s3://'):].split('/', 1)
+        client = BenefitsClient({'region_name': 'us-east-1', 'profile_name': args.profile},
+                                s3_bucket=bucket, s3_path=path)
+    else:
+        client = LocalBenefitsClient(args.benefit_dir)
+
+    client.put_states(plans_by_state, manifest)
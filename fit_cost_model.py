@@ -0,0 +1,51 @@
+"""
+Fit the engine cost model (lambda_package/engine.py) from the TIMING records logged by the
+calculator, and write the coefficients to lambda_package/cost_model.json, which is packaged with
+the calculator and used in place of the default coefficients.
+
+Each line of the input file should contain one record logged by run_batch() or run_detailed(),
+with or without the 'TIMING ' prefix. For example, to collect records from CloudWatch:
+    aws logs filter-log-events --log-group-name /aws/lambda/ma_calculator \\
+        --filter-pattern TIMING --query 'events[].message' --output text > timings.txt
+
+Run like this:
+    python fit_cost_model.py timings.txt
+or, to only print the coefficients:
+    python fit_cost_model.py timings.txt --dry-run
+"""
+
+import argparse
+import json
+import pprint
+import sys
+
+sys.path.append('lambda_package')
+from engine import CostModel
+
+
+def read_timing_records(file_name):
+    with open(file_name) as fp:
+        for line in fp:
+            _, _, record = line.strip().rpartition('TIMING ')
+            if record:
+                yield json.loads(record)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
+                                     description=__doc__)
+
+    parser.add_argument('timing_file', type=str, help='file with one TIMING record per line')
+    parser.add_argument('--output', type=str, default='lambda_package/cost_model.json',
+                        help='where to write the coefficients')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='print the coefficients without writing them')
+
+    args = parser.parse_args()
+
+    cost_model = CostModel.fit(read_timing_records(args.timing_file))
+    pprint.pprint(cost_model.coefficients)
+
+    if not args.dry_run:
+        cost_model.save(args.output)
@@ -0,0 +1,335 @@
+"""
+Blob stores that the clients read claims and benefits from, and write large results to.
+
+    * S3BlobStore reads and writes S3 objects under a bucket and path;
+    * LocalBlobStore reads and writes files under a directory, e.g. for bulk recomputes on one
+      machine at disk speed, or tests without network;
+    * MemoryBlobStore memory-maps the files under a directory the first time they are read, and
+      serves them from memory from then on. Blobs written to it are only kept in memory.
+
+The store is selected by BLOB_STORE in the [storage] section of lambda.cfg (see
+make_blob_store()). A blob is written through a file object:
+
+    with blob_store.writer(key) as f:
+        f.write(...)
+
+and read whole (read()), as a stream (open()), or by byte range (read_range()). Each blob has an
+ETag that changes when it is rewritten, for conditional reads.
+"""
+import contextlib
+import hashlib
+import io
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+S3 = 's3'
+LOCAL = 'local'
+MEMORY = 'memory'
+
+# Connections of the S3 client shared by the threads of a process; as many as the threads that
+# storage_utils.fetch_all() starts:
+MAX_POOL_CONNECTIONS = 8
+
+# Blobs larger than this are spooled to disk before they are uploaded:
+_SPOOL_BYTES = 16 * 1024 * 1024
+_URL_EXPIRES_SECONDS = 3600
+
+_S3_CLIENTS = {}
+_S3_CLIENTS_LOCK = threading.Lock()
+
+_MEMORY_STORES = {}
+_MEMORY_STORES_LOCK = threading.Lock()
+
+
+class BlobNotFound(Exception):
+    pass
+
+
+class BlobChanged(Exception):
+    """ The ETag of a blob is not the one that a conditional read expected. """
+    pass
+
+
+def _get_s3_client(aws_options):
+    """ An S3 client shared by all threads for the AWS options. Unlike resources, clients are
+    thread-safe.
+    """
+    key = tuple(sorted(aws_options.iteritems()))
+    with _S3_CLIENTS_LOCK:
+        if key not in _S3_CLIENTS:
+            session = boto3.Session(**aws_options)
+            _S3_CLIENTS[key] = session.client(
+                's3', config=Config(max_pool_connections=MAX_POOL_CONNECTIONS))
+
+    return _S3_CLIENTS[key]
+
+
+class S3BlobStore(object):
+    __slots__ = ('_client', '_s3_bucket', '_s3_path')
+
+    def __init__(self, s3_bucket, s3_path, aws_options):
+        self._client = _get_s3_client(aws_options)
+        self._s3_bucket = s3_bucket
+        self._s3_path = s3_path
+
+    def _get_s3_key(self, key):
+        return os.path.join(self._s3_path, key)
+
+    def _get_object(self, key, **kwargs):
+        try:
+            return self._client.get_object(Bucket=self._s3_bucket, Key=self._get_s3_key(key),
+                                           **kwargs)
+
+        except ClientError as e:
+            error_code = e.response['Error']['Code']
+            if error_code in ('404', 'NoSuchKey'):
+                raise BlobNotFound(self.location(key))
+            elif error_code in ('412', 'PreconditionFailed'):
+                raise BlobChanged(self.location(key))
+            raise
+
+    @contextlib.contextmanager
+    def writer(self, key):
+        with tempfile.SpooledTemporaryFile(max_size=_SPOOL_BYTES) as f:
+            yield f
+
+            f.seek(0)
+            self._client.upload_fileobj(f, self._s3_bucket, self._get_s3_key(key))
+
+    def put(self, key, data):
+        """
+        :return: the ETag of the blob written.
+        """
+        response = self._client.put_object(Bucket=self._s3_bucket, Key=self._get_s3_key(key),
+                                           Body=data)
+        return response['ETag']
+
+    def read(self, key):
+        return self._get_object(key)['Body'].read()
+
+    def open(self, key, if_none_match=None):
+        """
+        :return: (file object streaming the blob, ETag, size in bytes), or None if the ETag is
+            if_none_match. Closing the file object early stops the download.
+        """
+        try:
+            response = self._get_object(
+                key, **({'IfNoneMatch': if_none_match} if if_none_match is not None else {}))
+
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('304', 'NotModified'):
+                return None
+            raise
+
+        return response['Body'], response['ETag'], response['ContentLength']
+
+    def read_range(self, key, start, end, if_match=None):
+        """
+        :return: the bytes from start to end (exclusive).
+        :raises BlobChanged: if the ETag is not if_match.
+        """
+        kwargs = {'IfMatch': if_match} if if_match is not None else {}
+        return self._get_object(key, Range='bytes={}-{}'.format(start, end - 1),
+                                **kwargs)['Body'].read()
+
+    def location(self, key):
+        return 's3://{}/{}'.format(self._s3_bucket, self._get_s3_key(key))
+
+    def url(self, key, expires_seconds=_URL_EXPIRES_SECONDS):
+        """ A presigned URL to download the blob without AWS credentials. """
+        return self._client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': self._s3_bucket, 'Key': self._get_s3_key(key)},
+            ExpiresIn=expires_seconds,
+        )
+
+
+def _get_file_etag(path):
+    # The modification time and size stand in for the ETag of S3:
+    try:
+        stat = os.stat(path)
+
+    except OSError:
+        return None
+
+    return '{}-{}'.format(stat.st_mtime, stat.st_size)
+
+
+class LocalBlobStore(object):
+    __slots__ = ('_directory',)
+
+    def __init__(self, directory):
+        self._directory = directory
+
+    def _get_path(self, key):
+        return os.path.join(self._directory, key)
+
+    def _get_etag(self, key):
+        etag = _get_file_etag(self._get_path(key))
+        if etag is None:
+            raise BlobNotFound(self.location(key))
+
+        return etag
+
+    @contextlib.contextmanager
+    def writer(self, key):
+        path = self._get_path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        # Written to a temporary file first, so that readers never see a partial blob:
+        f = tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False)
+        try:
+            with f:
+                yield f
+
+        except Exception:
+            os.remove(f.name)
+            raise
+
+        shutil.move(f.name, path)
+
+    def put(self, key, data):
+        with self.writer(key) as f:
+            f.write(data)
+
+        return self._get_etag(key)
+
+    def read(self, key):
+        self._get_etag(key)
+        with open(self._get_path(key), 'rb') as f:
+            return f.read()
+
+    def open(self, key, if_none_match=None):
+        etag = self._get_etag(key)
+        if etag == if_none_match:
+            return None
+
+        return open(self._get_path(key), 'rb'), etag, os.path.getsize(self._get_path(key))
+
+    def read_range(self, key, start, end, if_match=None):
+        if if_match is not None and self._get_etag(key) != if_match:
+            raise BlobChanged(self.location(key))
+
+        with open(self._get_path(key), 'rb') as f:
+            f.seek(start)
+            return f.read(end - start)
+
+    def location(self, key):
+        return 'file://' + os.path.abspath(self._get_path(key))
+
+    def url(self, key, expires_seconds=_URL_EXPIRES_SECONDS):
+        return self.location(key)
+
+
+class _BufferReader(object):
+    """ A file object reading a memory-mapped file or a string without copying it whole. """
+    __slots__ = ('_buffer', '_position')
+
+    def __init__(self, buffer):
+        self._buffer = buffer
+        self._position = 0
+
+    def read(self, size=-1):
+        end = len(self._buffer) if size < 0 else self._position + size
+        data = self._buffer[self._position:end]
+        self._position += len(data)
+        return data
+
+    def close(self):
+        pass
+
+
+class MemoryBlobStore(object):
+    """ Thread-safe; use make_blob_store() to share one store for each directory. """
+
+    def __init__(self, directory=None):
+        self._directory = directory
+        self._blobs = {}
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        """
+        :return: (memory-mapped file or string, ETag)
+        """
+        with self._lock:
+            if key not in self._blobs:
+                path = os.path.join(self._directory, key) if self._directory else None
+                etag = _get_file_etag(path) if path else None
+                if etag is None:
+                    raise BlobNotFound(self.location(key))
+
+                with open(path, 'rb') as f:
+                    # Empty files cannot be memory-mapped:
+                    data = (mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                            if os.path.getsize(path) else '')
+                self._blobs[key] = (data, etag)
+
+            return self._blobs[key]
+
+    @contextlib.contextmanager
+    def writer(self, key):
+        f = io.BytesIO()
+        yield f
+
+        self.put(key, f.getvalue())
+
+    def put(self, key, data):
+        etag = '"{}"'.format(hashlib.md5(data).hexdigest())
+        with self._lock:
+            self._blobs[key] = (str(data), etag)
+
+        return etag
+
+    def read(self, key):
+        return self._get(key)[0][:]
+
+    def open(self, key, if_none_match=None):
+        data, etag = self._get(key)
+        if etag == if_none_match:
+            return None
+
+        return _BufferReader(data), etag, len(data)
+
+    def read_range(self, key, start, end, if_match=None):
+        data, etag = self._get(key)
+        if if_match is not None and etag != if_match:
+            raise BlobChanged(self.location(key))
+
+        return data[start:end]
+
+    def location(self, key):
+        return 'memory://' + (os.path.abspath(os.path.join(self._directory, key))
+                              if self._directory else key)
+
+    def url(self, key, expires_seconds=_URL_EXPIRES_SECONDS):
+        return self.location(key)
+
+
+def make_blob_store(kind, bucket, path, aws_options, local_root=''):
+    """
+    :param kind: S3, LOCAL (files under {local_root}/{bucket}/{path}), or MEMORY (the same
+        files, memory-mapped).
+    """
+    if kind == S3:
+        return S3BlobStore(bucket, path, aws_options)
+
+    directory = os.path.join(local_root, bucket, path)
+    if kind == LOCAL:
+        return LocalBlobStore(directory)
+
+    elif kind == MEMORY:
+        with _MEMORY_STORES_LOCK:
+            if directory not in _MEMORY_STORES:
+                _MEMORY_STORES[directory] = MemoryBlobStore(directory)
+
+            return _MEMORY_STORES[directory]
+
+    raise ValueError('Unrecognized blob store: {}'.format(kind))
@@ -14,11 +14,23 @@ class ConfigInfo(object):
         'claims_path',
         'benefits_bucket',
         'benefits_path',
+        'surfaces_path',
+        'results_bucket',
+        'results_path',
         'costs_table',
+        'leases_table',
         'use_s3_for_claims',
         'claims_year',
+        'claims_cache_size',
+        'claims_version_attribute',
         'use_s3_for_benefits',
+        'benefits_revalidate_seconds',
+        'compact_benefits',
+        'benefits_versions',
         'log_level',
+        'offload_bytes',
+        'blob_store',
+        'blob_root',
     )
 
     def __init__(self, config_file_name):
@@ -33,13 +45,47 @@ class ConfigInfo(object):
 
         self.benefits_bucket = config_parser.get('aws', 'BENEFITS_BUCKET')
         self.benefits_path = config_parser.get('aws', 'BENEFITS_PATH')
+        self.surfaces_path = config_parser.get('aws', 'SURFACES_PATH')
+
+        # Detailed results too large to return are written here (see detailed_api.py):
+        self.results_bucket = config_parser.get('aws', 'RESULTS_BUCKET')
+        self.results_path = config_parser.get('aws', 'RESULTS_PATH')
 
         self.costs_table = config_parser.get('aws', 'DYNAMODB_COST_TABLE')
 
+        # Leases for deduplicating concurrent batch requests (see single_flight.py); no
+        # deduplication without the table:
+        self.leases_table = (config_parser.get('aws', 'DYNAMODB_LEASE_TABLE')
+                             if config_parser.has_option('aws', 'DYNAMODB_LEASE_TABLE') else None)
+
         self.use_s3_for_claims = config_parser.get('claims', 'USE_S3') == 'TRUE'
         self.claims_year = config_parser.get('claims', 'CLAIMS_YEAR')
 
+        # Claims of people kept in a warm container (see claims_loader.py), and the attribute of
+        # DynamoDB items that changes whenever their claims do:
+        self.claims_cache_size = config_parser.getint('claims', 'CACHE_SIZE')
+        self.claims_version_attribute = config_parser.get('claims', 'VERSION_ATTRIBUTE')
+
         self.use_s3_for_benefits = config_parser.get('benefits', 'USE_S3') == 'TRUE'
 
+        # Seconds before benefits cached in a warm container are checked for updates:
+        self.benefits_revalidate_seconds = config_parser.getint('benefits', 'REVALIDATE_SECONDS')
+
+        # Whether loaded plans share identical strings and subtrees (see plan_store.py):
+        self.compact_benefits = config_parser.get('benefits', 'COMPACT') == 'TRUE'
+
+        # Named benefits versions that a request can price in addition to BENEFITS_PATH. Each
+        # maps to a path in BENEFITS_BUCKET:
+        self.benefits_versions = (dict(config_parser.items('benefits_versions'))
+                                  if config_parser.has_section('benefits_versions') else {})
+
         self.log_level = config_parser.get('general', 'LOG_LEVEL')
 
+        # Size of the JSON response above which detailed results are offloaded:
+        self.offload_bytes = config_parser.getint('general', 'OFFLOAD_BYTES')
+
+        # Where the buckets above are read from and written to: s3, local, or memory (see
+        # blob_store.make_blob_store()); the local directories are under LOCAL_ROOT:
+        self.blob_store = config_parser.get('storage', 'BLOB_STORE')
+        self.blob_root = config_parser.get('storage', 'LOCAL_ROOT')
+
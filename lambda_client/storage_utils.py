@@ -1,74 +1,372 @@
 import boto3
+import codecs
 import json
-import os
 import Queue
+import random
+import socket
 import threading
+import time
 
+from botocore.exceptions import (
+    ClientError,
+    ConnectionError,
+    HTTPClientError,
+    IncompleteReadError,
+)
+from urllib3.exceptions import ProtocolError
+
+from blob_store import (
+    MAX_POOL_CONNECTIONS,
+    BlobChanged,
+    BlobNotFound,
+    LocalBlobStore,
+    S3BlobStore,
+    make_blob_store,
+)
 from config_info import (
     CONFIG_FILE_NAME,
     ConfigInfo,
 )
 
-def _json_from_s3(s3_bucket, s3_path, resource):
-    content_object = resource.Object(s3_bucket, s3_path)
+# Concurrent fetches of blobs, e.g. the benefits of all states on a cold start; each fetch from S3
+# has a connection of the shared client:
+_MAX_FETCH_WORKERS = MAX_POOL_CONNECTIONS
+_MAX_FETCH_RETRIES = 4  # corresponds to a total delay of at most 3 seconds
+_RETRY_BASE_SECONDS = 0.1
+
+# S3 error codes worth retrying, besides server errors:
+_RETRYABLE_ERROR_CODES = ('RequestTimeout', 'SlowDown', 'Throttling', 'ThrottlingException')
+
+# Errors that a retry would get again: missing or changed blobs, and contents that cannot be
+# parsed (json raises ValueError, and records without the expected fields KeyError or TypeError):
+_PERMANENT_ERRORS = (BlobNotFound, BlobChanged, ValueError, KeyError, TypeError)
+
+# Errors worth retrying besides the ClientErrors above: connection errors, timeouts (botocore's
+# ReadTimeoutError is an HTTPClientError), and connections dropped while reading a body. Other
+# errors, e.g. missing credentials, are not retried:
+_TRANSIENT_ERRORS = (ConnectionError, HTTPClientError, IncompleteReadError, ProtocolError,
+                     socket.error)
+
+# Bodies of JSON-lines files are read and decoded in chunks of this size:
+_READ_CHUNK_BYTES = 64 * 1024
+
+# Plans fewer bytes apart than this in a state file are read with one ranged GET:
+_MAX_RANGE_GAP = 64 * 1024
+
+# Written with the state files, to locate each plan by picwell_id (see put_states()):
+_PID_INDEX_FILE_NAME = 'pid_index.json'
+
+# Written with compiled benefits, to describe them (see compile_benefits.py):
+_MANIFEST_FILE_NAME = 'manifest.json'
+
+# The jitter has its own random state, so that retries do not disturb reproducible callers:
+_jitter = random.Random()
+
+
+class ClaimsNotFound(BlobNotFound):
+    """ A person has no claims file, or no claims in it or in the claims table. """
+    pass
+
+
+def _is_retryable(e):
+    if isinstance(e, _PERMANENT_ERRORS):
+        return False
+
+    elif isinstance(e, ClientError):
+        error_code = e.response.get('Error', {}).get('Code')
+        status_code = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        return error_code in _RETRYABLE_ERROR_CODES or status_code >= 500
+
+    return isinstance(e, _TRANSIENT_ERRORS)
+
+
+def fetch_with_retries(fetch, key):
+    """ Calls fetch(key), retrying failed calls that may succeed on a retry with jittered
+    exponential backoff.
+
+    :raises: the error of the last call.
+    """
+    retries = 0
+    while True:
+        try:
+            return fetch(key)
+
+        except Exception as e:
+            retries += 1
+            if retries > _MAX_FETCH_RETRIES or not _is_retryable(e):
+                raise
+
+            # Exponential delay with full jitter, so that workers failing together do not
+            # retry together:
+            time.sleep(_jitter.uniform(0, _RETRY_BASE_SECONDS * 2 ** retries))
+
+
+def fetch_all(fetch, keys, max_workers=_MAX_FETCH_WORKERS):
+    """ Calls fetch(key) for each key on a bounded pool of threads, retrying failed calls with
+    jittered exponential backoff.
+
+    :return: (list of results in the order of keys, dict of seconds taken by key, retries
+        included)
+    :raises: the error of the first key, in the order of keys, whose retries all failed.
+    """
+    keys = list(keys)
+    queue = Queue.Queue()
+    for index, key in enumerate(keys):
+        queue.put((index, key))
+
+    results = [None] * len(keys)
+    errors = [None] * len(keys)
+    latencies = {}
+
+    def work():
+        while True:
+            try:
+                index, key = queue.get_nowait()
+            except Queue.Empty:
+                return
+
+            start = time.time()
+            try:
+                results[index] = fetch_with_retries(fetch, key)
+            except Exception as e:
+                errors[index] = e
+            latencies[key] = time.time() - start
+
+    threads = [threading.Thread(target=work) for _ in xrange(min(max_workers, len(keys)))]
+    for t in threads:
+        t.start()
+
+    # Wait for all threads to finish:
+    for t in threads:
+        t.join()
+
+    for error in errors:
+        if error is not None:
+            raise error
+
+    return results, latencies
+
+
+def _iter_json_lines(body, limit=None):
+    """ Parses the records of a JSON-lines body as it is read, so that neither the body nor its
+    decoded text is ever held whole.
+
+    :param body: file-like object, e.g. the streaming body of an S3 object. It is closed once
+        the records are read, or when the caller stops early.
+    :param limit: number of records after which the rest of the body is not read.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    # Pieces of a line that continues in the next chunk:
+    pieces = []
+    n_records = 0
+
+    try:
+        while True:
+            chunk = body.read(_READ_CHUNK_BYTES)
+            parts = decoder.decode(chunk, final=not chunk).split(u'\n')
+
+            if len(parts) == 1:
+                pieces.append(parts[0])
+                lines = []
+            else:
+                lines = [u''.join(pieces) + parts[0]] + parts[1:-1]
+                pieces = [parts[-1]]
+
+            if not chunk:
+                lines.append(u''.join(pieces))
+
+            for line in lines:
+                if not line.strip():
+                    continue
+
+                yield json.loads(line)
+                n_records += 1
+                if n_records == limit:
+                    return
+
+            if not chunk:
+                return
+
+    finally:
+        body.close()
+
+
+class _CountingReader(object):
+    """ A file object counting the bytes read from another. """
+    __slots__ = ('_body', 'bytes_read')
+
+    def __init__(self, body):
+        self._body = body
+        self.bytes_read = 0
+
+    def read(self, size):
+        data = self._body.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def close(self):
+        self._body.close()
+
+
+# TODO: the following function should be deprecated; the clients read through blob stores:
+def _read_json(s3_bucket, s3_path, resource, limit=None):
+    file_content = resource.Object(s3_bucket, s3_path).get()
+    return list(_iter_json_lines(file_content['Body'], limit))
+
+
+def _encode_plans(plans):
+    """
+    :return: (JSON lines of the plans, dict of the (offset, length) of each line by picwell_id)
+    """
+    lines = []
+    offsets = {}
+    offset = 0
+    for plan in plans:
+        line = json.dumps(plan) + '\n'
+        offsets[str(plan['picwell_id'])] = (offset, len(line))
+        lines.append(line)
+        offset += len(line)
+
+    return ''.join(lines), offsets
+
+
+def _get_plan_ranges(pid_index, pids):
+    """ Byte ranges of the state files to read for the plans of the pids.
+
+    :return: list of (file name, start, end, ((picwell_id, offset, length), ...)); the end is
+        exclusive. Plans in the same file fewer than _MAX_RANGE_GAP bytes apart share a range.
+    """
+    entries_by_file = {}
+    for pid in set(str(pid) for pid in pids):
+        if pid in pid_index['pids']:
+            file_name, offset, length = pid_index['pids'][pid]
+            entries_by_file.setdefault(file_name, []).append((pid, offset, length))
+
+    ranges = []
+    for file_name, entries in sorted(entries_by_file.iteritems()):
+        file_ranges = []
+        for pid, offset, length in sorted(entries, key=lambda entry: entry[1]):
+            if file_ranges and offset - file_ranges[-1][2] <= _MAX_RANGE_GAP:
+                file_ranges[-1][2] = max(file_ranges[-1][2], offset + length)
+                file_ranges[-1][3].append((pid, offset, length))
+            else:
+                file_ranges.append([file_name, offset, offset + length, [(pid, offset, length)]])
+
+        ranges += [(file_name, start, end, tuple(range_entries))
+                   for file_name, start, end, range_entries in file_ranges]
+
+    return ranges
+
+
+def _slice_plans(ranges, bodies, pids):
+    """
+    :param bodies: the bytes read for each of the ranges.
+    :return: list of the plans in the order of pids, leaving out pids not in the ranges.
+    """
+    plans = {}
+    for (_, start, _, entries), body in zip(ranges, bodies):
+        for pid, offset, length in entries:
+            plans[pid] = json.loads(body[offset - start:offset - start + length].decode('utf-8'))
 
-    file_content = content_object.get()
-    decoded_body = file_content['Body'].read().decode('utf-8')
+    return [plans[str(pid)] for pid in pids if str(pid) in plans]
 
-    return decoded_body
 
+def _find_in_states(client, pids):
+    # For benefits written without a pid index, whose state files are read in full:
+    states = sorted(set(str(pid)[-2:] for pid in pids))
+    results, _ = fetch_all(lambda state: client.get_state_if_changed(state)[0], states)
 
-def _read_json(s3_bucket, s3_path, resource):
-    lines_from_s3 = _json_from_s3(s3_bucket, s3_path, resource)
-    return [json.loads(l) for l in lines_from_s3.splitlines()]
+    plans = {str(plan['picwell_id']): plan for state_plans in results for plan in state_plans}
+    return [plans[str(pid)] for pid in pids if str(pid) in plans]
 
 
 class ClaimsClient(object):
-    __slots__ = ('_resource', '_s3_bucket', '_s3_path', '_table_name')
+    """
+    Only the first record of the claims file of a person is parsed, and the rest of the file is not
+    read. The bytes read from claims files by all calls, and the total size of the files, are kept
+    in bytes_read and bytes_stored, to tell how much more than needed is fetched.
+
+    The claims of a person have a version for conditional reads (see get_if_changed()): the ETag
+    of the claims file, or the version attribute of the DynamoDB item, if the client is given its
+    name.
+    """
+    __slots__ = ('_blob_store', '_resource', '_table_name', '_version_attribute', '_lock',
+                 'bytes_read', 'bytes_stored')
 
     def __init__(self, aws_info,
                  s3_bucket=None, s3_path=None,
-                 table_name=None):
-        # 3 options are provided: use config file, S3, or DynamoDB.
-        use_config = (s3_bucket is None and s3_path is None and table_name is None)
+                 table_name=None, blob_store=None,
+                 version_attribute=None):
+        # 4 options are provided: use config file, S3, DynamoDB, or a blob store (see
+        # blob_store.py).
+        use_config = (s3_bucket is None and s3_path is None and table_name is None and
+                      blob_store is None)
         assert (use_config or
                 (s3_bucket is not None and s3_path is not None) or
-                table_name is not None)
+                table_name is not None or
+                blob_store is not None)
 
         if use_config:
             configs = ConfigInfo(CONFIG_FILE_NAME)
 
             if configs.use_s3_for_claims:
-                self._s3_bucket = configs.claims_bucket
-                self._s3_path = configs.claims_path
+                self._blob_store = make_blob_store(configs.blob_store, configs.claims_bucket,
+                                                   configs.claims_path, aws_info,
+                                                   configs.blob_root)
                 self._table_name = None
 
             else:
-                self._s3_bucket = None
-                self._s3_path = None
+                self._blob_store = None
                 self._table_name = configs.claims_table
 
+            version_attribute = configs.claims_version_attribute
+
+        elif blob_store is not None:
+            self._blob_store = blob_store
+            self._table_name = None
+
         else:
-            self._s3_bucket = s3_bucket
-            self._s3_path = s3_path
+            self._blob_store = (S3BlobStore(s3_bucket, s3_path, aws_info)
+                                if s3_bucket is not None else None)
             self._table_name = table_name
 
-        session = boto3.Session(**aws_info)
-        self._resource = session.resource('s3' if self.use_s3 else 'dynamodb')
+        self._resource = (boto3.Session(**aws_info).resource('dynamodb')
+                          if self._table_name is not None else None)
+        self._version_attribute = version_attribute
+
+        # The counts are updated by concurrent reads (see fetch_all()):
+        self._lock = threading.Lock()
+        self.bytes_read = 0
+        self.bytes_stored = 0
 
     @property
     def use_s3(self):
-        return self._s3_bucket is not None
+        # Claims are in a blob store, S3 or not:
+        return self._blob_store is not None
 
     def _get_from_s3(self, uid):
-        file_name = os.path.join(self._s3_path, '{}.json'.format(uid))
-        claims_list = _read_json(self._s3_bucket, file_name, self._resource)
+        return self._get_from_s3_if_changed(uid)[0]
+
+    def _get_from_s3_if_changed(self, uid, etag=None):
+        key = '{}.json'.format(uid)
+        result = self._blob_store.open(key, if_none_match=etag)
+        if result is None:
+            return None
+
+        body, file_etag, size = result
+        reader = _CountingReader(body)
+        # Only the first record is used:
+        claims_list = list(_iter_json_lines(reader, limit=1))
+
+        with self._lock:
+            self.bytes_read += reader.bytes_read
+            self.bytes_stored += size
 
         if not claims_list:
-            message = 'No user data located at s3://{}'.format(file_name)
-            raise Exception(message)
+            message = 'No user data located at {}'.format(self._blob_store.location(key))
+            raise ClaimsNotFound(message)
 
-        return claims_list[0]
+        return claims_list[0], file_etag
 
     def _get_from_dynamodb(self, uid):
         table = self._resource.Table(self._table_name)
@@ -77,16 +375,46 @@ class ClaimsClient(object):
                              ConsistentRead=False)
         if 'Item' not in res or not res['Item']:  # not sure exactly what happens
             message = 'No user data located in {} table'.format(self._table_name)
-            raise Exception(message)
+            raise ClaimsNotFound(message)
 
         return res['Item']
 
+    def _get_from_dynamodb_if_changed(self, uid, version=None):
+        if version is not None and self._version_attribute is not None:
+            # Only the version is read to validate claims read before:
+            table = self._resource.Table(self._table_name)
+            res = table.get_item(Key={'uid': uid},
+                                 ConsistentRead=False,
+                                 ProjectionExpression='#version',
+                                 ExpressionAttributeNames={'#version': self._version_attribute})
+            if res.get('Item', {}).get(self._version_attribute) == version:
+                return None
+
+        item = self._get_from_dynamodb(uid)
+        return item, item.get(self._version_attribute) if self._version_attribute else None
+
     def get(self, uid):
         return self._get_from_s3(uid) if self.use_s3 else self._get_from_dynamodb(uid)
 
+    def get_if_changed(self, uid, version=None):
+        """ Conditional read of the claims of a person.
+
+        :return: (claims, version), or None if the claims are still at the given version. Claims
+            without a version (e.g. in DynamoDB, when the client has no version attribute) are
+            read every time.
+        """
+        return (self._get_from_s3_if_changed(uid, version) if self.use_s3
+                else self._get_from_dynamodb_if_changed(uid, version))
+
 
 class BenefitsClient(object):
-    __slots__ = ('_resource', '_s3_bucket', '_s3_path')
+    """
+    Reads the plans of each state from {state}.json in a blob store: S3, or the one given (see
+    blob_store.py). The plans of the states are fetched concurrently on a bounded pool of threads
+    sharing one S3 client. The seconds taken to fetch each state by the last call are kept in
+    latencies.
+    """
+    __slots__ = ('_blob_store', '_pid_index', 'latencies')
     _ALL_STATES = ('01', '04', '05', '06', '08',
                    '09', '10', '11', '12', '13',
                    '15', '16', '17', '18', '19',
@@ -99,56 +427,140 @@ class BenefitsClient(object):
                    '51', '53', '54', '55', '56',
                    '72')
 
-    def __init__(self, aws_info, s3_bucket=None, s3_path=None):
-        use_config = (s3_bucket is None and s3_path is None)
+    def __init__(self, aws_info, s3_bucket=None, s3_path=None, blob_store=None):
+        use_config = (s3_bucket is None and s3_path is None and blob_store is None)
         assert (use_config or
-                (s3_bucket is not None and s3_path is not None))
+                (s3_bucket is not None and s3_path is not None) or
+                blob_store is not None)
 
         if use_config:
             configs = ConfigInfo(CONFIG_FILE_NAME)
 
-            self._s3_bucket = configs.benefits_bucket
-            self._s3_path = configs.benefits_path
+            self._blob_store = make_blob_store(configs.blob_store, configs.benefits_bucket,
+                                               configs.benefits_path, aws_info,
+                                               configs.blob_root)
+
+        elif blob_store is not None:
+            self._blob_store = blob_store
 
         else:
-            self._s3_bucket = s3_bucket
-            self._s3_path = s3_path
+            self._blob_store = S3BlobStore(s3_bucket, s3_path, aws_info)
 
-        session = boto3.Session(**aws_info)
-        self._resource = session.resource('s3')
+        self._pid_index = None
+        self.latencies = {}
 
     def _get_one_state(self, state):
-        file_name = os.path.join(self._s3_path, '{}.json'.format(state))
-        return _read_json(self._s3_bucket, file_name, self._resource)
+        body, _, _ = self._blob_store.open('{}.json'.format(state))
+        return list(_iter_json_lines(body))
 
     def _get_all_states(self, states):
         assert all(state in BenefitsClient._ALL_STATES for state in states)
 
-        # Issue a thread for each state given:
-        queue = Queue.Queue()
-        threads = []
-        for state in states:
-            t = threading.Thread(target=lambda q, s: q.put(self._get_one_state(s)),
-                                 args=(queue, state))
-            threads.append(t)
-            t.start()
-
-        # Wait for all threads to finish:
-        for t in threads:
-            t.join()
+        # Combined in the order of the states, whichever finishes first:
+        results, self.latencies = fetch_all(self._get_one_state, states)
+        return [plan for plans in results for plan in plans]
 
-        # Combine all the results:
-        plans = []
-        while not queue.empty():
-            plans += queue.get()
-
-        return plans
+    def get_states(self, states):
+        """
+        :return: list of the plans of the states, in the order of the states.
+        """
+        return self._get_all_states([str(state) for state in states])
 
     def get_all(self):
         return self._get_all_states(BenefitsClient._ALL_STATES)
 
+    def get_state_if_changed(self, state, etag=None):
+        """ Conditional GET of the plans of a state.
+
+        :return: (plans, ETag), or None if the ETag of the state file is still the given one. A
+            state without a file has no plans (and no ETag).
+        """
+        try:
+            result = self._blob_store.open('{}.json'.format(state), if_none_match=etag)
+
+        except BlobNotFound:
+            return [], None
+
+        if result is None:
+            return None
+
+        body, file_etag, _ = result
+        return list(_iter_json_lines(body)), file_etag
+
+    def _get_pid_index(self, reload=False):
+        if self._pid_index is None or reload:
+            self._pid_index = json.loads(self._blob_store.read(_PID_INDEX_FILE_NAME))
+
+        return self._pid_index
+
+    def _get_range(self, plan_range, etag):
+        file_name, start, end, _ = plan_range
+        return self._blob_store.read_range(file_name, start, end, if_match=etag)
+
+    def _get_ranges(self, pid_index, pids):
+        ranges = _get_plan_ranges(pid_index, pids)
+        bodies, self.latencies = fetch_all(
+            lambda plan_range: self._get_range(plan_range, pid_index['files'][plan_range[0]]),
+            ranges)
+
+        return _slice_plans(ranges, bodies, pids)
+
     def get(self, pids):
-        pass
+        """ Reads only the plans of the pids, with ranged GETs of the state files where the pid
+        index locates them. The index is kept by the client, and reloaded when a pid is not in it
+        or a state file was rewritten since (the ranged GETs are conditional on the ETags in the
+        index).
+
+        :return: list of the plans in the order of pids; unknown pids are left out.
+        """
+        try:
+            cached = self._pid_index is not None
+            pid_index = self._get_pid_index()
+
+            # An index read earlier may predate plans added since:
+            if cached and any(str(pid) not in pid_index['pids'] for pid in pids):
+                pid_index = self._get_pid_index(reload=True)
+
+        except BlobNotFound:
+            return _find_in_states(self, pids)
+
+        try:
+            return self._get_ranges(pid_index, pids)
+
+        except BlobChanged:
+            return self._get_ranges(self._get_pid_index(reload=True), pids)
+
+    def put_states(self, plans_by_state, manifest=None):
+        """ Writes the plans of each state to {state}.json, one plan per line, and the pid index
+        that get() reads: {'files': {<file name>: <ETag>},
+                           'pids': {<picwell_id>: [<file name>, <offset>, <length>]}}.
+        The manifest, if given, is written to manifest.json after everything else.
+        """
+        pid_index = {'files': {}, 'pids': {}}
+        for state, plans in sorted(plans_by_state.iteritems()):
+            file_name = '{}.json'.format(state)
+            body, offsets = _encode_plans(plans)
+
+            pid_index['files'][file_name] = self._blob_store.put(file_name, body)
+            for pid, (offset, length) in offsets.iteritems():
+                pid_index['pids'][pid] = (file_name, offset, length)
+
+        # Written last, so that the index never points into files that are not written yet:
+        self._blob_store.put(_PID_INDEX_FILE_NAME, json.dumps(pid_index))
+
+        if manifest is not None:
+            self._blob_store.put(_MANIFEST_FILE_NAME,
+                                 json.dumps(manifest, indent=2, sort_keys=True))
+
+
+class LocalBenefitsClient(BenefitsClient):
+    """ Reads the plans of each state from {directory}/{state}.json, in the layout of the S3
+    benefits, e.g. for tests.
+    """
+    __slots__ = ()
+
+    def __init__(self, directory):
+        super(LocalBenefitsClient, self).__init__(None, blob_store=LocalBlobStore(directory))
 
 
 # TODO: the following functions should be deprecated:
@@ -166,3 +578,9 @@ def read_benefits_from_s3(s3_bucket, s3_path, aws_options):
     client = BenefitsClient(aws_options, s3_bucket=s3_bucket, s3_path=s3_path)
     return client.get_all()
 
+
+def read_surfaces_from_s3(s3_bucket, s3_path, aws_options, states=None):
+    # Response surfaces are stored by state in the same layout as the benefits:
+    client = BenefitsClient(aws_options, s3_bucket=s3_bucket, s3_path=s3_path)
+    return client.get_states(states) if states else client.get_all()
+
@@ -1,64 +1,336 @@
+import collections
+import json
+import Queue
+import threading
 from datetime import datetime
 
-from calc.calculator import calculate_oop
+from benefits_loader import (
+    get_unknown,
+    PlanIndex,
+)
 from cost_map import DynamoDBCostMap
+from engine import (
+    select_engine,
+    timing_record,
+)
 from utils import (
+    fail_with_message,
     filter_and_sort_claims,
+    get_flag,
     succeed_with_message,
+    versioned_state,
 )
 
 
-def _calculate_batch(person, plans, claim_year, fips_code, months):
-    # TODO: should we inflate claims?
+def _calculate_batch(person, plan_groups, claim_year, months, engine, trends=None):
+    """
+    :param plan_groups: list of (state key of the cost items, plans for the state).
+    """
+    # Claims are not inflated unless cost trends are requested. The OOPs without a trend are
+    # calculated in the same pass as the trend scenarios:
     claims = person.get('medical_claims', [])
+    scenarios = None if trends is None else [0.0] + list(trends)
+
+    # All states (and benefits versions) are evaluated together so that the claims are prepared
+    # once, and an engine can spread the plans across workers:
+    plans = [plan for _, plans_for_state in plan_groups for plan in plans_for_state]
 
     cost_items = []
     for start_month in (str(month).zfill(2) for month in months):
         claims_to_process = filter_and_sort_claims(claims, claim_year, start_month)
+        all_oops = iter(engine.calculate(claims_to_process, plans, oop_only=True,
+                                         trends=scenarios))
+
+        for state, plans_for_state in plan_groups:
+            oops = {}
+            trend_oops = {}
+            for plan in plans_for_state:
+                pid = str(plan['picwell_id'])
+                if scenarios is None:
+                    oops[pid] = next(all_oops)
+                else:
+                    scenario_oops = next(all_oops)
+                    oops[pid], trend_oops[pid] = scenario_oops[0], scenario_oops[1:]
 
-        oops = {}
-        for plan in plans:
-            costs = calculate_oop(claims_to_process, plan, force_network='in_network',
-                                  truncate_claims_at_year_boundary=False)
-            oops[str(plan['picwell_id'])] = costs['oop']
+            cost_item = {
+                'month': start_month,
+                'uid': person['uid'],
+                'state': state,
+                'oops': oops
+            }
+            if scenarios is not None:
+                cost_item['trends'] = trends
+                cost_item['trend_oops'] = trend_oops
 
-        cost_items.append({
-            'month': start_month,
-            'uid': person['uid'],
-            'state': fips_code,
-            'oops': oops
-        })
+            cost_items.append(cost_item)
 
     return cost_items
 
 
-def run_batch(person, plans, claim_year, run_options, table_name, aws_options, logger, start_time):
-    cost_map = DynamoDBCostMap(table_name=table_name, aws_options=aws_options)
+# Time kept in reserve for writing the cost items and starting the continuation:
+_TIME_MARGIN_MILLIS = 10000
+
+# Options that the continuation token replaces:
+_WORK_OPTIONS = ('uid', 'uids', 'continuation')
+
+
+def _is_running_out(time_left, longest_step):
+    if time_left is None:
+        return False
+
+    return time_left() < _TIME_MARGIN_MILLIS + 1000 * longest_step
+
+
+_PERSIST_MODES = ('sync', 'skip', 'background')
+
+
+class _BackgroundWriter(object):
+    """ Writes cost items on a daemon thread, so that the response does not wait for DynamoDB.
+
+    Lambda freezes the container once the response is returned, so the writes may only finish
+    when the container is invoked again; run_batch() waits for the earlier writes of the same
+    people before it writes theirs again.
+    """
+
+    def __init__(self):
+        self._queue = Queue.Queue()
+        self._thread = None
+        # Number of queued writes by (table name, uid):
+        self._pending = collections.Counter()
+        self._condition = threading.Condition()
+
+    def submit(self, cost_items, table_name, aws_options, logger):
+        keys = set((table_name, cost_item['uid']) for cost_item in cost_items)
+
+        with self._condition:
+            self._pending.update(keys)
+
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._write_items)
+                self._thread.daemon = True
+                self._thread.start()
+
+        self._queue.put((cost_items, table_name, aws_options, logger, keys))
+
+    def wait(self, table_name, uids):
+        """ Waits for the queued writes of the people to the table. """
+        keys = [(table_name, uid) for uid in uids]
+
+        with self._condition:
+            while any(self._pending[key] for key in keys):
+                self._condition.wait()
+
+    def _write_items(self):
+        while True:
+            cost_items, table_name, aws_options, logger, keys = self._queue.get()
+            try:
+                DynamoDBCostMap(table_name=table_name, aws_options=aws_options).add_items(
+                    cost_items)
+
+            except Exception as e:
+                logger.error('Failed to write {} cost items in the background: {}'.format(
+                    len(cost_items), e))
+
+            finally:
+                with self._condition:
+                    self._pending -= collections.Counter(keys)
+                    self._condition.notify_all()
+
+
+_BACKGROUND_WRITER = _BackgroundWriter()
+
+
+def _persist(cost_items, persist, table_name, aws_options, logger):
+    if persist == 'sync':
+        DynamoDBCostMap(table_name=table_name, aws_options=aws_options).add_items(cost_items)
+
+    elif persist == 'background':
+        _BACKGROUND_WRITER.submit(cost_items, table_name, aws_options, logger)
+
+
+def _continue_batch(continuation, run_options, invoker, logger, cost_items=None,
+                    failed_work=None):
+    """ Returns the run options for the remaining work, starting another invocation with them
+    unless run_options['on_timeout'] is 'return'. Inline results return the cost items that are
+    complete, and do not start another invocation by default.
+    """
+    continuation_options = {key: value for key, value in run_options.iteritems()
+                            if key not in _WORK_OPTIONS}
+    continuation_options['service'] = 'batch'
+    continuation_options['continuation'] = continuation
+
+    on_timeout = run_options.get('on_timeout', 'return' if cost_items is not None else 'invoke')
+
+    invoked = False
+    if invoker is not None and on_timeout == 'invoke':
+        try:
+            invoked = invoker.invoke_async(continuation_options)
+
+        except Exception as e:
+            # The caller can still resubmit the continuation:
+            logger.error('Failed to continue the batch calculation: {}'.format(e))
+
+    logger.info('Running out of time; {} uids remain.'.format(len(continuation)))
+
+    result = {
+        'status': 'partial',
+        'continuation': continuation_options,
+        'invoked': invoked,
+    }
+    if cost_items is not None:
+        result['cost_items'] = cost_items
+    if failed_work:
+        result['failed'] = failed_work
+
+    return succeed_with_message(json.dumps(result))
+
+
+def run_batch(persons, plan_indexes, claim_year, run_options, table_name, aws_options,
+              logger, start_time, time_left=None, invoker=None, failed=None):
+    """
+    :param persons: list of people whose claims are evaluated against the same plans. The cost
+        items of everyone are written together, in shared DynamoDB batches.
+    :param plan_indexes: dict of PlanIndex by benefits version (None for the default benefits).
+        The cost items of a benefits version other than the default are stored under
+        version-qualified state keys.
+    :param time_left: function that returns the remaining time of the invocation in
+        milliseconds (context.get_remaining_time_in_millis() of Lambda), or None.
+    :param invoker: LambdaInvoker used to continue the remaining work in another invocation.
+    :param failed: dict of error messages by uid, for the people whose claims could not be
+        fetched. Their uids are returned in the 'failed_uids' of a successful result, so that
+        callers can tell who was calculated (see worker.py).
+
+    When the invocation is running out of time, the completed cost items are written and the
+    remaining work is described by run_options['continuation'], a list of [uid, months] to
+    calculate. The response message is then a JSON object with the run options for the
+    remaining work, which are also used to invoke the function again (see _continue_batch()).
+
+    The work of the people whose claims could not be fetched is logged as a list of
+    [uid, months, error message], and returned as 'failed' in the response message, so that
+    it can be resubmitted.
+
+    Otherwise the response message is a JSON object:
+        {
+            'status': 'complete',
+            'uids': <number of people>,
+            'elapsed': <seconds>,
+            'failed': [[<uid>, [<month>, ...], <error message>], ...],
+        }
+    where 'failed' is present only if someone could not be calculated. With
+    run_options['inline'], it also has the cost items:
+            'cost_items': [{'month': <str>, 'uid': <str>, 'state': <str>, 'oops': {...}}, ...],
+    run_options['persist'] chooses how the cost items are written to the cost table: 'sync'
+    (the default) before responding, 'background' on a thread that the response does not wait
+    for, or 'skip' not at all. Only inline results can skip writing.
+    """
+    try:
+        inline = get_flag(run_options, 'inline')
+
+    except ValueError as e:
+        return fail_with_message(e.message)
+
+    persist = run_options.get('persist', 'sync')
+    if persist not in _PERSIST_MODES:
+        return fail_with_message('Unrecognized persist mode: {}'.format(persist))
+    if persist == 'skip' and not inline:
+        return fail_with_message('Cost items can be skipped only with inline results')
 
     # Read states and propration periods to consider. If not given use default values (all
     # states among the plans and all proration periods, respectively).
     months = run_options.get('months', (month + 1 for month in range(12)))
     months = [str(month).zfill(2) for month in months]
 
-    states = set(run_options.get('states',
-                                 (plan['state_fips'] for plan in plans)))
-    states = [str(state) for state in states]
+    if 'states' in run_options:
+        states = sorted(set(str(state) for state in run_options['states']))
+
+        unknown_states = get_unknown(plan_indexes.itervalues(), states, PlanIndex.has_state)
+        if unknown_states:
+            return fail_with_message('No plans for states: {}'.format(', '.join(unknown_states)))
+
+    plan_groups = []
+    for version, plan_index in plan_indexes.iteritems():
+        for state in (states if 'states' in run_options else plan_index.states):
+            plans_for_state = plan_index.in_state(state)
+
+            if plans_for_state:
+                plan_groups.append((versioned_state(state, version), plans_for_state))
+
+    # Earlier background writes for the same people finish first, so that they cannot
+    # overwrite newer items:
+    _BACKGROUND_WRITER.wait(table_name, [person['uid'] for person in persons])
 
     setup_elapsed = (datetime.now() - start_time).total_seconds()
     logger.info('Total setup took {} seconds.'.format(setup_elapsed) +
                 'Start calculation for batch processing:')
 
+    # A continuation gives the remaining months for each person:
+    months_by_uid = dict(run_options.get('continuation', []))
+    work = [(person, [str(month).zfill(2) for month in months_by_uid.get(person['uid'], months)])
+            for person in persons]
+
+    failed_work = [[uid, [str(month).zfill(2) for month in months_by_uid.get(uid, months)], message]
+                   for uid, message in sorted((failed or {}).iteritems())]
+    if failed_work:
+        logger.error('Not calculated for lack of claims: {}'.format(json.dumps(failed_work)))
+
     cost_items = []
-    for state in states:
-        plans_for_state = filter(lambda plan: plan['state_fips'] == state, plans)
+    continuation = []
+    n_steps = 0
+    longest_step = 0.0
+    for person, person_months in work:
+        if continuation:
+            continuation.append([person['uid'], person_months])
+            continue
 
-        if plans_for_state:
-            cost_items += _calculate_batch(person, plans_for_state, claim_year, state, months)
+        # The engine is chosen per person, since the number of claims varies the most:
+        engine, shape = select_engine(person.get('medical_claims', []),
+                                      (plan for _, plans_for_state in plan_groups
+                                       for plan in plans_for_state),
+                                      len(person_months), run_options, logger)
 
-    cost_map.add_items(cost_items)
+        calculation_time = datetime.now()
+        for index, month in enumerate(person_months):
+            # At least one month is calculated in every invocation, so that the work progresses:
+            if n_steps and _is_running_out(time_left, longest_step):
+                continuation.append([person['uid'], person_months[index:]])
+                shape.n_months = index
+                break
+
+            step_time = datetime.now()
+            cost_items += _calculate_batch(person, plan_groups, claim_year, [month], engine,
+                                           run_options.get('trends'))
+            longest_step = max(longest_step, (datetime.now() - step_time).total_seconds())
+            n_steps += 1
+
+        if shape.n_months:
+            logger.info(timing_record(engine, shape,
+                                      (datetime.now() - calculation_time).total_seconds()))
+
+    _persist(cost_items, persist, table_name, aws_options, logger)
 
     end_time = datetime.now()
     elapsed = (end_time - start_time).total_seconds()
     logger.info('Clock stopped at {}. Elapsed: {}'.format(str(end_time), str(elapsed)))
 
-    return succeed_with_message('batch calculation complete: {}'.format(elapsed))
\ No newline at end of file
+    inline_items = cost_items if inline else None
+    if continuation:
+        result = _continue_batch(continuation, run_options, invoker, logger, inline_items,
+                                 failed_work)
+
+    else:
+        message = {
+            'status': 'complete',
+            'uids': len(persons),
+            'elapsed': elapsed,
+        }
+        if inline_items is not None:
+            message['cost_items'] = inline_items
+        if failed_work:
+            message['failed'] = failed_work
+
+        result = succeed_with_message(json.dumps(message))
+
+    if failed:
+        result['failed_uids'] = sorted(failed)
+
+    return result
@@ -0,0 +1,298 @@
+"""
+Loads plan benefits, keeping them in memory across warm invocations of the Lambda function.
+
+Benefits are identified by a version: None for the default benefits (BENEFITS_PATH, or the
+packaged benefits.snap when benefits are not read from S3; see snapshot.py), or a name in the
+[benefits_versions] section of lambda.cfg.
+
+Benefits in S3 are cached by state file. A request loads only the states it needs, and a cached
+state is revalidated with a conditional GET (If-None-Match) once REVALIDATE_SECONDS have passed
+since it was last checked, so that a warm container picks up updated benefits without
+downloading unchanged ones. Benefits in a local directory (an empty BENEFITS_BUCKET) are
+cached the same way. Otherwise the benefits are read from the blob store of BLOB_STORE in the
+[storage] section of lambda.cfg: S3, or local files read at disk speed or from memory (see
+blob_store.py).
+
+A detailed request for a few pids reads only their plans, at the offsets recorded in the pid index
+written with the state files, unless their states are cached already; such plans are cached by
+pid with the same revalidation period, up to _MAX_CACHED_PIDS of the most recently used.
+
+The plans are returned in a PlanIndex (or the BenefitsSnapshot, which has the same interface),
+so that the services look plans up by picwell_id and state without scanning all plans on every
+invocation. Each cached state keeps the index of its plans until it is reloaded, and a request
+for several states looks their plans up in the indexes of the states (see PlanIndex.merge()).
+The response surfaces of the estimate service are cached by state as well.
+
+With COMPACT = TRUE in the [benefits] section of lambda.cfg, the plans are compacted as they are
+loaded, so that identical strings and subtrees are kept once (see plan_store.py).
+"""
+import collections
+import logging
+import os
+import time
+
+from blob_store import make_blob_store
+from plan_store import PlanCompactor
+from snapshot import BenefitsSnapshot
+from storage_utils import (
+    BenefitsClient,
+    LocalBenefitsClient,
+    fetch_all,
+)
+
+logger = logging.getLogger()
+
+_SNAPSHOT_FILE_NAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benefits.snap')
+
+# Key of the packaged snapshot in _PLANS_CACHE:
+_SNAPSHOT_KEY = 'snapshot'
+
+# Shares the subtrees of all the plans loaded, across states and versions (see plan_store.py):
+_COMPACTOR = PlanCompactor()
+
+# Plans read by pid, beyond which the least recently used are evicted:
+_MAX_CACHED_PIDS = 10000
+
+_CLIENTS_CACHE = {}
+_PLANS_CACHE = {}
+_PIDS_CACHE = collections.OrderedDict()
+_STATES_CACHE = {}
+_SURFACES_CACHE = {}
+
+
+class PlanIndex(object):
+    """ The plans of a benefits version, indexed by state, and by picwell_id within each state.
+    """
+    __slots__ = ('_by_state',)
+
+    def __init__(self, plans):
+        plans_by_state = {}
+        for plan in plans:
+            plans_by_state.setdefault(str(plan['state_fips']), []).append(plan)
+
+        # (plans, plans by picwell_id) by state:
+        self._by_state = {state: (state_plans,
+                                  {str(plan['picwell_id']): plan for plan in state_plans})
+                          for state, state_plans in plans_by_state.iteritems()}
+
+    @staticmethod
+    def merge(indexes):
+        """ A PlanIndex of the plans of indexes of different states, sharing their lookups. """
+        index = PlanIndex([])
+        for state_index in indexes:
+            index._by_state.update(state_index._by_state)
+
+        return index
+
+    @property
+    def plans(self):
+        return [plan for state in sorted(self._by_state) for plan in self._by_state[state][0]]
+
+    @property
+    def states(self):
+        return self._by_state.keys()
+
+    def _get(self, pid):
+        for _, plans_by_pid in self._by_state.itervalues():
+            if pid in plans_by_pid:
+                return plans_by_pid[pid]
+
+        return None
+
+    def has_pid(self, pid):
+        return self._get(str(pid)) is not None
+
+    def has_state(self, state):
+        return str(state) in self._by_state
+
+    def find(self, pids):
+        """ Plans with the given picwell_ids, in the same order; unknown picwell_ids are skipped.
+        """
+        plans = (self._get(str(pid)) for pid in pids)
+        return [plan for plan in plans if plan is not None]
+
+    def in_state(self, state):
+        return self._by_state[str(state)][0] if str(state) in self._by_state else []
+
+
+def get_unknown(indexes, keys, is_known):
+    """ Keys (picwell_ids or states) that none of the indexes knows, e.g.
+    get_unknown(indexes, pids, PlanIndex.has_pid).
+    """
+    return [key for key in keys if not any(is_known(index, key) for index in indexes)]
+
+
+def _tag_version(plans, version):
+    # Cached benefit lookups are keyed by picwell_id and benefits_version (see
+    # calc.utils.cache_benefit_fun), so that the versions do not replace each other's:
+    for plan in plans:
+        plan['benefits_version'] = version
+
+    return plans
+
+
+def get_unknown_versions(configs, versions):
+    return [version for version in versions
+            if version is not None and version not in configs.benefits_versions]
+
+
+def get_plan_state(pid):
+    # The benefits are split into state files by the last two digits of the picwell_id (see
+    # prepare_benefits.py):
+    return str(pid)[-2:]
+
+
+class _CachedState(object):
+    __slots__ = ('plans', 'etag', 'checked', 'index')
+
+    def __init__(self, plans, etag, checked, index=None):
+        self.plans = plans
+        self.etag = etag
+        self.checked = checked
+        self.index = index
+
+
+def _compact(configs, plans):
+    return _COMPACTOR.compact(plans) if configs.compact_benefits else 0
+
+
+def _revalidate_state(configs, client, cache_key, version, now):
+    """
+    :return: the number of bytes saved by compacting the plans of the state, if reloaded.
+    """
+    cached_state = _STATES_CACHE.get(cache_key)
+    result = client.get_state_if_changed(cache_key[-1],
+                                         cached_state.etag if cached_state else None)
+
+    if result is None:
+        cached_state.checked = now
+        return 0
+
+    plans, etag = result
+    if version is not None:
+        plans = _tag_version(plans, version)
+
+    bytes_saved = _compact(configs, plans)
+    _STATES_CACHE[cache_key] = _CachedState(plans, etag, now, PlanIndex(plans))
+
+    return bytes_saved
+
+
+def _get_benefits_client(configs, path, aws_options):
+    # Clients are kept, so that a BenefitsClient reuses the pid index it read:
+    client_key = (configs.benefits_bucket, path)
+    if client_key not in _CLIENTS_CACHE:
+        _CLIENTS_CACHE[client_key] = (
+            BenefitsClient(aws_options,
+                           blob_store=make_blob_store(configs.blob_store, configs.benefits_bucket,
+                                                      path, aws_options, configs.blob_root))
+            if configs.benefits_bucket else LocalBenefitsClient(path))
+
+    return _CLIENTS_CACHE[client_key]
+
+
+def _is_due(cache, cache_key, revalidate_seconds, now):
+    return cache_key not in cache or now - cache[cache_key].checked >= revalidate_seconds
+
+
+def _load_pids(configs, aws_options, path, version, pids, now):
+    cache_keys = [(configs.benefits_bucket, path, version, pid) for pid in pids]
+
+    due_pids = [cache_key[-1] for cache_key in cache_keys
+                if _is_due(_PIDS_CACHE, cache_key, configs.benefits_revalidate_seconds, now)]
+    if due_pids:
+        plans = _get_benefits_client(configs, path, aws_options).get(due_pids)
+        if version is not None:
+            plans = _tag_version(plans, version)
+
+        _compact(configs, plans)
+        plans_by_pid = {str(plan['picwell_id']): plan for plan in plans}
+
+        # Unknown pids are not cached, since any pid can be requested:
+        for pid in due_pids:
+            cache_key = (configs.benefits_bucket, path, version, pid)
+            _PIDS_CACHE.pop(cache_key, None)
+            if pid in plans_by_pid:
+                _PIDS_CACHE[cache_key] = _CachedState([plans_by_pid[pid]], None, now)
+
+    found_plans = []
+    for cache_key in cache_keys:
+        # The most recently used plans are kept:
+        cached_pid = _PIDS_CACHE.pop(cache_key, None)
+        if cached_pid is not None:
+            _PIDS_CACHE[cache_key] = cached_pid
+            found_plans += cached_pid.plans
+
+    while len(_PIDS_CACHE) > _MAX_CACHED_PIDS:
+        _PIDS_CACHE.popitem(last=False)
+
+    return found_plans
+
+
+def load_plans(configs, aws_options, version=None, states=None, pids=None):
+    """
+    :param states: states whose plans are needed; all states if None.
+    :param pids: picwell_ids of the only plans needed, if given. Unless their states are cached
+        already, only these plans are read (see BenefitsClient.get()), and cached on their own.
+
+    :return: PlanIndex of the plans of the benefits version in the states, or of the pids.
+    """
+    if version is None and not configs.use_s3_for_benefits:
+        if _SNAPSHOT_KEY not in _PLANS_CACHE:
+            _PLANS_CACHE[_SNAPSHOT_KEY] = BenefitsSnapshot(
+                _SNAPSHOT_FILE_NAME, _COMPACTOR if configs.compact_benefits else None)
+
+        return _PLANS_CACHE[_SNAPSHOT_KEY]
+
+    path = configs.benefits_path if version is None else configs.benefits_versions[version]
+    now = time.time()
+
+    if pids is not None:
+        pids = sorted(set(str(pid) for pid in pids))
+        states = sorted(set(get_plan_state(pid) for pid in pids))
+        if any(_is_due(_STATES_CACHE, (configs.benefits_bucket, path, version, state),
+                       configs.benefits_revalidate_seconds, now) for state in states):
+            return PlanIndex(_load_pids(configs, aws_options, path, version, pids, now))
+
+    states = sorted(set(str(state) for state in (states or BenefitsClient._ALL_STATES)))
+    cache_keys = [(configs.benefits_bucket, path, version, state) for state in states]
+
+    # Fetch the states that are missing or due for revalidation on a bounded pool of threads:
+    due_keys = [cache_key for cache_key in cache_keys
+                if _is_due(_STATES_CACHE, cache_key, configs.benefits_revalidate_seconds, now)]
+    if due_keys:
+        client = _get_benefits_client(configs, path, aws_options)
+
+        bytes_saved, latencies = fetch_all(
+            lambda cache_key: _revalidate_state(configs, client, cache_key, version, now),
+            due_keys)
+
+        for cache_key in due_keys:
+            logger.debug('Revalidated the benefits of state {} in {:.3f} s.'.format(
+                cache_key[-1], latencies[cache_key]))
+
+        if configs.compact_benefits:
+            logger.info('Compacting the benefits saved {} bytes ({} bytes in total).'.format(
+                sum(bytes_saved), _COMPACTOR.bytes_saved))
+
+    return PlanIndex.merge(_STATES_CACHE[cache_key].index for cache_key in cache_keys)
+
+
+def load_surfaces(configs, aws_options, states=None):
+    """
+    :return: list of the response surfaces of the states (all states if None).
+    """
+    surfaces_by_state = _SURFACES_CACHE.setdefault(
+        (configs.benefits_bucket, configs.surfaces_path), {})
+
+    states = [str(state) for state in (states or BenefitsClient._ALL_STATES)]
+    missing_states = [state for state in states if state not in surfaces_by_state]
+    if missing_states:
+        loaded_surfaces = {state: [] for state in missing_states}
+        client = _get_benefits_client(configs, configs.surfaces_path, aws_options)
+        for surface in client.get_states(missing_states):
+            loaded_surfaces[str(surface['state_fips'])].append(surface)
+
+        surfaces_by_state.update(loaded_surfaces)
+
+    return [surface for state in states for surface in surfaces_by_state[state]]
@@ -18,8 +18,10 @@ from collections import defaultdict
 
 from .calendar import Calendar
 from .cost import (
+    get_copay_value,
     get_moops,
     get_deductibles,
+    get_plan_shape,
     get_shared_oop,
     normalize_prices,
     get_shared_cost_tiers,
@@ -155,39 +157,57 @@ def _claim_eligible_for_coverage(claim, calendar, cost_sharing_intervals):
             cost_sharing_intervals is not None)
 
 
-def _determine_covered_portion(claim, calendar, cost_sharing_intervals):
+def _determine_coverage(claim, calendar, cost_sharing_intervals):
+    """
+    The part of _determine_covered_portion() that does not depend on the claim cost. Day counts
+    are recorded in the calendar, so this must be called once per claim.
+
+    :return: (day_count_start, covered_day_count_end, day_count_end), or None if no part of the
+        claim is covered.
+    """
     claim_eligible_for_coverage = _claim_eligible_for_coverage(claim, calendar,
                                                                cost_sharing_intervals)
-    if claim_eligible_for_coverage:
-        # A claim is at least partially covered:
-        max_day_count = _get_max_day_count(cost_sharing_intervals)
+    if not claim_eligible_for_coverage:
+        return None
 
-        if is_part_a_claim(claim['benefit_category']):
-            (day_count_start, day_count_end) = calendar.get_day_counts(claim)
+    # A claim is at least partially covered:
+    max_day_count = _get_max_day_count(cost_sharing_intervals)
 
-            assert day_count_start <= day_count_end
+    if is_part_a_claim(claim['benefit_category']):
+        (day_count_start, day_count_end) = calendar.get_day_counts(claim)
 
-        else:
-            (day_count_start, day_count_end) = (0, claim['length_of_stay'])
+        assert day_count_start <= day_count_end
 
-        if max_day_count < day_count_start:
-            covered_cost = 0
-            covered_day_count_start, covered_day_count_end = None, None
+    else:
+        (day_count_start, day_count_end) = (0, claim['length_of_stay'])
 
-        elif max_day_count < day_count_end:
-            cost_per_day = float(claim['cost']) / (day_count_end - day_count_start + 1)
-            covered_cost = cost_per_day * (max_day_count - day_count_start + 1)
-            covered_day_count_start, covered_day_count_end = day_count_start, max_day_count
+    if max_day_count < day_count_start:
+        return None
 
-        else:
-            covered_cost = claim['cost']
-            covered_day_count_start, covered_day_count_end = day_count_start, day_count_end
+    elif max_day_count < day_count_end:
+        return day_count_start, max_day_count, day_count_end
 
     else:
-        covered_cost, covered_day_count_start, covered_day_count_end = (
-            0, None, None)
+        return day_count_start, day_count_end, day_count_end
+
+
+def _get_covered_cost(cost, coverage):
+    if coverage is None:
+        return 0, None, None
+
+    day_count_start, covered_day_count_end, day_count_end = coverage
+    if covered_day_count_end < day_count_end:
+        cost_per_day = float(cost) / (day_count_end - day_count_start + 1)
+        covered_cost = cost_per_day * (covered_day_count_end - day_count_start + 1)
+        return covered_cost, day_count_start, covered_day_count_end
+
+    else:
+        return cost, day_count_start, day_count_end
+
 
-    return covered_cost, covered_day_count_start, covered_day_count_end
+def _determine_covered_portion(claim, calendar, cost_sharing_intervals):
+    coverage = _determine_coverage(claim, calendar, cost_sharing_intervals)
+    return _get_covered_cost(claim['cost'], coverage)
 
 
 def _calculate_costs(costs, claim, plan, calendar):
@@ -250,6 +270,118 @@ def _calculate_costs(costs, claim, plan, calendar):
     return claim['cost'], deductible, covered_oop, uncovered_oop
 
 
+# Plan-specialized versions of _calculate_costs(). Each step of the general calculation is
+# chosen once per plan shape (see get_plan_shape()), so plans that do not use deductibles,
+# OOP limits or Part B coinsurance skip those lookups for every claim.
+def _get_amount_left(thresholds, costs, key_name, network_type, benefit_category):
+    comp_amount, net_amount, cat_amount = _get_threshold_amounts_for(
+        thresholds, costs, key_name, network_type, benefit_category)
+
+    return min(max(cat_amount, 0), max(net_amount, 0), max(comp_amount, 0))
+
+
+def _apply_deductible(costs, plan, benefit_category, network_type, covered_cost):
+    deductible_left = _get_amount_left(get_deductibles(plan, benefit_category), costs,
+                                       'deductible_breakdown', network_type, benefit_category)
+
+    return 0.0 if deductible_left == inf else min(covered_cost, deductible_left)
+
+
+def _skip_deductible(costs, plan, benefit_category, network_type, covered_cost):
+    return 0.0
+
+
+def _apply_oop_limits(costs, plan, benefit_category, network_type, deductible, shared_oop):
+    covered_oop_left = _get_amount_left(get_moops(plan, benefit_category), costs,
+                                        'covered_breakdown', network_type, benefit_category)
+    covered_oop = min(covered_oop_left, deductible + shared_oop)
+
+    return covered_oop, min(covered_oop, deductible)
+
+
+def _skip_oop_limits(costs, plan, benefit_category, network_type, deductible, shared_oop):
+    return deductible + shared_oop, deductible
+
+
+def _get_copay_only_shared_oop(shared_cost, intervals, category, day_count_start, day_count_end):
+    if is_part_a_claim(category):
+        return get_shared_oop(shared_cost, intervals, category, day_count_start, day_count_end)
+
+    copay_cost = 0.0
+    if 'copay' in intervals[0]:
+        copay_cost = get_copay_value(intervals[0]['copay'], day_count_end - day_count_start + 1)
+
+    return min(max(0.0, copay_cost), shared_cost)
+
+
+def _make_cost_sharing_function(plan_shape):
+    apply_deductible = (_apply_deductible if plan_shape.has_deductibles
+                        else _skip_deductible)
+    apply_oop_limits = (_apply_oop_limits if plan_shape.has_oop_limits
+                        else _skip_oop_limits)
+    calculate_shared_oop = (_get_copay_only_shared_oop if plan_shape.part_b_copay_only
+                            else get_shared_oop)
+
+    def apply_cost_sharing(costs, claim, plan, cost, cost_sharing_intervals, coverage):
+        benefit_category = claim['benefit_category']
+        network_type = claim['network_type']
+
+        covered_cost, day_count_start, day_count_end = _get_covered_cost(cost, coverage)
+        uncovered_oop = cost - covered_cost
+
+        deductible = apply_deductible(costs, plan, benefit_category, network_type, covered_cost)
+        shared_cost = covered_cost - deductible
+
+        if shared_cost > 0.0:
+            shared_oop = calculate_shared_oop(shared_cost, cost_sharing_intervals,
+                                              benefit_category, day_count_start, day_count_end)
+        else:
+            shared_oop = 0.0
+
+        covered_oop, deductible = apply_oop_limits(costs, plan, benefit_category, network_type,
+                                                   deductible, shared_oop)
+
+        return cost, deductible, covered_oop, uncovered_oop
+
+    return apply_cost_sharing
+
+
+def _make_cost_functions(plan_shape):
+    apply_cost_sharing = _make_cost_sharing_function(plan_shape)
+
+    def calculate_costs(costs, claim, plan, calendar):
+        if _claim_has_negative_cost(claim) or _claim_is_not_categorized(claim):
+            return 0, 0, 0, 0
+
+        cost_sharing_intervals = get_shared_cost_tiers(plan, claim['benefit_category'],
+                                                       claim['network_type'])
+        coverage = _determine_coverage(claim, calendar, cost_sharing_intervals)
+
+        return apply_cost_sharing(costs, claim, plan, claim['cost'], cost_sharing_intervals,
+                                  coverage)
+
+    return calculate_costs, apply_cost_sharing
+
+
+_COST_FUNCTIONS = {}
+
+
+def _get_cost_functions(plan):
+    plan_shape = get_plan_shape(plan)
+    if plan_shape not in _COST_FUNCTIONS:
+        _COST_FUNCTIONS[plan_shape] = _make_cost_functions(plan_shape)
+
+    return _COST_FUNCTIONS[plan_shape]
+
+
+def _get_cost_function(plan):
+    return _get_cost_functions(plan)[0]
+
+
+def _get_cost_sharing_function(plan):
+    return _get_cost_functions(plan)[1]
+
+
 def _get_claim_info(claim, force_network=None):
     cost = float(claim.get('cost', 0.0))
     benefit_category = patch_categories(claim.get('benefit_category', 0))
@@ -334,8 +466,12 @@ def calculate_oop(claims, plan, force_network=None,
     Returns:
          A float value representing the total out-of-pocket cost
     """
+    return calculate_prepared_oop(
+        prepare_claims(claims, force_network, truncate_claims_at_year_boundary), plan)
+
 
-    costs = {
+def _new_costs():
+    return {
         'oop': 0.0,
         'allowed': 0.0,
         # TODO: is it necessary to track composite breakdown?
@@ -365,29 +501,132 @@ def calculate_oop(claims, plan, force_network=None,
         },
     }
 
-    part_a_calendar = Calendar(plan)
 
+def _apply_msa_deposit(costs, plan):
+    # for 2015 some plans include an msa deposit that can offset oop spending
+    msa_deposit = float(plan.get('msa_deposit', 0.0))
+    costs['oop'] = max(0.0, costs['oop'] + costs['uncovered'] - msa_deposit)
+
+
+def prepare_claims(claims, force_network=None, truncate_claims_at_year_boundary=False):
+    """
+    Converts claims into the form used by the calculation. The result does not depend on the
+    plan, so it can be shared by calculate_prepared_oop() calls for many plans.
+
+    See calculate_oop() for the arguments.
+    """
+    prepared_claims = []
     for claim in claims:
         claim = _get_claim_info(claim, force_network)
         if truncate_claims_at_year_boundary:
             adjust_part_a_claim_for_year_overflow(claim)
 
+        prepared_claims.append(claim)
+
+    return prepared_claims
+
+
+def calculate_prepared_oop(prepared_claims, plan):
+    """ calculate_oop() for claims returned by prepare_claims(). """
+    costs = _new_costs()
+
+    part_a_calendar = Calendar(plan)
+    calculate_costs = _get_cost_function(plan)
+
+    for claim in prepared_claims:
         (allowed,
          deductible,
          covered_oop,
-         uncovered_oop) = _calculate_costs(costs, claim, plan, part_a_calendar)
+         uncovered_oop) = calculate_costs(costs, claim, plan, part_a_calendar)
 
         # Update the totals and deductibles paid out:
         _update_cost_totals_and_breakdowns(costs, claim,
                                            allowed, deductible, covered_oop, uncovered_oop)
 
-    # for 2015 some plans include an msa deposit that can offset oop spending
-    msa_deposit = float(plan.get('msa_deposit', 0.0))
-    costs['oop'] = max(0.0, costs['oop'] + costs['uncovered'] - msa_deposit)
+    _apply_msa_deposit(costs, plan)
 
     return costs
 
 
+def _get_trend_multipliers(trend):
+    """
+    :param trend: the cost trend of a scenario; either a rate applied to all claims (0.03 for 3%)
+        or a dict of rates by benefit category, with an optional 'default' rate for the
+        categories not listed.
+    :return: function mapping a (patched) benefit category to the cost multiplier.
+    """
+    if isinstance(trend, dict):
+        default_rate = float(trend.get('default', 0.0))
+        rates = dict((patch_categories(category), float(rate))
+                     for category, rate in trend.iteritems() if category != 'default')
+    else:
+        default_rate = float(trend)
+        rates = {}
+
+    if default_rate <= -1.0 or any(rate <= -1.0 for rate in rates.itervalues()):
+        raise ValueError('Cost trends must be greater than -100%: {}'.format(trend))
+
+    return lambda benefit_category: 1.0 + rates.get(benefit_category, default_rate)
+
+
+def validate_trends(trends):
+    """ Raises ValueError unless trends is a list of valid trends (see _get_trend_multipliers()).
+    """
+    if not isinstance(trends, (list, tuple)):
+        raise ValueError('Cost trends must be given as a list: {}'.format(trends))
+
+    try:
+        for trend in trends:
+            _get_trend_multipliers(trend)
+
+    except (TypeError, AttributeError):
+        raise ValueError('Invalid cost trends: {}'.format(trends))
+
+
+def calculate_prepared_oop_scenarios(prepared_claims, plan, trends):
+    """
+    Calculates the costs for claims returned by prepare_claims() under several cost trend
+    scenarios in one pass. Whether and for which days a claim is covered does not depend on its
+    cost, so the calendar and the cost sharing lookups are shared by all scenarios.
+
+    :param trends: list of cost trends; see _get_trend_multipliers().
+    :return: list of cost bundles (see calculate_oop()), one for each trend.
+    """
+    multipliers = [_get_trend_multipliers(trend) for trend in trends]
+    scenario_costs = [_new_costs() for _ in trends]
+
+    part_a_calendar = Calendar(plan)
+    apply_cost_sharing = _get_cost_sharing_function(plan)
+
+    for claim in prepared_claims:
+        # A positive multiplier keeps negative-cost claims negative:
+        if _claim_has_negative_cost(claim) or _claim_is_not_categorized(claim):
+            for costs in scenario_costs:
+                _update_cost_totals_and_breakdowns(costs, claim, 0, 0, 0, 0)
+            continue
+
+        cost_sharing_intervals = get_shared_cost_tiers(plan, claim['benefit_category'],
+                                                       claim['network_type'])
+        coverage = _determine_coverage(claim, part_a_calendar, cost_sharing_intervals)
+
+        for costs, get_multiplier in zip(scenario_costs, multipliers):
+            cost = claim['cost'] * get_multiplier(claim['benefit_category'])
+
+            (allowed,
+             deductible,
+             covered_oop,
+             uncovered_oop) = apply_cost_sharing(costs, claim, plan, cost,
+                                                 cost_sharing_intervals, coverage)
+
+            _update_cost_totals_and_breakdowns(costs, claim,
+                                               allowed, deductible, covered_oop, uncovered_oop)
+
+    for costs in scenario_costs:
+        _apply_msa_deposit(costs, plan)
+
+    return scenario_costs
+
+
 def calculate_oops_proration(enrolid, canonical_claims, benefits_dict, claim_year,
                              pricing_dict=None, start_months=ALL_MONTHS):
     """
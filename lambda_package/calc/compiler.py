@@ -0,0 +1,167 @@
+"""
+Build-time compilation of plan benefits (see compile_benefits.py).
+
+A compiled plan has the structure of the plans produced by BenefitsParser, so the calculator
+uses it unchanged, but:
+
+    * it is validated once for what the calculator would otherwise find out claim by claim:
+      plan-wide deductibles and OOP limits are by year, the amounts and cost sharing are
+      numbers, and the last day intervals of copays and coinsurance end on the same day;
+    * the amounts, copays, coinsurance, and interval_max values are parsed as floats;
+    * the benefits of the categories that patch_categories() replaces are dropped, since the
+      calculator never looks them up;
+    * it has the 'equivalence_class' of the plans with the same cost sharing, whose costs are
+      calculated once for all of them (see engine.py).
+"""
+from __future__ import absolute_import
+
+import copy
+import hashlib
+import json
+
+from .cost import patch_categories
+from .utils import PART_A_CATEGORIES
+
+# Bumped whenever compiled plans change, and recorded in the manifest of compiled benefits:
+COMPILER_VERSION = 1
+
+# The fields of a plan that the calculator reads. Plans that agree on these have the same costs:
+_COST_FIELDS = ('benefits', 'deductibles', 'oop_limits', 'msa_deposit')
+
+_THRESHOLD_PARAMETERS = ('deductibles', 'oop_limits')
+_NETWORK_TYPES = ('composite', 'in_network', 'out_network')
+_SHARE_TYPES = ('copay', 'coinsurance')
+_SHARE_NUMBERS = ('min', 'max', 'interval_max')
+
+
+def _is_patched(category):
+    return patch_categories(category) != str(category)
+
+
+def _parse_number(value, path):
+    try:
+        return float(value)
+
+    except (TypeError, ValueError):
+        raise ValueError('{} is not a number: {!r}'.format('.'.join(path), value))
+
+
+def _compile_shares(shares, path):
+    for share_type in _SHARE_TYPES:
+        if share_type in shares:
+            for key in _SHARE_NUMBERS:
+                if key in shares[share_type]:
+                    shares[share_type][key] = _parse_number(shares[share_type][key],
+                                                            path + [share_type, key])
+
+
+def _get_interval_max(shares, share_type):
+    if share_type not in shares:
+        return None
+
+    return shares[share_type].get('interval_max', float('infinity'))
+
+
+def _compile_day_intervals(day_intervals, path):
+    for day_interval, shares in day_intervals.iteritems():
+        try:
+            int(day_interval)
+        except ValueError:
+            raise ValueError('{} is not a day interval'.format('.'.join(path + [day_interval])))
+
+        _compile_shares(shares, path + [day_interval])
+
+    if day_intervals:
+        last_shares = day_intervals[max(day_intervals, key=int)]
+        copay_interval_max = _get_interval_max(last_shares, 'copay')
+        coinsurance_interval_max = _get_interval_max(last_shares, 'coinsurance')
+        if (copay_interval_max is not None and coinsurance_interval_max is not None and
+                copay_interval_max != coinsurance_interval_max):
+            raise ValueError('{}: the last day interval ends on different days for copays and '
+                             'coinsurance'.format('.'.join(path)))
+
+
+def _compile_categories(categories):
+    for category in [category for category in categories if _is_patched(category)]:
+        del categories[category]
+
+    for category, category_benefits in categories.iteritems():
+        path = ['benefits', 'categories', str(category)]
+        for parameter in _THRESHOLD_PARAMETERS:
+            if parameter in category_benefits:
+                category_benefits[parameter] = _parse_number(category_benefits[parameter],
+                                                             path + [parameter])
+
+        for network_type in _NETWORK_TYPES:
+            network_benefits = category_benefits.get(network_type)
+            if not network_benefits:
+                continue
+
+            if str(category) in PART_A_CATEGORIES:
+                _compile_day_intervals(network_benefits.get('day_intervals', {}),
+                                       path + [network_type, 'day_intervals'])
+            else:
+                _compile_shares(network_benefits, path + [network_type])
+
+
+def _compile_thresholds(plan):
+    for parameter in _THRESHOLD_PARAMETERS:
+        for network_type in _NETWORK_TYPES:
+            threshold = (plan.get(parameter) or {}).get(network_type)
+            if threshold is None:
+                continue
+
+            path = [parameter, network_type]
+            threshold['categories'] = [category for category in threshold.get('categories', [])
+                                       if not _is_patched(category)]
+            if not threshold['categories']:
+                continue
+
+            if threshold.get('period') != 365:
+                raise ValueError('{} is not by year: period {!r}'.format(
+                    '.'.join(path), threshold.get('period')))
+
+            threshold['amount'] = _parse_number(threshold.get('amount'), path + ['amount'])
+
+
+def get_equivalence_class(plan):
+    cost_fields = {field: plan[field] for field in _COST_FIELDS if field in plan}
+    return hashlib.sha1(json.dumps(cost_fields, sort_keys=True)).hexdigest()[:16]
+
+
+def compile_plan(plan):
+    """
+    :param plan: the benefits dict as produced by BenefitsParser; it is not modified.
+
+    :return: the compiled plan.
+    :raises ValueError: if the plan is not valid.
+    """
+    plan = copy.deepcopy(plan)
+
+    try:
+        _compile_categories(plan.get('benefits', {}).get('categories', {}))
+        _compile_thresholds(plan)
+        if 'msa_deposit' in plan:
+            plan['msa_deposit'] = _parse_number(plan['msa_deposit'], ['msa_deposit'])
+
+    except ValueError as e:
+        raise ValueError('Plan {}: {}'.format(plan.get('picwell_id'), e))
+
+    plan['equivalence_class'] = get_equivalence_class(plan)
+    return plan
+
+
+def compile_plans(plans):
+    """
+    :return: (list of the valid plans compiled, list of the error messages of the others)
+    """
+    compiled_plans = []
+    errors = []
+    for plan in plans:
+        try:
+            compiled_plans.append(compile_plan(plan))
+
+        except ValueError as e:
+            errors.append(str(e))
+
+    return compiled_plans, errors
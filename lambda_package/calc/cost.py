@@ -1,11 +1,18 @@
 from __future__ import absolute_import
 
+from collections import namedtuple
+
 from .utils import (
     cache_benefit_fun,
     chained_get,
     PART_A_CATEGORIES
 )
 
+# The parts of the calculation that a plan actually uses. See get_plan_shape().
+PlanShape = namedtuple('PlanShape', ['has_deductibles', 'has_oop_limits', 'part_b_copay_only'])
+
+_PLAN_NETWORK_TYPES = ('composite', 'in_network', 'out_network')
+
 
 def patch_categories(category):
     """
@@ -219,6 +226,55 @@ def get_shared_cost_tiers(plan, category, network_type):
     return intervals
 
 
+@cache_benefit_fun
+def get_tier_depth(plan):
+    """
+    :param plan: the benefits dict as produced by BenefitsParser
+     :type plan: dict
+
+    :return: int, the largest number of in-network day intervals among the Part A categories.
+        It is 0 if the plan does not cover any Part A category.
+    """
+    depths = [len(get_shared_cost_tiers(plan, category, 'in_network') or [])
+              for category in PART_A_CATEGORIES]
+
+    return max(depths) if depths else 0
+
+
+def _has_plan_parameter(plan, parameter):
+    # Plan-wide thresholds:
+    if any(chained_get(plan, [parameter, network_type], None) is not None
+           for network_type in _PLAN_NETWORK_TYPES):
+        return True
+
+    # Category thresholds:
+    categories = chained_get(plan, ['benefits', 'categories'], {})
+    return any(parameter in category_benefits for category_benefits in categories.itervalues())
+
+
+@cache_benefit_fun
+def get_plan_shape(plan):
+    """
+    :param plan: the benefits dict as produced by BenefitsParser
+     :type plan: dict
+
+    :return: PlanShape
+        has_deductibles: False if the plan has neither plan-wide nor category deductibles.
+        has_oop_limits: False if the plan has neither plan-wide nor category OOP limits.
+        part_b_copay_only: True if no Part B category has coinsurance under any network.
+    """
+    categories = chained_get(plan, ['benefits', 'categories'], {})
+    part_b_copay_only = not any(
+        'coinsurance' in (category_benefits.get(network_type) or {})
+        for category, category_benefits in categories.iteritems()
+        if str(category) not in PART_A_CATEGORIES
+        for network_type in _PLAN_NETWORK_TYPES)
+
+    return PlanShape(has_deductibles=_has_plan_parameter(plan, 'deductibles'),
+                     has_oop_limits=_has_plan_parameter(plan, 'oop_limits'),
+                     part_b_copay_only=part_b_copay_only)
+
+
 def get_sharing_value(sharing_params):
     """
     :param sharing_params: the bundle at the end of cost sharing by BenefitsParser
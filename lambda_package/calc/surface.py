@@ -0,0 +1,214 @@
+"""
+Per-plan OOP response surfaces for instant estimates.
+
+A response surface tabulates, for every benefit category, the OOP of a single claim in that
+category at a fixed set of claim amounts (calculated with calculate_oop()). A member's OOP
+under a plan is then estimated from the member's spend and number of claims per category,
+treating the claims in a category as equal in amount, and adding the categories up.
+
+The estimate comes with approximate bounds:
+    * OOP never decreases when a claim amount goes up, and never goes up faster than it, so the
+      value between two buckets lies between the value at the lower bucket and the smaller of
+      the value at the upper bucket and the value at the lower bucket plus the extra amount.
+    * Each claim is tabulated on its own and pays the deductibles on its own, so the sum over
+      the claims may count the deductible more than once.
+The bounds do not account for claims of unequal amounts within a category, or for the length
+of stay of Part A claims, which are assumed to be a single stay of typical length.
+"""
+from __future__ import absolute_import
+
+from .calculator import calculate_oop
+from .cost import patch_categories
+from .utils import (
+    chained_get,
+    is_snf_claim,
+    INPATIENT_CATEGORIES,
+)
+
+SPEND_BUCKETS = (0.0, 50.0, 100.0, 250.0, 500.0, 1000.0, 2500.0, 5000.0, 10000.0, 25000.0,
+                 50000.0, 100000.0, 250000.0)
+
+SURFACE_CATEGORIES = sorted(set(patch_categories(category) for category in range(1, 50)),
+                            key=int)
+
+_TYPICAL_LENGTH_OF_STAY = {
+    '25': 5,
+    '26': 10,
+    '44': 20,
+}
+
+inf = float('infinity')
+
+
+def _synthetic_claims(category, spend, claim_year):
+    length_of_stay = _TYPICAL_LENGTH_OF_STAY.get(category, 1)
+    claim = {
+        'benefit_category': category,
+        'cost': spend,
+        'length_of_stay': length_of_stay,
+        'admitted': '{}-07-01'.format(claim_year),
+        'discharged': '{}-07-{:02d}'.format(claim_year, min(length_of_stay, 30)),
+    }
+
+    return [claim]
+
+
+def _qualifying_stay(claim_year):
+    # An SNF stay is usually covered only after an inpatient stay of required length:
+    return {
+        'benefit_category': sorted(INPATIENT_CATEGORIES)[0],
+        'cost': 0.01,
+        'length_of_stay': 30,
+        'admitted': '{}-06-01'.format(claim_year),
+        'discharged': '{}-06-30'.format(claim_year),
+    }
+
+
+def _get_oop_parts(claims, plan):
+    costs = calculate_oop(claims, plan, force_network='in_network',
+                          truncate_claims_at_year_boundary=False)
+    return costs['covered_breakdown']['composite'], costs['uncovered']
+
+
+def _get_category_surface(plan, category, claim_year):
+    surface = []
+    for spend in SPEND_BUCKETS:
+        claims = _synthetic_claims(category, spend, claim_year)
+
+        if is_snf_claim(category):
+            stay = [_qualifying_stay(claim_year)]
+            covered, uncovered = _get_oop_parts(stay + claims, plan)
+            stay_covered, stay_uncovered = _get_oop_parts(stay, plan)
+            covered, uncovered = covered - stay_covered, uncovered - stay_uncovered
+        else:
+            covered, uncovered = _get_oop_parts(claims, plan)
+
+        surface.append([round(covered, 2), round(uncovered, 2)])
+
+    return surface
+
+
+def _get_plan_wide_amount(plan, parameter):
+    amounts = [chained_get(plan, [parameter, network_type, 'amount'], None)
+               for network_type in ('composite', 'in_network')]
+    amounts = [float(amount) for amount in amounts if amount is not None]
+
+    return amounts
+
+
+def build_response_surface(plan, claim_year):
+    """
+    :param plan: the benefits dict as produced by BenefitsParser
+    :param claim_year: the year used for the synthetic claims.
+
+    :return: dict
+        {
+            'picwell_id': <str>,
+            'state_fips': <str>,
+            'oop_limit': <float|None: lowest plan-wide OOP limit>,
+            'deductible': <float: the most deductible that a single claim can pay>,
+            'msa_deposit': <float>,
+            'categories': {
+                <category>: [[covered OOP, uncovered cost] for each of SPEND_BUCKETS],
+                ...
+            },
+        }
+    """
+    # The MSA deposit offsets the total OOP, so it is applied after adding up the categories:
+    plan_without_msa = dict((key, value) for key, value in plan.iteritems()
+                            if key != 'msa_deposit')
+
+    oop_limits = _get_plan_wide_amount(plan, 'oop_limits')
+    deductibles = _get_plan_wide_amount(plan, 'deductibles')
+    category_deductibles = [
+        float(category_benefits['deductibles'])
+        for category_benefits in chained_get(plan, ['benefits', 'categories'], {}).itervalues()
+        if 'deductibles' in category_benefits]
+
+    return {
+        'picwell_id': str(plan['picwell_id']),
+        'state_fips': str(plan['state_fips']),
+        'oop_limit': min(oop_limits) if oop_limits else None,
+        'deductible': max(deductibles + [0.0]) + max(category_deductibles + [0.0]),
+        'msa_deposit': float(plan.get('msa_deposit', 0.0)),
+        'categories': {category: _get_category_surface(plan_without_msa, category, claim_year)
+                       for category in SURFACE_CATEGORIES},
+    }
+
+
+def summarize_spend(claims):
+    """ Total cost and number of claims per (patched) benefit category, the input to
+    estimate_oop():
+        {
+            <category>: [<total cost>, <number of claims>],
+            ...
+        }
+    """
+    spend = {}
+    for claim in claims:
+        category = patch_categories(claim.get('benefit_category', 0))
+        cost = float(claim.get('cost', 0.0))
+        if category != '0' and cost > 0:
+            total, count = spend.get(category, (0.0, 0))
+            spend[category] = [total + cost, count + 1]
+
+    return spend
+
+
+def _interpolate(values, spend):
+    """ Returns (lower, estimate, upper) of a non-decreasing function tabulated on SPEND_BUCKETS.
+    """
+    for index in xrange(1, len(SPEND_BUCKETS)):
+        if spend <= SPEND_BUCKETS[index]:
+            low_spend, high_spend = SPEND_BUCKETS[index - 1], SPEND_BUCKETS[index]
+            low_value, high_value = values[index - 1], values[index]
+
+            upper = min(high_value, low_value + spend - low_spend)
+            fraction = (spend - low_spend) / (high_spend - low_spend)
+            estimate = low_value + fraction * (high_value - low_value)
+
+            return low_value, min(estimate, upper), upper
+
+    # Beyond the last bucket, OOP grows at most as fast as spend:
+    last_value = values[-1]
+    return last_value, last_value, last_value + spend - SPEND_BUCKETS[-1]
+
+
+def estimate_oop(surface, spend):
+    """
+    :param surface: a response surface as produced by build_response_surface().
+    :param spend: dict of total cost and number of claims per benefit category, as produced by
+        summarize_spend(). A total cost alone counts as a single claim.
+
+    :return: (estimate, lower, upper)
+    """
+    covered = [0.0, 0.0, 0.0]  # lower, estimate, upper
+    uncovered = [0.0, 0.0, 0.0]
+    total_spend = 0.0
+    deductible_paid = 0.0
+
+    for category, amount in spend.iteritems():
+        total, count = amount if isinstance(amount, (list, tuple)) else (amount, 1)
+        category_surface = surface['categories'].get(patch_categories(category))
+        if category_surface is None or total <= 0 or count <= 0:
+            continue
+
+        claim_amount = float(total) / count
+        for totals, values in ((covered, [value[0] for value in category_surface]),
+                               (uncovered, [value[1] for value in category_surface])):
+            for index, value in enumerate(_interpolate(values, claim_amount)):
+                totals[index] += count * value
+
+        total_spend += total
+        deductible_paid += count * min(claim_amount, surface['deductible'])
+
+    # Each claim paid the deductibles on its own, but together they pay them only once:
+    covered[0] = max(covered[0] - (deductible_paid - min(total_spend, surface['deductible'])),
+                     0.0)
+
+    oop_limit = surface['oop_limit'] if surface['oop_limit'] is not None else inf
+    lower, estimate, upper = (
+        max(0.0, min(covered_oop, oop_limit) + uncovered_oop - surface['msa_deposit'])
+        for covered_oop, uncovered_oop in zip(covered, uncovered))
+
+    return min(max(estimate, lower), upper), lower, upper
@@ -29,10 +29,15 @@ def cache_benefit_fun(fun):
     cache = {}
 
     def wrapped(benefits, *args):
-        h = hash(args) + hash(benefits['picwell_id'])
-        if h not in cache:
-            cache[h] = fun(benefits, *args)
-        return cache[h]
+        # Plans from different benefits versions (see benefits_loader) can share a picwell_id:
+        key = (benefits['picwell_id'], benefits.get('benefits_version')) + args
+
+        # Each entry keeps the plan that it was calculated for: a plan reloaded with changed
+        # benefits is a new object, and replaces the entry. Plans are not changed in place.
+        entry = cache.get(key)
+        if entry is None or entry[0] is not benefits:
+            entry = cache[key] = (benefits, fun(benefits, *args))
+        return entry[1]
 
     return wrapped
 
@@ -0,0 +1,162 @@
+"""
+Loads the claims of people, keeping the most recently used in memory across warm invocations of
+the Lambda function.
+
+The same uid is often calculated several times in quick succession: a batch call followed by
+detailed calls for a few pids, or retries. The claims of up to CACHE_SIZE people (in the [claims]
+section of lambda.cfg) are cached by uid, and revalidated whenever they are used: with a
+conditional GET (If-None-Match) of the claims file, or by reading only the VERSION_ATTRIBUTE of
+the DynamoDB item. Unchanged claims are neither read nor parsed again. DynamoDB items without the
+version attribute are not cached.
+
+The cached claims are shared by all the calls that use them, and must be treated as read-only.
+"""
+import collections
+import logging
+import threading
+
+from blob_store import make_blob_store
+from storage_utils import (
+    ClaimsClient,
+    fetch_all,
+    fetch_with_retries,
+)
+
+logger = logging.getLogger()
+
+# Caches by size; lambda.cfg is packaged with the function, so a container has one:
+_CACHES = {}
+_CACHES_LOCK = threading.Lock()
+
+
+class ClaimsCache(object):
+    """ The claims of the most recently used people, with the version that they were read at.
+    Thread-safe.
+    """
+
+    def __init__(self, max_persons):
+        self._max_persons = max_persons
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        # Lookups since the cache was created whose claims were unchanged, or had to be read:
+        self.hits = 0
+        self.misses = 0
+
+    def get_version(self, uid):
+        """
+        :return: the version of the cached claims of uid, or None if they are not cached.
+        """
+        with self._lock:
+            return self._entries[uid][1] if uid in self._entries else None
+
+    def hit(self, uid):
+        """
+        :return: the cached claims of uid, now the most recently used, or None if they were
+            evicted since their version was looked up.
+        """
+        with self._lock:
+            if uid not in self._entries:
+                return None
+
+            person, version = self._entries.pop(uid)
+            self._entries[uid] = (person, version)
+            self.hits += 1
+
+        return person
+
+    def store(self, uid, person, version):
+        """ Caches the claims read for uid, unless they have no version, evicting the least
+        recently used claims beyond the size of the cache.
+        """
+        with self._lock:
+            self.misses += 1
+            self._entries.pop(uid, None)
+            if version is None or self._max_persons <= 0:
+                return
+
+            self._entries[uid] = (person, version)
+            while len(self._entries) > self._max_persons:
+                self._entries.popitem(last=False)
+
+
+def _get_cache(configs):
+    with _CACHES_LOCK:
+        if configs.claims_cache_size not in _CACHES:
+            _CACHES[configs.claims_cache_size] = ClaimsCache(configs.claims_cache_size)
+
+        return _CACHES[configs.claims_cache_size]
+
+
+def _get_claims_client(configs, aws_options):
+    if configs.use_s3_for_claims:
+        return ClaimsClient(aws_options,
+                            blob_store=make_blob_store(configs.blob_store, configs.claims_bucket,
+                                                       configs.claims_path, aws_options,
+                                                       configs.blob_root))
+
+    return ClaimsClient(aws_options, table_name=configs.claims_table,
+                        version_attribute=configs.claims_version_attribute)
+
+
+def _load_person(cache, client, uid):
+    result = client.get_if_changed(uid, cache.get_version(uid))
+    if result is None:
+        person = cache.hit(uid)
+        if person is not None:
+            return person
+
+        result = client.get_if_changed(uid)
+
+    person, version = result
+    cache.store(uid, person, version)
+
+    return person
+
+
+def load_persons(configs, aws_options, uids):
+    """ Fetches the claims of several people concurrently, unless they are cached and unchanged.
+
+    :return: (list of people in the order of uids, dict of error messages by uid). People whose
+        claims cannot be fetched are left out of the list.
+    """
+    cache = _get_cache(configs)
+    client = _get_claims_client(configs, aws_options)
+    hits, misses = cache.hits, cache.misses
+
+    # The error of a uid is reported once its retries failed:
+    def load(uid):
+        try:
+            return fetch_with_retries(lambda uid: _load_person(cache, client, uid), uid), None
+
+        except Exception as e:
+            return None, str(e)
+
+    results, _ = fetch_all(load, uids)
+
+    hits, misses = cache.hits - hits, cache.misses - misses
+    logger.info('Found {} of {} people in the claims cache ({} hits and {} misses in this '
+                'container).'.format(hits, hits + misses, cache.hits, cache.misses))
+
+    # Only the first record of each claims file is read (see ClaimsClient):
+    if client.use_s3 and client.bytes_stored:
+        logger.info('Read {} of {} bytes of claims files ({:.1%}).'.format(
+            client.bytes_read, client.bytes_stored,
+            float(client.bytes_read) / client.bytes_stored))
+
+    persons = [person for person, _ in results if person is not None]
+    errors = {uid: error for uid, (_, error) in zip(uids, results) if error is not None}
+
+    return persons, errors
+
+
+def load_person(configs, aws_options, uid):
+    """
+    :return: the claims of the person, as load_persons().
+    :raises Exception: if the claims cannot be fetched.
+    """
+    persons, errors = load_persons(configs, aws_options, [uid])
+    if errors:
+        raise Exception(errors[uid])
+
+    return persons[0]
@@ -1,5 +1,7 @@
 from __future__ import absolute_import
 
+import json
+
 from storage import DynamoDBStorage
 from .utils import read_cost_json
 
@@ -12,6 +14,22 @@ class DynamoDBCostMap(object):
     def _pack_oops(oop_dict):
         return {pid: '{0:.2f}'.format(oop) for pid, oop in oop_dict.iteritems()}
 
+    @staticmethod
+    def _pack_trend_oops(trend_oop_dict):
+        return {pid: ['{0:.2f}'.format(oop) for oop in oops]
+                for pid, oops in trend_oop_dict.iteritems()}
+
+    @staticmethod
+    def _pack_cost_item(cost_item):
+        # Items with cost trend scenarios (see batch_api) also store the trends and the OOPs
+        # under each trend:
+        if 'trend_oops' not in cost_item:
+            return cost_item
+
+        return dict(cost_item,
+                    trends=json.dumps(cost_item['trends']),
+                    trend_oops=DynamoDBCostMap._pack_trend_oops(cost_item['trend_oops']))
+
     @staticmethod
     def _unpack_oops(oop_dict):
         return {pid: float(oop) for pid, oop in oop_dict.iteritems()}
@@ -57,7 +75,8 @@ class DynamoDBCostMap(object):
                                         unpacker=self._unpack_oops)
 
     def add_items(self, cost_items):
-        self._storage.add_items(cost_items)
+        self._storage.add_items(DynamoDBCostMap._pack_cost_item(cost_item)
+                                for cost_item in cost_items)
 
     def update_items(self, cost_items):
         self._storage.update_items(cost_items)
@@ -1,51 +1,221 @@
+import base64
+import gzip
 import json
+import uuid
 from datetime import datetime
+from StringIO import StringIO
 
-from calc.calculator import calculate_oop
+from benefits_loader import (
+    get_unknown,
+    PlanIndex,
+)
+from calc.utils import chained_get
+from engine import (
+    select_engine,
+    timing_record,
+)
 from utils import (
+    fail_with_message,
+    succeed_with_body,
     succeed_with_message,
     filter_and_sort_claims,
+    get_flag,
+    respond_with_result,
 )
 
+_FORMATS = ('rows', 'columnar')
+
+# Fields that identify the costs of a plan:
+_ID_FIELDS = ('uid', 'picwell_id', 'benefits_version')
 
-def _calculate_detail(person, plans, claim_year, month):
-    # TODO: should we inflate claims?
+
+def _calculate_detail(person, plans, claim_year, month, engine, trends=None):
+    # Claims are not inflated unless cost trends are requested. The costs without a trend are
+    # calculated in the same pass as the trend scenarios:
     claims = person.get('medical_claims', [])
     claims_to_process = filter_and_sort_claims(claims, claim_year, month)
 
-    costs = []
-    for plan in plans:
-        cost = calculate_oop(claims_to_process, plan, force_network='in_network',
-                             truncate_claims_at_year_boundary=False)
+    if trends is None:
+        costs = engine.calculate(claims_to_process, plans)
+
+    else:
+        costs = []
+        for scenario_costs in engine.calculate(claims_to_process, plans,
+                                               trends=[0.0] + list(trends)):
+            cost = scenario_costs[0]
+            cost['trends'] = trends
+            cost['trend_oops'] = [trend_cost['oop'] for trend_cost in scenario_costs[1:]]
+            costs.append(cost)
 
+    for plan, cost in zip(plans, costs):
         cost['uid'] = person['uid']
         cost['picwell_id'] = str(plan['picwell_id'])
-
-        costs.append(cost)
+        if plan.get('benefits_version') is not None:
+            cost['benefits_version'] = plan['benefits_version']
 
     return costs
 
 
-def run_detailed(person, plans, claim_year, run_options, logger, start_time):
+def _to_columns(person, costs, fields=None):
+    """ Sends the plan IDs once, followed by an array per field in the same order:
+        {
+            'uid': <str>,
+            'picwell_ids': [<str>, ...],
+            'fields': {
+                <field>: [<value for each plan>, ...],
+                ...
+            },
+        }
+
+    A field may name a nested value with dots (e.g. 'covered_breakdown.composite'); a value is
+    None for a plan that does not have the field.
+    """
+    if fields is None:
+        fields = sorted(set(key for cost in costs for key in cost) - {'uid', 'picwell_id'})
+
+    return {
+        'uid': person['uid'],
+        'picwell_ids': [cost['picwell_id'] for cost in costs],
+        'fields': {field: [chained_get(cost, field.split('.'), None) for cost in costs]
+                   for field in fields},
+    }
+
+
+def _select_fields(cost, fields):
+    row = {field: cost[field] for field in _ID_FIELDS if field in cost}
+    row.update((field, chained_get(cost, field.split('.'), None)) for field in fields)
+
+    return row
+
+
+def _offload(person, costs, fields, blob_store):
+    """ Writes the costs as gzipped NDJSON (a JSON object per line) to the blob store.
+
+    :return: dict pointing to the results.
+    """
+    key = 'detailed/{}/{}-{}.ndjson.gz'.format(person['uid'],
+                                               datetime.now().strftime('%Y%m%dT%H%M%S'),
+                                               uuid.uuid4().hex[:8])
+
+    with blob_store.writer(key) as f:
+        with gzip.GzipFile(fileobj=f, mode='wb') as gzip_file:
+            for cost in costs:
+                row = cost if fields is None else _select_fields(cost, fields)
+                gzip_file.write(json.dumps(row))
+                gzip_file.write('\n')
+
+    return {
+        'status': 'offloaded',
+        'location': blob_store.location(key),
+        'url': blob_store.url(key),
+        'format': 'ndjson',
+        'compression': 'gzip',
+        'count': len(costs),
+    }
+
+
+def _gzip(body):
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(body)
+
+    return base64.b64encode(buf.getvalue())
+
+
+def _encode(result, compress, double_encoded):
+    """
+    :return: (result of main() with the encoded result, number of bytes of the response that
+        Lambda returns). Lambda encodes the whole response of respond() as JSON again, which
+        escapes the quotes of a JSON body, so the response is larger than its body.
+    """
+    if double_encoded:
+        res = succeed_with_message(json.dumps(result))
+
+    else:
+        body = json.dumps(result, separators=(',', ':'))
+        res = (succeed_with_body(_gzip(body), gzipped=True) if compress else
+               succeed_with_body(body))
+
+    return res, len(json.dumps(respond_with_result(res)))
+
+
+def run_detailed(person, plan_indexes, claim_year, run_options, logger, start_time,
+                 blob_store=None, offload_bytes=None):
+    """
+    :param plan_indexes: dict of PlanIndex by benefits version (None for the default benefits).
+        The costs of plans from a benefits version other than the default include the version.
+
+    By default, the costs are returned as a JSON string of a list with the full breakdown for
+    each plan. run_options['format'] = 'columnar' returns the costs by field instead (see
+    _to_columns()), limited to run_options['fields'] if given, and run_options['compress']
+    gzips the response. Either way, the response body is encoded only once.
+
+    If the response that Lambda returns is larger than offload_bytes, the costs are written to
+    the blob store instead, as gzipped NDJSON with a plan per line (limited to
+    run_options['fields'] if given), and the response is a pointer to them (see _offload()) in
+    the requested encoding.
+    """
+    response_format = run_options.get('format', 'rows')
+    if response_format not in _FORMATS:
+        return fail_with_message('Unrecognized format: {}'.format(response_format))
+
+    try:
+        compress = get_flag(run_options, 'compress')
+
+    except ValueError as e:
+        return fail_with_message(e.message)
+
     # If no pids is given, run for all available plans:
     if 'pids' in run_options:
-        pids = set(str(pid) for pid in run_options['pids'])
-        filtered_plans = filter(lambda plan: str(plan['picwell_id']) in pids, plans)
+        pids = [str(pid) for pid in run_options['pids']]
+
+        unknown_pids = get_unknown(plan_indexes.itervalues(), pids, PlanIndex.has_pid)
+        if unknown_pids:
+            return fail_with_message('Unrecognized pids: {}'.format(', '.join(unknown_pids)))
+
+        filtered_plans = [plan for plan_index in plan_indexes.itervalues()
+                          for plan in plan_index.find(pids)]
 
     else:
-        filtered_plans = plans
+        filtered_plans = [plan for plan_index in plan_indexes.itervalues()
+                          for plan in plan_index.plans]
 
     # Use the full year if the proration period is not specified:
     month = str(run_options.get('month', 1)).zfill(2)
 
+    engine, shape = select_engine(person.get('medical_claims', []), filtered_plans, 1,
+                                  run_options, logger)
+
     setup_elapsed = (datetime.now() - start_time).total_seconds()
     logger.info('Total setup took {} seconds.'.format(setup_elapsed) +
                 'Start calculation to return full calculation results:')
 
-    costs = _calculate_detail(person, filtered_plans, claim_year, month)
+    calculation_time = datetime.now()
+    costs = _calculate_detail(person, filtered_plans, claim_year, month, engine,
+                              run_options.get('trends'))
+    logger.info(timing_record(engine, shape,
+                              (datetime.now() - calculation_time).total_seconds()))
 
     end_time = datetime.now()
     elapsed = (end_time - start_time).total_seconds()
     logger.info('Clock stopped at {}. Elapsed: {}'.format(str(end_time), str(elapsed)))
 
-    return succeed_with_message(json.dumps(costs))
\ No newline at end of file
+    # The default format without compression is kept as a JSON string inside the response body
+    # for existing clients:
+    double_encoded = response_format == 'rows' and not compress
+
+    if response_format == 'columnar':
+        result = _to_columns(person, costs, run_options.get('fields'))
+
+    else:
+        result = costs
+
+    res, response_bytes = _encode(result, compress, double_encoded)
+
+    if blob_store is not None and offload_bytes is not None and response_bytes > offload_bytes:
+        logger.info('Offloading the costs of {} plans ({} bytes).'.format(len(costs),
+                                                                          response_bytes))
+        res, _ = _encode(_offload(person, costs, run_options.get('fields'), blob_store),
+                         False, double_encoded)
+
+    return res
@@ -0,0 +1,392 @@
+"""
+Execution engines that evaluate a set of claims against many plans, and the cost model used to
+pick one of them for a request.
+
+Two engines are available:
+
+    * 'scalar': evaluates the plans one after another in the calling process.
+    * 'process': splits the plans into contiguous chunks and evaluates each chunk in a forked
+      process. Only Process and Pipe are used because multiprocessing.Pool and Queue need
+      /dev/shm, which is not available on Lambda.
+
+Outside Lambda, a long-running server registers a 'pool' engine that evaluates the chunks in a
+pool of processes forked once (see server.py). Like the others, it is used when the cost model
+predicts it to be the fastest, or when a request asks for it.
+
+Compiled plans with the same cost sharing (see calc/compiler.py) are calculated once by every
+engine, and share the results.
+
+The cost model predicts the run time of each engine from the shape of the workload.
+fit_cost_model.py fits it from the timing records that run_batch() and run_detailed() log, and
+writes the coefficients to cost_model.json, which is packaged with the calculator.
+"""
+import copy
+import json
+import multiprocessing
+import os
+
+from calc.calculator import (
+    calculate_prepared_oop,
+    calculate_prepared_oop_scenarios,
+    prepare_claims,
+)
+from calc.cost import get_tier_depth
+from calc.utils import is_part_a_claim
+
+SCALAR = 'scalar'
+PROCESS = 'process'
+ENGINES = (SCALAR, PROCESS)
+POOL = 'pool'
+
+# Engines registered at run time, by name:
+_REGISTERED_ENGINES = {}
+
+# Plans inherited by the workers of a PoolEngine, by _get_plan_key(). Plans are not changed in
+# place, so a plan that is not the same object as the inherited one was reloaded since:
+_WORKER_PLANS = {}
+
+# Coefficients fitted by fit_cost_model.py, packaged with the calculator:
+_COEFFICIENTS_FILE_NAME = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                       'cost_model.json')
+
+# Starting values for the engines that cost_model.json does not have. Each entry is
+# (setup seconds per calculation, seconds per unit of work); see WorkloadShape for both.
+_DEFAULT_COEFFICIENTS = {
+    SCALAR: (0.0, 1.3e-5),
+    PROCESS: (0.03, 0.7e-5),
+    # The pool is forked once, so only the claims and the plan keys are sent to the workers:
+    POOL: (0.003, 0.7e-5),
+}
+
+# CostModel by coefficients file, loaded on first use (see select_engine()):
+_COST_MODEL_CACHE = {}
+
+# A Part A claim walks through the day intervals of a plan, so it costs more than a Part B claim:
+_PART_A_WEIGHT = 0.5
+
+
+def _get_unique_plans(plans):
+    """
+    :return: (list with one plan of each equivalence class, list of the index of the class of
+        each plan in that list). Plans without an equivalence class are their own class.
+    """
+    unique_plans = []
+    class_indexes = []
+    indexes_by_class = {}
+    for plan in plans:
+        equivalence_class = plan.get('equivalence_class')
+        if equivalence_class not in indexes_by_class:
+            if equivalence_class is not None:
+                indexes_by_class[equivalence_class] = len(unique_plans)
+            class_indexes.append(len(unique_plans))
+            unique_plans.append(plan)
+
+        else:
+            class_indexes.append(indexes_by_class[equivalence_class])
+
+    return unique_plans, class_indexes
+
+
+def _share_results(results, class_indexes):
+    # The callers add to the results of each plan, so the plans of a class get copies:
+    shared_results = []
+    used_indexes = set()
+    for index in class_indexes:
+        shared_results.append(copy.deepcopy(results[index]) if index in used_indexes
+                              else results[index])
+        used_indexes.add(index)
+
+    return shared_results
+
+
+def _calculate(claims, plans, oop_only, trends):
+    prepared_claims = prepare_claims(claims, force_network='in_network',
+                                     truncate_claims_at_year_boundary=False)
+
+    results = []
+    for plan in plans:
+        if trends is None:
+            costs = calculate_prepared_oop(prepared_claims, plan)
+            results.append(costs['oop'] if oop_only else costs)
+
+        else:
+            scenario_costs = calculate_prepared_oop_scenarios(prepared_claims, plan, trends)
+            results.append([costs['oop'] for costs in scenario_costs] if oop_only
+                           else scenario_costs)
+
+    return results
+
+
+def _calculate_and_send(connection, claims, plans, oop_only, trends):
+    try:
+        connection.send((True, _calculate(claims, plans, oop_only, trends)))
+    except Exception as e:
+        connection.send((False, str(e)))
+    finally:
+        connection.close()
+
+
+class ScalarEngine(object):
+    name = SCALAR
+
+    def calculate(self, claims, plans, oop_only=False, trends=None):
+        """ Returns the calculation results (full costs, or only the OOPs) in the order of plans.
+        If cost trends are given, the result for each plan is a list with one entry per trend.
+        """
+        unique_plans, class_indexes = _get_unique_plans(plans)
+        return _share_results(_calculate(claims, unique_plans, oop_only, trends), class_indexes)
+
+
+class ProcessEngine(object):
+    name = PROCESS
+
+    def __init__(self, processes=None):
+        self._processes = processes or multiprocessing.cpu_count()
+
+    def calculate(self, claims, plans, oop_only=False, trends=None):
+        plans, class_indexes = _get_unique_plans(plans)
+        return _share_results(self._calculate_in_processes(claims, plans, oop_only, trends),
+                              class_indexes)
+
+    def _calculate_in_processes(self, claims, plans, oop_only, trends):
+        chunk_size = -(-len(plans) // self._processes)  # ceiling division
+        if chunk_size == 0 or self._processes == 1:
+            return _calculate(claims, plans, oop_only, trends)
+
+        workers = []
+        for start in xrange(0, len(plans), chunk_size):
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(
+                target=_calculate_and_send,
+                args=(sender, claims, plans[start:start + chunk_size], oop_only, trends))
+            process.start()
+            sender.close()
+            workers.append((process, receiver))
+
+        # Receive before joining; a child blocks on send() until its results are read:
+        results = []
+        errors = []
+        for process, receiver in workers:
+            succeeded, value = receiver.recv()
+            if succeeded:
+                results += value
+            else:
+                errors.append(value)
+            process.join()
+
+        if errors:
+            raise Exception('Calculation failed in a worker process: {}'.format(errors[0]))
+
+        return results
+
+
+def _get_plan_key(plan):
+    return str(plan['picwell_id']), plan.get('benefits_version')
+
+
+def _calculate_chunk(args):
+    claims, plan_refs, oop_only, trends = args
+    plans = [_WORKER_PLANS[plan_ref] if isinstance(plan_ref, tuple) else plan_ref
+             for plan_ref in plan_refs]
+
+    return _calculate(claims, plans, oop_only, trends)
+
+
+class PoolEngine(object):
+    """ Evaluates chunks of plans in a multiprocessing.Pool that is forked once, for long-running
+    processes (multiprocessing.Pool does not work on Lambda). The workers inherit the plans given
+    when the pool is created, so only the keys of those plans are sent with each calculation.
+    Plans reloaded since (e.g. revalidated benefits) are sent whole.
+    """
+    name = POOL
+
+    def __init__(self, processes=None, plans=()):
+        self._processes = processes or multiprocessing.cpu_count()
+
+        _WORKER_PLANS.update((_get_plan_key(plan), plan) for plan in plans)
+        self._pool = multiprocessing.Pool(self._processes)
+
+    def calculate(self, claims, plans, oop_only=False, trends=None):
+        plans, class_indexes = _get_unique_plans(plans)
+        plan_refs = [_get_plan_key(plan) if _WORKER_PLANS.get(_get_plan_key(plan)) is plan
+                     else plan for plan in plans]
+        chunk_size = -(-len(plan_refs) // self._processes)  # ceiling division
+        if chunk_size == 0:
+            return []
+
+        chunk_results = self._pool.map(
+            _calculate_chunk,
+            [(claims, plan_refs[start:start + chunk_size], oop_only, trends)
+             for start in xrange(0, len(plan_refs), chunk_size)])
+
+        return _share_results([result for results in chunk_results for result in results],
+                              class_indexes)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+
+def register_engine(engine):
+    """ Makes an engine instance available by its name, e.g. to run_options['engine']. """
+    _REGISTERED_ENGINES[engine.name] = engine
+
+
+def is_engine(name):
+    return name in ENGINES or name in _REGISTERED_ENGINES
+
+
+def get_engine(name):
+    if name in _REGISTERED_ENGINES:
+        return _REGISTERED_ENGINES[name]
+    elif name == SCALAR:
+        return ScalarEngine()
+    elif name == PROCESS:
+        return ProcessEngine()
+    else:
+        raise ValueError('Unrecognized engine: {}'.format(name))
+
+
+class WorkloadShape(object):
+    __slots__ = (
+        'n_claims',
+        'part_a_share',
+        'n_plans',
+        'tier_depth',
+        'n_months',
+    )
+
+    def __init__(self, n_claims, part_a_share, n_plans, tier_depth, n_months):
+        self.n_claims = n_claims
+        self.part_a_share = part_a_share
+        self.n_plans = n_plans
+        self.tier_depth = tier_depth
+        self.n_months = n_months
+
+    @staticmethod
+    def from_request(claims, plans, n_months):
+        plans = list(plans)
+        n_part_a = sum(1 for claim in claims
+                       if is_part_a_claim(str(claim.get('benefit_category', 0))))
+        tier_depth = (float(sum(get_tier_depth(plan) for plan in plans)) / len(plans)
+                      if plans else 0.0)
+
+        return WorkloadShape(n_claims=len(claims),
+                             part_a_share=float(n_part_a) / len(claims) if claims else 0.0,
+                             n_plans=len(plans),
+                             tier_depth=tier_depth,
+                             n_months=n_months)
+
+    @property
+    def work(self):
+        """ Number of claim-plan evaluations, with Part A claims weighted by the tier depth. """
+        claim_weight = 1.0 + _PART_A_WEIGHT * self.part_a_share * self.tier_depth
+        return self.n_plans * self.n_months * self.n_claims * claim_weight
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in WorkloadShape.__slots__}
+
+
+class CostModel(object):
+    """ Predicts the run time of an engine as its setup for each calculation, one a month (see
+    run_batch()), plus its time per unit of work.
+    """
+    def __init__(self, coefficients=None):
+        self._coefficients = dict(coefficients or _DEFAULT_COEFFICIENTS)
+
+    @property
+    def coefficients(self):
+        return dict(self._coefficients)
+
+    def predict_seconds(self, shape, engine_name):
+        setup, per_unit = self._coefficients[engine_name]
+        return setup * shape.n_months + per_unit * shape.work
+
+    def choose_engine(self, shape):
+        """ Returns the name of the available engine with the lowest predicted run time. """
+        return min((engine_name for engine_name in self._coefficients if is_engine(engine_name)),
+                   key=lambda engine_name: self.predict_seconds(shape, engine_name))
+
+    @staticmethod
+    def fit(timing_records):
+        """ Fits the coefficients by least squares of seconds against the number of calculations
+        (months) and the work, per engine.
+
+        :param timing_records: an iterable of dicts as produced by timing_record(). Engines whose
+            records do not tell the setup from the work keep their default coefficients.
+        :return: a CostModel.
+        """
+        samples = {}
+        for record in timing_records:
+            shape = WorkloadShape(**record['shape'])
+            samples.setdefault(record['engine'], []).append(
+                (shape.n_months, shape.work, record['seconds']))
+
+        coefficients = dict(_DEFAULT_COEFFICIENTS)
+        for engine_name, points in samples.iteritems():
+            # Normal equations of seconds = setup * months + per_unit * work:
+            s_mm = sum(m * m for m, _, _ in points)
+            s_mw = sum(m * w for m, w, _ in points)
+            s_ww = sum(w * w for _, w, _ in points)
+            s_my = sum(m * y for m, _, y in points)
+            s_wy = sum(w * y for _, w, y in points)
+            det = float(s_mm * s_ww - s_mw * s_mw)
+            if abs(det) <= 1e-9 * s_mm * s_ww:
+                continue
+
+            setup = (s_my * s_ww - s_wy * s_mw) / det
+            per_unit = (s_wy * s_mm - s_my * s_mw) / det
+            coefficients[engine_name] = (max(setup, 0.0), max(per_unit, 0.0))
+
+        return CostModel(coefficients)
+
+    @staticmethod
+    def load(file_name=_COEFFICIENTS_FILE_NAME):
+        """ Reads the coefficients that save() wrote, over the default ones. Without the file,
+        the default coefficients are used.
+
+        :return: a CostModel.
+        """
+        coefficients = dict(_DEFAULT_COEFFICIENTS)
+        if os.path.isfile(file_name):
+            with open(file_name) as fp:
+                coefficients.update((str(engine_name), tuple(engine_coefficients))
+                                    for engine_name, engine_coefficients
+                                    in json.load(fp).iteritems())
+
+        return CostModel(coefficients)
+
+    def save(self, file_name=_COEFFICIENTS_FILE_NAME):
+        with open(file_name, 'w') as fp:
+            json.dump(self._coefficients, fp, indent=4, separators=(',', ': '), sort_keys=True)
+
+
+def select_engine(claims, plans, n_months, run_options, logger, cost_model=None):
+    """ Chooses the engine for a request. run_options['engine'] overrides the cost model, and
+    the packaged cost model is used unless another is given.
+
+    :return: (engine, shape)
+    """
+    if cost_model is None:
+        if _COEFFICIENTS_FILE_NAME not in _COST_MODEL_CACHE:
+            _COST_MODEL_CACHE[_COEFFICIENTS_FILE_NAME] = CostModel.load()
+        cost_model = _COST_MODEL_CACHE[_COEFFICIENTS_FILE_NAME]
+
+    shape = WorkloadShape.from_request(claims, plans, n_months)
+
+    engine_name = run_options.get('engine') or cost_model.choose_engine(shape)
+    logger.info('Using the {} engine; predicted calculation time is {:.3f} seconds '
+                '({} plans, {} claims, {} months).'.format(
+                    engine_name, cost_model.predict_seconds(shape, engine_name),
+                    shape.n_plans, shape.n_claims, shape.n_months))
+
+    return get_engine(engine_name), shape
+
+
+def timing_record(engine, shape, seconds):
+    """ A JSON line that is logged after each calculation to fit the cost model later. """
+    return 'TIMING ' + json.dumps({
+        'engine': engine.name,
+        'shape': shape.to_dict(),
+        'seconds': seconds,
+    })
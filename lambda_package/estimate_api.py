@@ -0,0 +1,85 @@
+import json
+from datetime import datetime
+
+from calc.surface import (
+    estimate_oop,
+    summarize_spend,
+)
+from utils import (
+    fail_with_message,
+    filter_and_sort_claims,
+    get_flag,
+    succeed_with_message,
+)
+
+# Options passed on to the exact batch calculation started by an estimate:
+_BATCH_OPTIONS = ('uid', 'months', 'states')
+
+
+def _rank_plans(surfaces, spend):
+    ranking = []
+    for surface in surfaces:
+        estimate, lower, upper = estimate_oop(surface, spend)
+        ranking.append({
+            'picwell_id': surface['picwell_id'],
+            'state': surface['state_fips'],
+            'oop': round(estimate, 2),
+            'error': round(max(upper - estimate, estimate - lower), 2),
+        })
+
+    return sorted(ranking, key=lambda item: item['oop'])
+
+
+def _start_batch(run_options, invoker, logger):
+    batch_options = dict((key, run_options[key]) for key in _BATCH_OPTIONS if key in run_options)
+    batch_options['service'] = 'batch'
+
+    try:
+        return invoker.invoke_async(batch_options)
+
+    except Exception as e:
+        # The estimate is still useful without the exact calculation:
+        logger.error('Failed to start the batch calculation: {}'.format(e))
+        return False
+
+
+def run_estimate(person, surfaces, claim_year, run_options, invoker, logger, start_time):
+    """ Ranks plans by the OOP estimated from response surfaces (see calc/surface.py).
+
+    run_options['spend'] gives the spend summary directly; otherwise, it is calculated from the
+    person's claims from run_options['month'] on. run_options['top'] limits the number of plans
+    returned. Unless run_options['start_batch'] is false, the exact batch calculation is started
+    asynchronously with the invoker.
+    """
+    try:
+        start_batch = get_flag(run_options, 'start_batch', default=True)
+
+    except ValueError as e:
+        return fail_with_message(e.message)
+
+    if 'spend' in run_options:
+        spend = run_options['spend']
+
+    else:
+        month = str(run_options.get('month', 1)).zfill(2)
+        claims = filter_and_sort_claims(person.get('medical_claims', []), claim_year, month)
+        spend = summarize_spend(claims)
+
+    setup_elapsed = (datetime.now() - start_time).total_seconds()
+    logger.info('Total setup took {} seconds.'.format(setup_elapsed) +
+                'Start estimation from response surfaces:')
+
+    ranking = _rank_plans(surfaces, spend)
+    if 'top' in run_options:
+        ranking = ranking[:int(run_options['top'])]
+
+    batch_started = _start_batch(run_options, invoker, logger) if start_batch else False
+
+    end_time = datetime.now()
+    elapsed = (end_time - start_time).total_seconds()
+    logger.info('Clock stopped at {}. Elapsed: {}'.format(str(end_time), str(elapsed)))
+
+    return succeed_with_message(json.dumps({
+        'plans': ranking,
+        'batch_started': batch_started,
+    }))
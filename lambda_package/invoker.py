@@ -0,0 +1,75 @@
+import json
+import os
+import threading
+
+import boto3
+
+# Lambda sets this for the running function; the default matches test_client.
+_FUNCTION_NAME = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'ma_calculator')
+
+
+def _as_event(run_options):
+    return {
+        'httpMethod': 'GET',
+        'queryStringParameters': run_options,
+    }
+
+
+class LambdaInvoker(object):
+    """ Invokes the calculator Lambda function with the given run options. """
+
+    def __init__(self, aws_options, function_name=_FUNCTION_NAME):
+        session = boto3.Session(**aws_options)
+        self._client = session.client('lambda')
+        self._function_name = function_name
+
+    def invoke_async(self, run_options):
+        response = self._client.invoke(
+            FunctionName=self._function_name,
+            InvocationType='Event',
+            Payload=json.dumps(_as_event(run_options)).encode('utf-8'),
+        )
+
+        return response['StatusCode'] == 202
+
+    def invoke(self, run_options):
+        """ Invokes the function and waits for the response of lambda_handler(). """
+        response = self._client.invoke(
+            FunctionName=self._function_name,
+            InvocationType='RequestResponse',
+            Payload=json.dumps(_as_event(run_options)).encode('utf-8'),
+        )
+
+        payload = json.loads(response['Payload'].read())
+        if 'FunctionError' in response:
+            return {
+                'statusCode': '500',
+                'body': payload.get('errorMessage'),
+            }
+
+        return payload
+
+
+class LocalInvoker(object):
+    """ Calls a handler in the same process in place of invoking the Lambda function, e.g.
+    LocalInvoker(lambda_handler) to run locally or in tests. With background, asynchronous
+    invocations return right away and call the handler on a daemon thread.
+    """
+
+    def __init__(self, handler, background=False):
+        self._handler = handler
+        self._background = background
+
+    def invoke_async(self, run_options):
+        if self._background:
+            thread = threading.Thread(target=self._handler, args=(_as_event(run_options), None))
+            thread.daemon = True
+            thread.start()
+
+        else:
+            self._handler(_as_event(run_options), None)
+
+        return True
+
+    def invoke(self, run_options):
+        return self._handler(_as_event(run_options), None)
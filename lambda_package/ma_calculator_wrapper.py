@@ -4,37 +4,52 @@ from __future__ import print_function
 import json
 import logging
 from datetime import datetime
-import os
 
 from batch_api import run_batch
-if os.path.isfile('benefits.py'):
-    from benefits import MA_PLANS  # load benefits at load time
+from benefits_loader import (
+    get_plan_state,
+    get_unknown_versions,
+    load_plans,
+    load_surfaces,
+)
+from blob_store import make_blob_store
+from calc.calculator import validate_trends
+from claims_loader import (
+    load_person,
+    load_persons,
+)
 from config_info import (
     CONFIG_FILE_NAME,
     ConfigInfo,
 )
 from detailed_api import run_detailed
+from engine import is_engine
+from estimate_api import run_estimate
+from invoker import LambdaInvoker
+from orchestrator import run_orchestrated
+from single_flight import (
+    DynamoDBLeaseStore,
+    SingleFlight,
+)
 from utils import (
     fail_with_message,
-)
-from storage_utils import (
-    read_claims_from_s3,
-    read_claims_from_dynamodb,
-    read_benefits_from_s3,
+    respond,
+    respond_with_result,
 )
 
 logger = logging.getLogger()
 logging.basicConfig()
 
+_SERVICES = ('batch', 'detailed', 'estimate', 'orchestrate')
 
-def respond(err, res=None):
-    return {
-        'statusCode': '400' if err else '200',
-        'body': err.message if err else json.dumps(res),
-        'headers': {
-            'Content-Type': 'application/json',
-        },
-    }
+
+def _get_needed_states(service, run_options):
+    """ States whose plans a request needs; None for all states. """
+    if service == 'detailed':
+        return (sorted(set(get_plan_state(pid) for pid in run_options['pids']))
+                if 'pids' in run_options else None)
+
+    return run_options.get('states')
 
 
 def _configure_logging(logger, log_level):
@@ -48,51 +63,139 @@ def _configure_logging(logger, log_level):
         logger.setLevel(logging.ERROR)
 
 
-def main(run_options, aws_options):
+def main(run_options, aws_options, context=None, invoker=None):
+    """
+    :param invoker: invokes the calculator for the work that a request starts (the exact batch of
+        an estimate, the units of the orchestrator, and batch continuations); a LambdaInvoker by
+        default, e.g. a LocalInvoker outside Lambda (see server.py).
+    """
     configs = ConfigInfo(CONFIG_FILE_NAME)
     _configure_logging(logger, configs.log_level)
 
+    # Concurrent batch requests for the same uid are calculated once when a lease table is
+    # configured (see single_flight.py):
+    if (configs.leases_table and run_options.get('service', 'batch') == 'batch' and
+            'uid' in run_options and 'uids' not in run_options and
+            'continuation' not in run_options):
+        single_flight = SingleFlight(DynamoDBLeaseStore(configs.leases_table, aws_options))
+        return single_flight.run(run_options['uid'], run_options,
+                                 lambda: _run(configs, run_options, aws_options, context,
+                                              invoker),
+                                 logger)
+
+    return _run(configs, run_options, aws_options, context, invoker)
+
+
+def _run(configs, run_options, aws_options, context, invoker):
     start_time = datetime.now()
     logger.info('Clock started at {}'.format(str(start_time)))
 
-    if 'uid' not in run_options:
+    if ('uid' not in run_options and 'uids' not in run_options and
+            'continuation' not in run_options):
         return {
             'statusCode': '400',
             'message': 'missing "uid"',
         }
-    uid = run_options['uid']
+    uid = run_options.get('uid')
 
-    # look up claims:
-    logger.info('Retrieving claims for {}...'.format(uid))
-    claim_time = datetime.now()
+    if run_options.get('engine') is not None and not is_engine(run_options['engine']):
+        return fail_with_message('Unrecognized engine: {}'.format(run_options['engine']))
 
-    try:
-        if configs.use_s3_for_claims:
-            person = read_claims_from_s3(uid, configs.claims_bucket, configs.claims_path,
-                                         aws_options)
+    service = run_options.get('service', 'batch')
+    if service not in _SERVICES:
+        return fail_with_message('Unrecognized service: {}'.format(service))
 
-        else:
-            person = read_claims_from_dynamodb(uid, configs.claims_table,
-                                               aws_options)
+    # The batch service evaluates several people against the same plans in one invocation:
+    if 'uids' in run_options and service not in ('batch', 'orchestrate'):
+        return fail_with_message('"uids" is supported only for the batch and orchestrate services')
+    uids = run_options.get('uids') or [uid]
 
-    except Exception as e:
-        logger.error(e.message)
-        return fail_with_message(e.message)
+    # A batch run that was running out of time continues with the remaining work (see
+    # run_batch()):
+    if 'continuation' in run_options:
+        if service != 'batch':
+            return fail_with_message('"continuation" is supported only for the batch service')
+        uids = [continued_uid for continued_uid, _ in run_options['continuation']]
+
+    if 'trends' in run_options:
+        try:
+            validate_trends(run_options['trends'])
+
+        except ValueError as e:
+            return fail_with_message(e.message)
+
+    # Benefits versions (see [benefits_versions] in lambda.cfg) to price against the same claims;
+    # None stands for the default benefits:
+    versions = run_options.get('benefits_versions') or [None]
+    unknown_versions = get_unknown_versions(configs, versions)
+    if unknown_versions:
+        return fail_with_message('Unrecognized benefits versions: {}'.format(
+            ', '.join(str(version) for version in unknown_versions)))
+
+    if service == 'estimate' and versions != [None]:
+        return fail_with_message('Benefits versions are not supported for estimates')
+
+    # look up claims (an estimate can be made from a given spend summary instead, and the
+    # orchestrator leaves the claims to the batch invocations):
+    if service == 'estimate' and 'spend' in run_options:
+        person = {'uid': uid}
+
+    elif service == 'orchestrate':
+        pass
+
+    elif service == 'batch':
+        logger.info('Retrieving claims for {} uids...'.format(len(uids)))
+        claim_time = datetime.now()
+
+        persons, errors = load_persons(configs, aws_options, uids)
+
+        # The others are still calculated when the claims of some cannot be retrieved:
+        for failed_uid, message in errors.iteritems():
+            logger.error('Failed to retrieve claims for {}: {}'.format(failed_uid, message))
+        if not persons:
+            return fail_with_message('; '.join(errors.itervalues()))
 
-    claim_elapsed = (datetime.now() - claim_time).total_seconds()
-    logger.info('Finished retrieving claims for {} in {} seconds.'.format(uid, claim_elapsed))
+        claim_elapsed = (datetime.now() - claim_time).total_seconds()
+        logger.info('Finished retrieving claims for {} uids in {} seconds.'.format(
+            len(persons), claim_elapsed))
+
+    else:
+        logger.info('Retrieving claims for {}...'.format(uid))
+        claim_time = datetime.now()
+
+        try:
+            person = load_person(configs, aws_options, uid)
+
+        except Exception as e:
+            logger.error(e.message)
+            return fail_with_message(e.message)
+
+        claim_elapsed = (datetime.now() - claim_time).total_seconds()
+        logger.info('Finished retrieving claims for {} in {} seconds.'.format(uid, claim_elapsed))
+
+    if service == 'estimate':
+        # Estimates only need the precomputed response surfaces, not the benefits:
+        logger.info('Retrieving response surfaces...')
+
+        try:
+            surfaces = load_surfaces(configs, aws_options, run_options.get('states'))
+
+        except Exception as e:
+            logger.error(e.message)
+            return fail_with_message(e.message)
+
+        return run_estimate(person, surfaces, configs.claims_year, run_options,
+                            invoker or LambdaInvoker(aws_options), logger, start_time)
 
     # look up plans from s3
     logger.info('Retrieving benefits file...')
     benefit_time = datetime.now()
 
     try:
-        if configs.use_s3_for_benefits:
-            plans = read_benefits_from_s3(configs.benefits_bucket, configs.benefits_path,
-                                          aws_options)
-
-        else:
-            plans = MA_PLANS
+        states = _get_needed_states(service, run_options)
+        pids = run_options.get('pids') if service == 'detailed' else None
+        plan_indexes = {version: load_plans(configs, aws_options, version, states, pids)
+                        for version in versions}
 
     except Exception as e:
         logger.error(e.message)
@@ -101,18 +204,25 @@ def main(run_options, aws_options):
     benefit_elapsed = (datetime.now() - benefit_time).total_seconds()
     logger.info('Finished retrieving benefits file in {} seconds.'.format(benefit_elapsed))
 
-    service = run_options.get('service', 'batch')
-    if service == 'batch':
-        return run_batch(person, plans, configs.claims_year, run_options,
-                         configs.costs_table, aws_options,
-                         logger, start_time)
+    if service == 'orchestrate':
+        return run_orchestrated(plan_indexes, run_options, invoker or LambdaInvoker(aws_options),
+                                logger, start_time)
 
-    elif service == 'detailed':
-        return run_detailed(person, plans, configs.claims_year, run_options,
-                            logger, start_time)
+    elif service == 'batch':
+        return run_batch(persons, plan_indexes, configs.claims_year, run_options,
+                         configs.costs_table, aws_options,
+                         logger, start_time,
+                         time_left=context.get_remaining_time_in_millis if context else None,
+                         invoker=invoker or (LambdaInvoker(aws_options) if context else None),
+                         failed=errors)
 
     else:
-        return fail_with_message('Unrecognized service: {}'.format(service))
+        return run_detailed(person, plan_indexes, configs.claims_year, run_options,
+                            logger, start_time,
+                            blob_store=make_blob_store(configs.blob_store, configs.results_bucket,
+                                                       configs.results_path, aws_options,
+                                                       configs.blob_root),
+                            offload_bytes=configs.offload_bytes)
 
 
 def lambda_handler(event, context):
@@ -122,6 +232,8 @@ def lambda_handler(event, context):
     :param event: dict containing info passed in from lambda environment.
                   Query String values end up in event['queryStringParameters']
                     The only needed parameter is 'uid'. 'states' is an optional list of FIPS codes.
+                    The batch service also takes a list of 'uids' instead, or the
+                    'continuation' of a batch run that ran out of time.
                   HTTP Method ends up in event['httpMethod']
 
     :param context: see docs.aws.amazon.com/lambda/latest/dg/python-context-object.html
@@ -131,7 +243,7 @@ def lambda_handler(event, context):
         'region_name': 'us-east-1',
     }
     operations = {
-        'GET': lambda run_options: main(run_options, aws_options)
+        'GET': lambda run_options: main(run_options, aws_options, context)
     }
 
     operation = event['httpMethod']
@@ -139,11 +251,7 @@ def lambda_handler(event, context):
         payload = (event['queryStringParameters'] if operation == 'GET'
         else json.loads(event['body']))
 
-        res = operations[operation](payload)
-        if res['statusCode'] != '200':
-            return respond(ValueError(res['message']), res['message'])
-
-        return respond(None, res['message'])
+        return respond_with_result(operations[operation](payload))
 
     else:
         return respond(ValueError('Unsupported method "{}"'.format(operation)))
@@ -172,10 +280,29 @@ if __name__ == '__main__':
         'states': ['42', '15'],
     }
 
+    # run_options = {
+    #     'service': 'batch',
+    #     'uids': ['1175404001', '1175404002'],
+    #     'months': ['01'],
+    # }
+
+    # run_options = {
+    #     'service': 'orchestrate',
+    #     'uid': '1175404001',
+    #     'max_units': 10,
+    # }
+
     # run_options = {
     #     'service': 'detailed',
     #     'uid': '1175404001',
     #     'pids': ['2820028008119', '2820088001036'],
     # }
 
+    # run_options = {
+    #     'service': 'estimate',
+    #     'uid': '1175404001',
+    #     'states': ['42'],
+    #     'top': 10,
+    # }
+
     print(main(run_options, aws_options))
@@ -0,0 +1,233 @@
+"""
+Fans a large batch request out to parallel batch invocations of the calculator.
+
+The requested (state, month) pairs are partitioned into work units of similar cost. The cost of
+a state for a month is estimated from its plans: every plan counts once, and plans with deeper
+Part A day tiers (see calc.cost.get_tier_depth) count more, since inpatient claims walk through
+the tiers. The months of a state that costs more than a unit are split into contiguous ranges,
+and states with the same months are packed together up to the cost of a unit.
+
+Each unit is calculated by a batch invocation, up to _MAX_DISPATCH_WORKERS of them at the same
+time, so the wall-clock time follows the largest unit rather than the sum of all of them.
+"""
+import json
+from datetime import datetime
+
+from calc.cost import get_tier_depth
+from storage_utils import fetch_all
+from utils import (
+    fail_with_message,
+    succeed_with_message,
+)
+
+_DEFAULT_MAX_UNITS = 20
+
+# Batch invocations waited for at the same time:
+_MAX_DISPATCH_WORKERS = 32
+
+# Extra cost of a plan per Part A day tier:
+_TIER_WEIGHT = 0.1
+
+# Options of the orchestrator that the batch invocations replace or do not take:
+_ORCHESTRATOR_OPTIONS = ('service', 'states', 'months', 'max_units')
+
+
+def _get_plan_cost(plan):
+    return 1.0 + _TIER_WEIGHT * get_tier_depth(plan)
+
+
+def get_state_costs(plan_indexes, states=None):
+    """ Estimated cost of calculating a month of each state, over all benefits versions.
+
+    :param plan_indexes: dict of PlanIndex by benefits version.
+    :param states: states to consider; all states of the plans if None.
+    """
+    state_costs = {}
+    for plan_index in plan_indexes.itervalues():
+        for state in (states if states is not None else plan_index.states):
+            state_cost = sum(_get_plan_cost(plan) for plan in plan_index.in_state(state))
+            if state_cost:
+                state_costs[str(state)] = state_costs.get(str(state), 0.0) + state_cost
+
+    return state_costs
+
+
+def _split_months(months, n_ranges):
+    size, extra = divmod(len(months), n_ranges)
+
+    ranges = []
+    start = 0
+    for index in xrange(n_ranges):
+        end = start + size + (1 if index < extra else 0)
+        ranges.append(tuple(months[start:end]))
+        start = end
+
+    return ranges
+
+
+def partition_work(state_costs, months, max_units=_DEFAULT_MAX_UNITS):
+    """
+    :param state_costs: dict of the cost of a month by state, as from get_state_costs().
+    :param months: list of months to calculate.
+    :param max_units: the number of units to aim for, at least 1. There can be more units when
+        the months of different states are split differently.
+
+    :return: list of (states, months) work units, largest first.
+    """
+    if max_units < 1:
+        raise ValueError('max_units should be at least 1: {}'.format(max_units))
+
+    if not state_costs or not months:
+        return []
+
+    total_cost = sum(state_costs.itervalues()) * len(months)
+    unit_cost = total_cost / max_units
+
+    # Split the months of costly states into ranges no more costly than a unit:
+    pieces = {}  # list of (cost, state) by month range
+    for state, state_cost in state_costs.iteritems():
+        n_ranges = min(len(months), max(1, int(round(state_cost * len(months) / unit_cost))))
+        for month_range in _split_months(months, n_ranges):
+            pieces.setdefault(month_range, []).append((state_cost * len(month_range), state))
+
+    # Pack states with the same months together, most costly first:
+    units = []
+    for month_range, range_pieces in pieces.iteritems():
+        range_units = []  # [cost, states]
+        for cost, state in sorted(range_pieces, reverse=True):
+            fitting_units = [unit for unit in range_units if unit[0] + cost <= unit_cost]
+            if fitting_units:
+                unit = min(fitting_units, key=lambda unit: unit[0])
+                unit[0] += cost
+                unit[1].append(state)
+
+            else:
+                range_units.append([cost, [state]])
+
+        units += [(cost, sorted(states), list(month_range)) for cost, states in range_units]
+
+    return [(states, unit_months) for _, states, unit_months in sorted(units, reverse=True)]
+
+
+def _get_unit_status(response):
+    if response.get('statusCode') != '200':
+        return 'failed', response.get('body')
+
+    # A batch invocation that ran out of time returns its continuation, and one that could not
+    # calculate some people returns their work as 'failed' (see run_batch()):
+    message = json.loads(response['body'])
+    try:
+        result = json.loads(message)
+
+    except ValueError:
+        return 'complete', message
+
+    if not isinstance(result, dict):
+        return 'complete', message
+
+    if result.get('failed'):
+        details = {'failed': result['failed']}
+        if result.get('status') == 'partial' and not result['invoked']:
+            details['continuation'] = result['continuation']
+
+        return 'failed', details
+
+    if result.get('status') != 'partial':
+        return 'complete', message
+
+    return ('continued' if result['invoked'] else 'partial'), result['continuation']
+
+
+def _invoke(invoker, run_options):
+    # Not retried, since a failed invocation may have calculated some of the unit:
+    try:
+        return _get_unit_status(invoker.invoke(run_options))
+
+    except Exception as e:
+        return 'failed', str(e)
+
+
+def dispatch(units, run_options, invoker):
+    """ Calculates each unit in a batch invocation, up to _MAX_DISPATCH_WORKERS at the same time.
+
+    :return: list of (status, details) in the order of the units. The status is 'complete',
+        'continued' (running out of time, and continued in another invocation), 'partial'
+        (running out of time; details give the run options for the rest), or 'failed'. The
+        details of a unit that could not calculate some people give their work as 'failed', and
+        the run options for the rest as 'continuation' if it was not continued.
+    """
+    batch_options = {key: value for key, value in run_options.iteritems()
+                     if key not in _ORCHESTRATOR_OPTIONS}
+    batch_options['service'] = 'batch'
+
+    unit_options = [dict(batch_options, states=states, months=months) for states, months in units]
+    statuses, _ = fetch_all(lambda index: _invoke(invoker, unit_options[index]),
+                            xrange(len(units)), max_workers=_MAX_DISPATCH_WORKERS)
+
+    return statuses
+
+
+def run_orchestrated(plan_indexes, run_options, invoker, logger, start_time):
+    """ Partitions a batch request into work units (see partition_work()) and dispatches them.
+    run_options['max_units'] limits the number of units.
+
+    The response message is a JSON object with the overall status ('complete', 'continued', or
+    'failed') and the status of each unit.
+    """
+    months = run_options.get('months', (month + 1 for month in range(12)))
+    months = [str(month).zfill(2) for month in months]
+
+    states = ([str(state) for state in set(run_options['states'])]
+              if 'states' in run_options else None)
+    state_costs = get_state_costs(plan_indexes, states)
+    if not state_costs:
+        return fail_with_message('No plans for the requested states')
+
+    try:
+        max_units = int(run_options.get('max_units', _DEFAULT_MAX_UNITS))
+
+    except (TypeError, ValueError):
+        return fail_with_message('"max_units" should be an integer: {}'.format(
+            run_options['max_units']))
+
+    if max_units < 1:
+        return fail_with_message('"max_units" should be at least 1: {}'.format(max_units))
+
+    units = partition_work(state_costs, months, max_units)
+
+    setup_elapsed = (datetime.now() - start_time).total_seconds()
+    logger.info('Total setup took {} seconds.'.format(setup_elapsed) +
+                'Dispatching {} work units:'.format(len(units)))
+
+    statuses = dispatch(units, run_options, invoker)
+
+    unit_results = []
+    for (unit_states, unit_months), (status, details) in zip(units, statuses):
+        if status == 'failed':
+            logger.error('Work unit {} {} failed: {}'.format(unit_states, unit_months, details))
+
+        unit_results.append({
+            'states': unit_states,
+            'months': unit_months,
+            'status': status,
+            'details': details,
+        })
+
+    unit_statuses = set(status for status, _ in statuses)
+    if unit_statuses <= {'complete'}:
+        status = 'complete'
+    elif unit_statuses & {'failed', 'partial'}:
+        status = 'failed'
+    else:
+        status = 'continued'
+
+    end_time = datetime.now()
+    elapsed = (end_time - start_time).total_seconds()
+    logger.info('Clock stopped at {}. Elapsed: {}'.format(str(end_time), str(elapsed)))
+
+    result = json.dumps({
+        'status': status,
+        'units': unit_results,
+    })
+
+    return (succeed_with_message(result) if status != 'failed' else fail_with_message(result))
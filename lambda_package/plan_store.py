@@ -0,0 +1,92 @@
+"""
+Compaction of loaded plans, so that more states and benefits versions fit in memory.
+
+Plans are deep trees of dicts with the same keys ('in_network', 'copay', 'interval_max', the
+benefit categories) and often the same cost sharing: thousands of plans have identical tiers and
+category blocks. PlanCompactor replaces every string, number, dict, and list in a plan below the
+top level with a shared equal object, so that each distinct subtree is kept once for all the plans
+compacted, across states and benefits versions.
+
+The shared objects must be treated as read-only; the calculator only reads plans. The top level of
+each plan stays its own, since the loader tags it with the benefits version.
+"""
+import sys
+import threading
+
+# The table of shared objects starts over when it grows past this, so that subtrees of benefits
+# replaced since are not kept forever:
+_MAX_SHARED_OBJECTS = 2000000
+
+_NUMBER_TYPES = (bool, int, long)
+
+
+class PlanCompactor(object):
+    """ Shares equal subtrees among all the plans that it compacts. Thread-safe. """
+
+    def __init__(self, max_shared_objects=_MAX_SHARED_OBJECTS):
+        self._max_shared_objects = max_shared_objects
+        self._shared = {}
+        self._lock = threading.Lock()
+        self._raw_bytes = 0
+        self._added_bytes = 0
+
+        # Bytes saved by all the compactions so far:
+        self.bytes_saved = 0
+
+    def _share(self, value):
+        # Shared objects are looked up by their contents. The contents of a dict or a list are
+        # shared already, so they are identified by id:
+        if isinstance(value, dict):
+            items = [(self._share(key), self._share(item)) for key, item in value.iteritems()]
+            shared_key = (dict, frozenset((id(key), id(item)) for key, item in items))
+
+        elif isinstance(value, list):
+            items = [self._share(item) for item in value]
+            shared_key = (list, tuple(id(item) for item in items))
+
+        elif isinstance(value, basestring) or isinstance(value, _NUMBER_TYPES):
+            shared_key = (type(value), value)
+
+        elif isinstance(value, float):
+            # repr() tells -0.0 from 0.0:
+            shared_key = (float, repr(value))
+
+        else:
+            return value
+
+        self._raw_bytes += sys.getsizeof(value)
+
+        shared = self._shared.get(shared_key)
+        if shared is None:
+            if isinstance(value, dict):
+                shared = dict(items)
+            elif isinstance(value, list):
+                shared = items
+            else:
+                shared = value
+
+            self._shared[shared_key] = shared
+            self._added_bytes += sys.getsizeof(shared)
+
+        return shared
+
+    def compact(self, plans):
+        """ Replaces the contents of the plans with shared objects, in place.
+
+        :return: the number of bytes saved, estimated with sys.getsizeof().
+        """
+        with self._lock:
+            if len(self._shared) > self._max_shared_objects:
+                self._shared.clear()
+
+            self._raw_bytes = 0
+            self._added_bytes = 0
+            for plan in plans:
+                items = [(self._share(key), self._share(value)) for key, value in plan.iteritems()]
+                plan.clear()
+                plan.update(items)
+
+            bytes_saved = self._raw_bytes - self._added_bytes
+            self.bytes_saved += bytes_saved
+
+        return bytes_saved
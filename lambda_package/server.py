@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+"""
+Serves the calculator over HTTP from a long-running process, for deployments outside Lambda.
+
+The benefits (and optionally the response surfaces) are loaded once at startup, and the plans
+are indexed and analyzed before any request comes in. A POST request takes the run options of
+lambda_handler() as a JSON body, e.g.
+
+    curl -d '{"service": "detailed", "uid": "1175404001", "pids": ["2820028008119"]}' \
+        localhost:8080
+
+and returns the body that lambda_handler() would return, with the same status code. Batch,
+detailed, and estimate (top-N) requests are all served.
+
+Python 2 has no asyncio, so requests are handled on threads of a threading HTTP server, and the
+number of calculations in progress is limited by --concurrency. The work that a request starts
+(e.g. the exact batch calculation after an estimate) is calculated in the same process, on
+threads of its own that do not count against the limit. The CPU-bound plan evaluation
+can go to a pool of processes forked once after the plans are loaded (the 'pool' engine; see
+engine.PoolEngine), which the cost model chooses like the other engines unless a request asks
+for one.
+"""
+from __future__ import print_function
+
+import base64
+import json
+import logging
+import threading
+from BaseHTTPServer import (
+    BaseHTTPRequestHandler,
+    HTTPServer,
+)
+from SocketServer import ThreadingMixIn
+
+from benefits_loader import (
+    load_plans,
+    load_surfaces,
+)
+from calc.cost import get_plan_shape
+from config_info import (
+    CONFIG_FILE_NAME,
+    ConfigInfo,
+)
+from engine import (
+    PoolEngine,
+    register_engine,
+)
+from invoker import LocalInvoker
+from ma_calculator_wrapper import (
+    main,
+    respond,
+    respond_with_result,
+)
+
+logger = logging.getLogger()
+
+
+def preload(configs, aws_options, load_estimate_surfaces=False):
+    """ Loads the plans of all benefits versions (and the response surfaces if requested), so
+    that requests find them cached.
+
+    :return: list of all plans.
+    """
+    plans = []
+    for version in [None] + sorted(configs.benefits_versions):
+        plan_index = load_plans(configs, aws_options, version)
+        plans += plan_index.plans
+
+    # The cost function for each plan is chosen by its shape, which is cached:
+    for plan in plans:
+        get_plan_shape(plan)
+
+    if load_estimate_surfaces:
+        load_surfaces(configs, aws_options)
+
+    return plans
+
+
+class CalculatorServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, aws_options, concurrency):
+        HTTPServer.__init__(self, address, CalculatorRequestHandler)
+        self.aws_options = aws_options
+        self.calculation_slots = threading.BoundedSemaphore(concurrency)
+        self.invoker = LocalInvoker(self._handle, background=True)
+
+    def _handle(self, event, context):
+        return respond_with_result(main(event['queryStringParameters'], self.aws_options,
+                                        invoker=self.invoker))
+
+
+class CalculatorRequestHandler(BaseHTTPRequestHandler):
+
+    def _send(self, response):
+        body = response['body']
+        self.send_response(int(response['statusCode']))
+        for name, value in response['headers'].iteritems():
+            self.send_header(name, value)
+
+        # HTTP sends gzipped bodies as bytes:
+        if response.get('isBase64Encoded', False):
+            body = base64.b64decode(body)
+
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.getheader('Content-Length', 0))
+        try:
+            run_options = json.loads(self.rfile.read(length))
+
+        except ValueError:
+            return self._send(respond(ValueError('The body should be a JSON object')))
+
+        if not isinstance(run_options, dict):
+            return self._send(respond(ValueError('The body should be a JSON object')))
+
+        with self.server.calculation_slots:
+            res = main(run_options, self.server.aws_options, invoker=self.server.invoker)
+
+        self._send(respond_with_result(res))
+
+    def log_message(self, format, *args):
+        logger.info('%s - %s', self.address_string(), format % args)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Medicare Advantage OOP Cost Calculator server")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='number of requests calculated at the same time')
+    parser.add_argument('--profile', default=None, help='AWS profile name')
+    parser.add_argument('--surfaces', action='store_true',
+                        help='preload the response surfaces for estimates')
+    args = parser.parse_args()
+
+    aws_options = {
+        'region_name': 'us-east-1',
+        'profile_name': args.profile,
+    }
+
+    configs = ConfigInfo(CONFIG_FILE_NAME)
+    plans = preload(configs, aws_options, args.surfaces)
+    print('Loaded {} plans.'.format(len(plans)))
+
+    # Fork the workers after loading the plans, so that they inherit them:
+    register_engine(PoolEngine(args.processes, plans))
+
+    server = CalculatorServer((args.host, args.port), aws_options, args.concurrency)
+    print('Serving on {}:{}...'.format(args.host, args.port))
+    server.serve_forever()
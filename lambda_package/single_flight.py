@@ -0,0 +1,220 @@
+"""
+Single-flight deduplication of concurrent batch requests for the same uid.
+
+Before calculating, an invocation claims a short-lived lease keyed by the uid and a fingerprint
+of the request with a conditional write. A duplicate request that finds the lease held either
+waits for the result of the invocation holding it, or returns right away, depending on
+run_options['on_duplicate'] ('wait' or 'return'). The result is kept with the lease for a short
+while, so that retries right after the calculation do not recompute it either. A result that
+cannot be kept (e.g. one over the DynamoDB item size limit) is still returned, and the lease is
+released instead.
+
+A lease expires if the invocation holding it dies, after which the next request claims it again.
+
+DynamoDBLeaseStore keeps the leases in a DynamoDB table with a string hash key 'lease_key'
+(enable TTL on 'expires' to clean up); MemoryLeaseStore is a stand-in for tests.
+"""
+import hashlib
+import json
+import threading
+import time
+import uuid
+
+import boto3
+from botocore.exceptions import ClientError
+
+_DEFAULT_LEASE_SECONDS = 300
+_DEFAULT_RESULT_SECONDS = 60
+_DEFAULT_WAIT_SECONDS = 60
+_POLL_SECONDS = 0.5
+
+# Under the 400KB limit of DynamoDB items, leaving room for the other attributes:
+_MAX_RESULT_BYTES = 350 * 1024
+
+# Run options that do not change the result of a batch request:
+_IGNORED_OPTIONS = ('uid', 'engine', 'on_duplicate', 'on_timeout')
+
+IN_FLIGHT = 'in_flight'
+DONE = 'done'
+
+
+def fingerprint(run_options):
+    options = {key: value for key, value in run_options.iteritems()
+               if key not in _IGNORED_OPTIONS}
+    if 'states' in options:
+        options['states'] = sorted(set(str(state) for state in options['states']))
+    if 'months' in options:
+        options['months'] = sorted(set(str(month).zfill(2) for month in options['months']))
+
+    return hashlib.sha1(json.dumps(options, sort_keys=True)).hexdigest()
+
+
+class MemoryLeaseStore(object):
+    """ Leases in memory, shared by the threads of a process. """
+
+    def __init__(self):
+        self._leases = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key, owner, seconds):
+        with self._lock:
+            lease = self._leases.get(key)
+            if lease is not None and lease['expires'] >= time.time():
+                return False
+
+            self._leases[key] = {'owner': owner, 'status': IN_FLIGHT,
+                                 'expires': time.time() + seconds}
+            return True
+
+    def complete(self, key, owner, result, seconds):
+        with self._lock:
+            if self._leases.get(key, {}).get('owner') == owner:
+                self._leases[key] = {'owner': owner, 'status': DONE, 'result': result,
+                                     'expires': time.time() + seconds}
+
+    def release(self, key, owner):
+        with self._lock:
+            if self._leases.get(key, {}).get('owner') == owner:
+                del self._leases[key]
+
+    def get(self, key):
+        with self._lock:
+            lease = self._leases.get(key)
+            return dict(lease) if lease is not None and lease['expires'] >= time.time() else None
+
+
+class DynamoDBLeaseStore(object):
+    """ Leases in a DynamoDB table, claimed with conditional writes. """
+
+    def __init__(self, table_name, aws_options):
+        session = boto3.Session(**aws_options)
+        self._table = session.resource('dynamodb').Table(table_name)
+
+    def acquire(self, key, owner, seconds):
+        now = time.time()
+        try:
+            self._table.put_item(
+                Item={'lease_key': key, 'owner': owner, 'status': IN_FLIGHT,
+                      'expires': int(now + seconds)},
+                ConditionExpression='attribute_not_exists(lease_key) OR expires < :now',
+                ExpressionAttributeValues={':now': int(now)},
+            )
+            return True
+
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise
+
+    def complete(self, key, owner, result, seconds):
+        encoded = json.dumps(result)
+        if len(encoded) > _MAX_RESULT_BYTES:
+            raise ValueError('The result of {} is too large to keep: {} bytes'.format(
+                key, len(encoded)))
+
+        try:
+            self._table.update_item(
+                Key={'lease_key': key},
+                UpdateExpression='SET #status = :done, #result = :result, expires = :expires',
+                ConditionExpression='#owner = :owner',
+                ExpressionAttributeNames={'#status': 'status', '#result': 'result',
+                                          '#owner': 'owner'},
+                ExpressionAttributeValues={':done': DONE, ':result': encoded,
+                                           ':expires': int(time.time() + seconds),
+                                           ':owner': owner},
+            )
+
+        except ClientError as e:
+            # Another invocation took over an expired lease:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+
+    def release(self, key, owner):
+        try:
+            self._table.delete_item(
+                Key={'lease_key': key},
+                ConditionExpression='#owner = :owner',
+                ExpressionAttributeNames={'#owner': 'owner'},
+                ExpressionAttributeValues={':owner': owner},
+            )
+
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+
+    def get(self, key):
+        item = self._table.get_item(Key={'lease_key': key}, ConsistentRead=True).get('Item')
+        if item is None or item['expires'] < time.time():
+            return None
+
+        lease = {'owner': item['owner'], 'status': item['status'], 'expires': item['expires']}
+        if 'result' in item:
+            lease['result'] = json.loads(item['result'])
+
+        return lease
+
+
+class SingleFlight(object):
+
+    def __init__(self, store, lease_seconds=_DEFAULT_LEASE_SECONDS,
+                 result_seconds=_DEFAULT_RESULT_SECONDS, wait_seconds=_DEFAULT_WAIT_SECONDS,
+                 poll_seconds=_POLL_SECONDS):
+        self._store = store
+        self._lease_seconds = lease_seconds
+        self._result_seconds = result_seconds
+        self._wait_seconds = wait_seconds
+        self._poll_seconds = poll_seconds
+
+    def run(self, uid, run_options, calculate, logger):
+        """ Calls calculate() unless the same request for the uid is in flight or just done.
+
+        :param calculate: function that returns the result of main() for the request.
+        :return: the result of main(), of this or of the duplicate request.
+        """
+        key = '{}:{}'.format(uid, fingerprint(run_options))
+        owner = uuid.uuid4().hex
+        wait = run_options.get('on_duplicate', 'wait') == 'wait'
+
+        deadline = time.time() + self._wait_seconds
+        while True:
+            if self._store.acquire(key, owner, self._lease_seconds):
+                return self._calculate(key, owner, calculate, logger)
+
+            lease = self._store.get(key)
+            if lease is not None and lease['status'] == DONE:
+                logger.info('Returning the result of a duplicate request for {}.'.format(uid))
+                return lease['result']
+
+            # A missing lease was released or expired, and can be claimed right away:
+            if lease is not None and (not wait or time.time() >= deadline):
+                logger.info('The same request for {} is in flight.'.format(uid))
+                return {
+                    'statusCode': '200',
+                    'message': json.dumps({'status': IN_FLIGHT}),
+                }
+
+            if lease is not None:
+                time.sleep(self._poll_seconds)
+
+    def _calculate(self, key, owner, calculate, logger):
+        try:
+            result = calculate()
+
+        except Exception:
+            self._store.release(key, owner)
+            raise
+
+        # Failed requests are not kept, so that a retry calculates again:
+        if result['statusCode'] != '200':
+            self._store.release(key, owner)
+            return result
+
+        # The result is calculated either way, and duplicates calculate it again:
+        try:
+            self._store.complete(key, owner, result, self._result_seconds)
+
+        except Exception as e:
+            logger.warning('Not keeping the result of {}: {}'.format(key, e))
+            self._store.release(key, owner)
+
+        return result
@@ -0,0 +1,111 @@
+"""
+Binary snapshot of the plan benefits, packaged with the Lambda function in place of reading the
+benefits from S3.
+
+The snapshot starts with a header that indexes the plans, followed by each plan serialized on
+its own with marshal:
+
+    b'MASNAP1\n'
+    <header length: 4-byte unsigned int, little-endian>
+    <header: marshal of {'pids': {<picwell_id>: (offset, length)}, 'states': {<state>: [<pid>]}}>
+    <plans>
+
+Offsets are relative to the first byte after the header. The file is memory-mapped, and a plan
+is only unmarshaled when it is first looked up, so a request that needs a few states or plans
+does not pay for building all of them.
+"""
+import marshal
+import mmap
+import struct
+
+_MAGIC = b'MASNAP1\n'
+_LENGTH = struct.Struct('<I')
+
+
+def write_snapshot(plans, f):
+    """
+    :param plans: iterable of plans as produced by BenefitsParser.
+    :param f: file object opened for binary writing.
+    """
+    blobs = []
+    pids = {}
+    states = {}
+    offset = 0
+    for plan in plans:
+        blob = marshal.dumps(plan)
+        pid = str(plan['picwell_id'])
+
+        blobs.append(blob)
+        pids[pid] = (offset, len(blob))
+        states.setdefault(str(plan['state_fips']), []).append(pid)
+        offset += len(blob)
+
+    header = marshal.dumps({'pids': pids, 'states': states})
+
+    f.write(_MAGIC)
+    f.write(_LENGTH.pack(len(header)))
+    f.write(header)
+    for blob in blobs:
+        f.write(blob)
+
+
+class BenefitsSnapshot(object):
+    """ Plans in a snapshot file, unmarshaled on demand and kept once unmarshaled.
+
+    It has the interface of benefits_loader.PlanIndex.
+    """
+    __slots__ = ('_file', '_map', '_data_start', '_pids', '_states', '_plans', '_compactor')
+
+    def __init__(self, path, compactor=None):
+        """
+        :param compactor: plan_store.PlanCompactor that compacts each plan when it is unmarshaled,
+            if given.
+        """
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._map[:len(_MAGIC)] != _MAGIC:
+            raise ValueError('{} is not a benefits snapshot'.format(path))
+
+        header_start = len(_MAGIC) + _LENGTH.size
+        header_length, = _LENGTH.unpack(self._map[len(_MAGIC):header_start])
+        header = marshal.loads(self._map[header_start:header_start + header_length])
+
+        self._data_start = header_start + header_length
+        self._pids = header['pids']
+        self._states = header['states']
+        self._plans = {}
+        self._compactor = compactor
+
+    def _get_plan(self, pid):
+        if pid not in self._plans:
+            offset, length = self._pids[pid]
+            start = self._data_start + offset
+            plan = marshal.loads(self._map[start:start + length])
+            if self._compactor is not None:
+                self._compactor.compact([plan])
+
+            self._plans[pid] = plan
+
+        return self._plans[pid]
+
+    @property
+    def plans(self):
+        return [self._get_plan(pid) for state in sorted(self._states)
+                for pid in self._states[state]]
+
+    @property
+    def states(self):
+        return self._states.keys()
+
+    def has_pid(self, pid):
+        return str(pid) in self._pids
+
+    def has_state(self, state):
+        return str(state) in self._states
+
+    def find(self, pids):
+        return [self._get_plan(str(pid)) for pid in pids if str(pid) in self._pids]
+
+    def in_state(self, state):
+        return [self._get_plan(pid) for pid in self._states.get(str(state), [])]
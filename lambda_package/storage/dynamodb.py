@@ -12,6 +12,9 @@ _LOCAL_ENDPOINT_URL = 'http://localhost:8000'
 _BATCH_READ_SIZE = 100  # cannot be larger than 100
 _MAX_READ_RETRIES = 6  # corresponds to total net delay of 1.28 seconds
 
+# Attributes of a cost item that make up the DynamoDB key and the packed OOPs:
+_ITEM_KEY_NAMES = ('month', 'uid', 'state', 'oops')
+
 
 def _hyphenate(month, uid):
     return '{}-{}'.format(month, uid)
@@ -219,6 +222,11 @@ class DynamoDBStorage(BaseStorage):
                     'oops': self._packer(cost_item['oops']),
                 }
 
+                # Any other attributes are stored as given:
+                for name, value in cost_item.iteritems():
+                    if name not in _ITEM_KEY_NAMES:
+                        db_item[name] = value
+
                 batch.put_item(db_item)
 
     def update_items(self, cost_items):
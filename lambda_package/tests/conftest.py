@@ -0,0 +1,9 @@
+import os
+import sys
+
+# The modules of the package import each other as on Lambda, from the package directory, where the
+# shared client modules are copied when packaging (see the Makefile). The tests import them the
+# same way:
+_TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_TESTS_DIR, '..'))
+sys.path.insert(1, os.path.join(_TESTS_DIR, '..', '..', 'lambda_client'))
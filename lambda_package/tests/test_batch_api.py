@@ -0,0 +1,120 @@
+import json
+import logging
+import threading
+from datetime import datetime
+
+import batch_api
+from batch_api import run_batch
+from benefits_loader import PlanIndex
+
+
+def _make_plan(picwell_id, copay):
+    return {
+        'picwell_id': picwell_id,
+        'state_fips': '42',
+        'benefits': {'categories': {'12': {'in_network': {'copay': {'max': copay}}}}},
+        'oop_limits': {'in_network': {'amount': 1500, 'period': 365, 'categories': ['12']}},
+    }
+
+
+def _make_person(uid):
+    return {
+        'uid': uid,
+        'medical_claims': [{'benefit_category': '12', 'cost': 400.0, 'length_of_stay': 1,
+                            'admitted': '2015-03-05', 'discharged': '2015-03-05'}],
+    }
+
+
+_PLAN_INDEXES = {None: PlanIndex([_make_plan('100042', 20), _make_plan('200042', 500)])}
+
+
+class _Invoker(object):
+    def __init__(self):
+        self.requests = []
+
+    def invoke_async(self, run_options):
+        self.requests.append(run_options)
+        return True
+
+
+def _run(persons, run_options, time_left=None, invoker=None, failed=None):
+    # Inline results that are not written, unless the run options say otherwise:
+    options = {'inline': True, 'persist': 'skip', 'engine': 'scalar'}
+    options.update(run_options)
+
+    return run_batch(persons, _PLAN_INDEXES, 2015, options, 'costs', {}, logging.getLogger(),
+                     datetime.now(), time_left=time_left, invoker=invoker, failed=failed)
+
+
+def test_batches_running_out_of_time_continue_with_the_remaining_months():
+    # Plenty of time before the second month, and less than the margin before the third:
+    times = iter([60000, 5000])
+    invoker = _Invoker()
+    res = _run([_make_person('u1'), _make_person('u2')],
+               {'uids': ['u1', 'u2'], 'months': ['01', '02', '03'], 'on_timeout': 'invoke'},
+               time_left=lambda: next(times), invoker=invoker)
+
+    message = json.loads(res['message'])
+    assert message['status'] == 'partial' and message['invoked']
+    assert [item['month'] for item in message['cost_items']] == ['01', '02']
+    assert message['cost_items'][0]['oops'] == {'100042': 20.0, '200042': 400.0}
+
+    continuation_options = message['continuation']
+    assert continuation_options['continuation'] == [['u1', ['03']], ['u2', ['01', '02', '03']]]
+    assert 'uids' not in continuation_options
+    assert invoker.requests == [continuation_options]
+
+    # The continuation calculates the months left, and returns those of the people whose claims
+    # could not be fetched:
+    res = _run([_make_person('u1')], continuation_options,
+               failed={'u2': 'No user data located'})
+
+    message = json.loads(res['message'])
+    assert message['status'] == 'complete'
+    assert [(item['uid'], item['month']) for item in message['cost_items']] == [('u1', '03')]
+    assert message['failed'] == [['u2', ['01', '02', '03'], 'No user data located']]
+    assert res['failed_uids'] == ['u2']
+
+
+def test_cost_items_are_written_as_the_persist_mode_says(monkeypatch):
+    written = []
+    blocked = threading.Event()
+
+    class _CostMap(object):
+        def __init__(self, table_name, aws_options):
+            self._table_name = table_name
+
+        def add_items(self, cost_items):
+            # The background write of u1 waits until it is released:
+            if threading.current_thread().daemon:
+                blocked.wait(5)
+            written.append((self._table_name, [item['uid'] for item in cost_items]))
+
+    monkeypatch.setattr(batch_api, 'DynamoDBCostMap', _CostMap)
+    months = {'months': ['01']}
+
+    res = _run([_make_person('u1')], dict(months, persist='skip'))
+    assert json.loads(res['message'])['status'] == 'complete' and written == []
+
+    res = _run([_make_person('u1')], dict(months, inline=False, persist='skip'))
+    assert res['statusCode'] == '500'
+
+    res = _run([_make_person('u1')], dict(months, inline=False, persist='sync'))
+    message = json.loads(res['message'])
+    assert message['status'] == 'complete' and 'cost_items' not in message
+    assert written == [('costs', ['u1'])]
+
+    # A request does not wait for the background writes of other people, only its own:
+    _run([_make_person('u1')], dict(months, persist='background'))
+    _run([_make_person('u2')], dict(months, persist='sync'))
+    assert written[1:] == [('costs', ['u2'])]
+
+    thread = threading.Thread(target=_run, args=([_make_person('u1')],
+                                                 dict(months, persist='sync')))
+    thread.start()
+    thread.join(0.1)
+    assert thread.is_alive()
+
+    blocked.set()
+    thread.join()
+    assert written[2:] == [('costs', ['u1']), ('costs', ['u1'])]
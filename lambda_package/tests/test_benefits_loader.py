@@ -0,0 +1,153 @@
+import collections
+import copy
+import json
+import os
+
+import benefits_loader
+from calc.calculator import calculate_oop
+
+
+class _Configs(object):
+    use_s3_for_benefits = True
+    benefits_bucket = ''
+    benefits_versions = {}
+    compact_benefits = True
+
+    def __init__(self, benefits_path, benefits_revalidate_seconds):
+        self.benefits_path = benefits_path
+        self.benefits_revalidate_seconds = benefits_revalidate_seconds
+
+
+def test_plan_indexes_look_plans_up_by_pid_and_state():
+    plans = [{'picwell_id': pid, 'state_fips': state}
+             for pid, state in ((100042, 42), (200042, 42), (100015, '15'))]
+    plan_index = benefits_loader.PlanIndex(plans)
+
+    assert sorted(plan_index.states) == ['15', '42']
+    assert plan_index.has_pid('100042') and plan_index.has_pid(100015)
+    assert not plan_index.has_pid('300042') and not plan_index.has_state('06')
+    assert plan_index.find(['200042', '300042', 100042]) == [plans[1], plans[0]]
+    assert plan_index.in_state(42) == plans[:2] and plan_index.in_state('06') == []
+
+    # Keys are unknown only if no index knows them:
+    other_index = benefits_loader.PlanIndex([{'picwell_id': '100006', 'state_fips': '06'}])
+    assert benefits_loader.get_unknown([plan_index, other_index], ['100006', '100042', '9'],
+                                       benefits_loader.PlanIndex.has_pid) == ['9']
+    assert benefits_loader.get_unknown([plan_index], ['06', '15'],
+                                       benefits_loader.PlanIndex.has_state) == ['06']
+
+
+def test_unknown_versions_are_the_ones_not_configured():
+    configs = _Configs('', 0)
+    configs.benefits_versions = {'2018': 'benefits_2018'}
+
+    assert benefits_loader.get_unknown_versions(configs, [None, '2018', '2019']) == ['2019']
+
+
+def _write_state(directory, state, pids):
+    with open(os.path.join(directory, '{}.json'.format(state)), 'w') as f:
+        f.writelines(json.dumps({'picwell_id': pid, 'state_fips': state}) + '\n' for pid in pids)
+
+
+def test_only_the_requested_states_are_loaded_and_revalidated(tmpdir, monkeypatch):
+    monkeypatch.setattr(benefits_loader, '_STATES_CACHE', {})
+    directory = str(tmpdir)
+    _write_state(directory, '42', ['100042', '200042'])
+    _write_state(directory, '15', ['100015'])
+
+    requests = []
+    get_state_if_changed = benefits_loader.LocalBenefitsClient.get_state_if_changed
+
+    def counting_get_state_if_changed(client, state, etag=None):
+        requests.append(state)
+        return get_state_if_changed(client, state, etag)
+
+    monkeypatch.setattr(benefits_loader.LocalBenefitsClient, 'get_state_if_changed',
+                        counting_get_state_if_changed)
+
+    plan_index = benefits_loader.load_plans(_Configs(directory, 3600), {}, states=['42'])
+    assert sorted(plan['picwell_id'] for plan in plan_index.plans) == ['100042', '200042']
+    assert requests == ['42']
+
+    # Cached until due for revalidation:
+    benefits_loader.load_plans(_Configs(directory, 3600), {}, states=['42'])
+    assert requests == ['42']
+
+    # Revalidated, and reloaded only when changed:
+    _write_state(directory, '42', ['100042', '200042', '300042'])
+    plan_index = benefits_loader.load_plans(_Configs(directory, 0), {}, states=['42', '15'])
+    assert requests[0] == '42' and sorted(requests[1:]) == ['15', '42']
+    assert len(plan_index.in_state('42')) == 3 and plan_index.has_pid('100015')
+
+
+def _write_plan(directory, copay):
+    plan = {
+        'picwell_id': '100042',
+        'state_fips': '42',
+        'benefits': {'categories': {'12': {'in_network': {'copay': {'max': copay}}}}},
+        'oop_limits': {'in_network': {'amount': 1500, 'period': 365, 'categories': ['12']}},
+    }
+    with open(os.path.join(directory, '42.json'), 'w') as f:
+        f.write(json.dumps(plan) + '\n')
+
+
+def test_reloaded_plans_are_priced_with_their_new_benefits(tmpdir, monkeypatch):
+    monkeypatch.setattr(benefits_loader, '_STATES_CACHE', {})
+    directory = str(tmpdir)
+    claims = [{'benefit_category': '12', 'cost': 400.0, 'length_of_stay': 1,
+               'admitted': '2015-01-05', 'discharged': '2015-01-05'}]
+
+    _write_plan(directory, 20)
+    plan_index = benefits_loader.load_plans(_Configs(directory, 0), {}, states=['42'])
+    assert calculate_oop(copy.deepcopy(claims), plan_index.find(['100042'])[0])['oop'] == 20.0
+
+    # The same picwell_id and benefits version, with a different copay:
+    _write_plan(directory, 500)
+    plan_index = benefits_loader.load_plans(_Configs(directory, 0), {}, states=['42'])
+    assert calculate_oop(copy.deepcopy(claims), plan_index.find(['100042'])[0])['oop'] == 400.0
+
+
+def test_state_indexes_are_kept_until_the_state_is_reloaded(tmpdir, monkeypatch):
+    monkeypatch.setattr(benefits_loader, '_STATES_CACHE', {})
+    directory = str(tmpdir)
+    _write_state(directory, '42', ['100042'])
+    _write_state(directory, '15', ['100015'])
+
+    plan_index = benefits_loader.load_plans(_Configs(directory, 0), {}, states=['42', '15'])
+    state_index = benefits_loader.load_plans(_Configs(directory, 0), {}, states=['42'])
+    assert state_index.in_state('42') is plan_index.in_state('42')
+    assert state_index.has_pid('100042') and not state_index.has_pid('100015')
+
+    _write_state(directory, '15', ['100015', '200015'])
+    reloaded_index = benefits_loader.load_plans(_Configs(directory, 0), {}, states=['42', '15'])
+    assert reloaded_index.in_state('42') is plan_index.in_state('42')
+    assert len(reloaded_index.in_state('15')) == 2 and reloaded_index.has_pid('200015')
+
+
+def test_plans_read_by_pid_are_cached_up_to_a_limit(monkeypatch):
+    monkeypatch.setattr(benefits_loader, '_STATES_CACHE', {})
+    monkeypatch.setattr(benefits_loader, '_PIDS_CACHE', collections.OrderedDict())
+    monkeypatch.setattr(benefits_loader, '_MAX_CACHED_PIDS', 2)
+    requests = []
+
+    class _Client(object):
+        def get(self, pids):
+            requests.append(pids)
+            return [{'picwell_id': pid, 'state_fips': pid[-2:]} for pid in pids if pid != '9']
+
+    monkeypatch.setattr(benefits_loader, '_get_benefits_client', lambda *args: _Client())
+    configs = _Configs('', 3600)
+
+    plan_index = benefits_loader.load_plans(configs, {}, pids=['100042', '9'])
+    assert [plan['picwell_id'] for plan in plan_index.plans] == ['100042']
+
+    # Unknown pids are not cached:
+    benefits_loader.load_plans(configs, {}, pids=['100042', '9'])
+    assert requests == [['100042', '9'], ['9']]
+
+    # The least recently used plans are evicted:
+    benefits_loader.load_plans(configs, {}, pids=['100015'])
+    benefits_loader.load_plans(configs, {}, pids=['100042'])
+    benefits_loader.load_plans(configs, {}, pids=['100006'])
+    benefits_loader.load_plans(configs, {}, pids=['100042', '100015'])
+    assert requests[2:] == [['100015'], ['100006'], ['100015']]
@@ -0,0 +1,43 @@
+import pytest
+
+import blob_store
+import storage_utils
+
+
+@pytest.mark.parametrize('kind', [blob_store.LOCAL, blob_store.MEMORY])
+def test_blobs_are_read_whole_streamed_and_by_range(kind, tmpdir):
+    store = blob_store.make_blob_store(kind, 'bucket', 'path', {}, str(tmpdir))
+
+    with store.writer('a/1.json') as f:
+        f.write('0123456789')
+    etag = store.put('2.json', 'abcdef')
+
+    assert store.read('a/1.json') == '0123456789'
+    assert store.read_range('2.json', 2, 5, if_match=etag) == 'cde'
+
+    body, open_etag, size = store.open('2.json')
+    assert open_etag == etag and size == 6
+    assert body.read(4) == 'abcd' and body.read() == 'ef'
+    assert store.open('2.json', if_none_match=etag) is None
+
+    with pytest.raises(blob_store.BlobChanged):
+        store.read_range('2.json', 0, 1, if_match='"other"')
+    with pytest.raises(blob_store.BlobNotFound):
+        store.open('3.json')
+
+
+def test_memory_stores_map_files_once_and_serve_the_benefits(tmpdir):
+    directory = tmpdir.join('bucket', 'benefits')
+    directory.ensure(dir=True)
+    directory.join('42.json').write('{"picwell_id": "10042", "state_fips": "42"}\n')
+
+    store = blob_store.make_blob_store(blob_store.MEMORY, 'bucket', 'benefits', {}, str(tmpdir))
+    assert blob_store.make_blob_store(
+        blob_store.MEMORY, 'bucket', 'benefits', {}, str(tmpdir)) is store
+
+    client = storage_utils.BenefitsClient(None, blob_store=store)
+    assert client.get(['10042']) == [{'picwell_id': '10042', 'state_fips': '42'}]
+
+    # Served from memory, whatever happens to the files:
+    directory.join('42.json').remove()
+    assert [plan['picwell_id'] for plan in client.get_states(['42'])] == ['10042']
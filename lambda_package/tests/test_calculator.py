@@ -0,0 +1,96 @@
+import json
+
+import pytest
+
+from calc import calculator
+from calc.cost import get_plan_shape
+
+
+def _make_plan(picwell_id, deductibles=True, oop_limits=True, coinsurance=True):
+    office_visit = {'copay': {'max': 20}}
+    if coinsurance:
+        office_visit['coinsurance'] = {'max': 20}
+
+    plan = {
+        'picwell_id': picwell_id,
+        'state_fips': '42',
+        'benefits': {
+            'combine_inpatient_day_count': False,
+            'categories': {
+                '12': {'in_network': office_visit},
+                '25': {
+                    'in_network': {
+                        'benefit_period': 'stay',
+                        'day_intervals': {
+                            '5': {'copay': {'max': 300, 'per_day': True, 'interval_max': 5}},
+                            '90': {'copay': {'max': 0, 'per_day': True, 'interval_max': 90}},
+                        },
+                    },
+                },
+            },
+        },
+    }
+
+    if deductibles:
+        plan['deductibles'] = {
+            'in_network': {'amount': 250, 'period': 365, 'categories': ['12']},
+        }
+        plan['benefits']['categories']['12']['deductibles'] = 100
+
+    if oop_limits:
+        plan['oop_limits'] = {
+            'in_network': {'amount': 1500, 'period': 365, 'categories': ['12', '25']},
+        }
+
+    return plan
+
+
+_CLAIMS = [
+    {'benefit_category': '12', 'cost': 400.0, 'length_of_stay': 1,
+     'admitted': '2015-01-05', 'discharged': '2015-01-05'},
+    {'benefit_category': '25', 'cost': 12000.0, 'length_of_stay': 7,
+     'admitted': '2015-02-01', 'discharged': '2015-02-08'},
+    {'benefit_category': '12', 'cost': 150.0, 'length_of_stay': 1,
+     'admitted': '2015-03-10', 'discharged': '2015-03-10'},
+]
+
+
+@pytest.mark.parametrize('picwell_id,options', [
+    (1001, {}),
+    (1002, {'deductibles': False}),
+    (1003, {'oop_limits': False}),
+    (1004, {'deductibles': False, 'oop_limits': False, 'coinsurance': False}),
+])
+def test_specialized_calculation_matches_general_calculation(monkeypatch, picwell_id, options):
+    plan = _make_plan(picwell_id, **options)
+    assert get_plan_shape(plan) == (options.get('deductibles', True),
+                                    options.get('oop_limits', True),
+                                    not options.get('coinsurance', True))
+
+    specialized = calculator.calculate_oop(_CLAIMS, plan, force_network='in_network')
+
+    monkeypatch.setattr(calculator, '_get_cost_function', lambda plan: calculator._calculate_costs)
+    general = calculator.calculate_oop(_CLAIMS, plan, force_network='in_network')
+
+    assert json.dumps(specialized, sort_keys=True) == json.dumps(general, sort_keys=True)
+
+
+def test_trend_scenarios_match_separately_inflated_claims():
+    plan = _make_plan(1005)
+    trends = [0.0, 0.05, {'default': 0.03, '25': 0.08}]
+
+    prepared_claims = calculator.prepare_claims(_CLAIMS, force_network='in_network')
+    scenario_costs = calculator.calculate_prepared_oop_scenarios(prepared_claims, plan, trends)
+
+    expected_oops = []
+    for multipliers in ({'12': 1.0, '25': 1.0}, {'12': 1.05, '25': 1.05}, {'12': 1.03, '25': 1.08}):
+        claims = [dict(claim, cost=claim['cost'] * multipliers[claim['benefit_category']])
+                  for claim in _CLAIMS]
+        expected_oops.append(calculator.calculate_oop(claims, plan, force_network='in_network')['oop'])
+
+    assert [costs['oop'] for costs in scenario_costs] == expected_oops
+
+
+def test_trends_must_be_greater_than_minus_one():
+    with pytest.raises(ValueError):
+        calculator.validate_trends([0.03, {'25': -1.0}])
@@ -0,0 +1,76 @@
+import json
+import os
+import socket
+
+import claims_loader
+import storage_utils
+
+
+class _Configs(object):
+    use_s3_for_claims = True
+    blob_store = 'local'
+    claims_bucket = 'bucket'
+    claims_path = 'claims'
+
+    def __init__(self, blob_root, claims_cache_size):
+        self.blob_root = blob_root
+        self.claims_cache_size = claims_cache_size
+
+
+def _write_claims(directory, uid, n_claims):
+    with open(os.path.join(directory, '{}.json'.format(uid)), 'w') as f:
+        f.write(json.dumps({'uid': uid, 'medical_claims': [{'cost': 10.0}] * n_claims}) + '\n')
+
+
+def test_unchanged_claims_are_reused_and_the_least_recently_used_evicted(tmpdir, monkeypatch):
+    monkeypatch.setattr(claims_loader, '_CACHES', {})
+    directory = str(tmpdir.join('bucket', 'claims').ensure(dir=True))
+    for uid in ('u1', 'u2', 'u3'):
+        _write_claims(directory, uid, 1)
+
+    configs = _Configs(str(tmpdir), 2)
+    person = claims_loader.load_person(configs, {}, 'u1')
+    persons, errors = claims_loader.load_persons(configs, {}, ['u1', 'u2', 'missing'])
+    assert persons[0] is person and [p['uid'] for p in persons] == ['u1', 'u2']
+    assert list(errors) == ['missing']
+
+    cache = claims_loader._get_cache(configs)
+    assert (cache.hits, cache.misses) == (1, 2)
+
+    # Changed claims are read again:
+    _write_claims(directory, 'u1', 3)
+    assert len(claims_loader.load_person(configs, {}, 'u1')['medical_claims']) == 3
+
+    # u2 is the least recently used:
+    claims_loader.load_person(configs, {}, 'u3')
+    assert cache.get_version('u2') is None
+    assert cache.get_version('u1') is not None and cache.get_version('u3') is not None
+
+
+def test_transient_errors_are_retried_before_a_uid_fails(tmpdir, monkeypatch):
+    monkeypatch.setattr(claims_loader, '_CACHES', {})
+    monkeypatch.setattr(storage_utils, '_RETRY_BASE_SECONDS', 0.001)
+    directory = str(tmpdir.join('bucket', 'claims').ensure(dir=True))
+    _write_claims(directory, 'u1', 1)
+
+    attempts = []
+    load_person = claims_loader._load_person
+
+    def flaky_load_person(cache, client, uid):
+        attempts.append(uid)
+        if attempts == ['u1']:
+            raise socket.error('Connection reset')
+        return load_person(cache, client, uid)
+
+    monkeypatch.setattr(claims_loader, '_load_person', flaky_load_person)
+
+    persons, errors = claims_loader.load_persons(_Configs(str(tmpdir), 2), {}, ['u1'])
+    assert [person['uid'] for person in persons] == ['u1'] and errors == {}
+    assert attempts == ['u1', 'u1']
+
+    # Missing claims are not:
+    open(os.path.join(directory, 'empty.json'), 'w').close()
+    del attempts[:]
+    persons, errors = claims_loader.load_persons(_Configs(str(tmpdir), 2), {}, ['empty'])
+    assert not persons and errors['empty'].startswith('No user data located')
+    assert attempts == ['empty']
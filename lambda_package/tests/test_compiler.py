@@ -0,0 +1,95 @@
+import copy
+
+import pytest
+
+from calc.calculator import calculate_oop
+from calc.compiler import (
+    compile_plan,
+    compile_plans,
+)
+
+
+def _make_plan(picwell_id):
+    return {
+        'picwell_id': picwell_id,
+        'state_fips': '42',
+        'benefits': {
+            'combine_inpatient_day_count': False,
+            'categories': {
+                '12': {'deductibles': '100', 'in_network': {'copay': {'max': '20'},
+                                                           'coinsurance': {'max': 20}}},
+                # Replaced by category 20 (see patch_categories()):
+                '21': {'deductibles': 500, 'in_network': {'coinsurance': {'max': 50}}},
+                '25': {
+                    'in_network': {
+                        'benefit_period': 'stay',
+                        'day_intervals': {
+                            '5': {'copay': {'max': 300, 'per_day': True, 'interval_max': '5'}},
+                            '90': {'copay': {'max': 0, 'per_day': True, 'interval_max': 90}},
+                        },
+                    },
+                },
+            },
+        },
+        'deductibles': {
+            'in_network': {'amount': '250', 'period': 365, 'categories': ['12', '21']},
+        },
+        'oop_limits': {
+            'in_network': {'amount': 1500, 'period': 365, 'categories': ['12', '25']},
+        },
+    }
+
+
+_CLAIMS = [
+    {'benefit_category': '12', 'cost': 400.0, 'length_of_stay': 1,
+     'admitted': '2015-01-05', 'discharged': '2015-01-05'},
+    {'benefit_category': '21', 'cost': 300.0, 'length_of_stay': 1,
+     'admitted': '2015-01-20', 'discharged': '2015-01-20'},
+    {'benefit_category': '25', 'cost': 12000.0, 'length_of_stay': 7,
+     'admitted': '2015-02-01', 'discharged': '2015-02-08'},
+]
+
+
+def test_compiled_plans_are_parsed_and_cost_the_same():
+    plan = _make_plan(3001)
+    compiled_plan = compile_plan(plan)
+
+    assert '21' not in compiled_plan['benefits']['categories']
+    assert compiled_plan['deductibles']['in_network'] == {
+        'amount': 250.0, 'period': 365, 'categories': ['12']}
+    assert compiled_plan['benefits']['categories']['12']['in_network']['copay']['max'] == 20.0
+    assert plan['deductibles']['in_network']['amount'] == '250'
+
+    # Cached benefit lookups are keyed by picwell_id and benefits version:
+    compiled_plan['benefits_version'] = 'compiled'
+    assert (calculate_oop(copy.deepcopy(_CLAIMS), compiled_plan) ==
+            calculate_oop(copy.deepcopy(_CLAIMS), plan))
+
+
+def test_plans_with_the_same_cost_sharing_share_an_equivalence_class():
+    plans = [_make_plan(3002), _make_plan(3003), _make_plan(3004)]
+    plans[2]['oop_limits']['in_network']['amount'] = 2000
+
+    compiled_plans, errors = compile_plans(plans)
+    assert not errors
+    assert compiled_plans[0]['equivalence_class'] == compiled_plans[1]['equivalence_class']
+    assert compiled_plans[0]['equivalence_class'] != compiled_plans[2]['equivalence_class']
+
+
+@pytest.mark.parametrize('path,value,message', [
+    (['oop_limits', 'in_network', 'period'], 30, 'oop_limits.in_network is not by year'),
+    (['benefits', 'categories', '12', 'in_network', 'copay', 'max'], 'n/a',
+     'benefits.categories.12.in_network.copay.max is not a number'),
+    (['benefits', 'categories', '25', 'in_network', 'day_intervals', '90', 'coinsurance'],
+     {'max': 10, 'interval_max': 60}, 'ends on different days'),
+])
+def test_invalid_plans_are_reported(path, value, message):
+    plan = _make_plan(3005)
+    container = plan
+    for key in path[:-1]:
+        container = container[key]
+    container[path[-1]] = value
+
+    compiled_plans, errors = compile_plans([plan, _make_plan(3006)])
+    assert [compiled_plan['picwell_id'] for compiled_plan in compiled_plans] == [3006]
+    assert len(errors) == 1 and errors[0].startswith('Plan 3005') and message in errors[0]
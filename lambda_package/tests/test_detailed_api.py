@@ -0,0 +1,74 @@
+import base64
+import gzip
+import json
+import logging
+from datetime import datetime
+from StringIO import StringIO
+
+from benefits_loader import PlanIndex
+from blob_store import LocalBlobStore
+from detailed_api import run_detailed
+from utils import respond_with_result
+
+
+def _make_plan(picwell_id, copay):
+    return {
+        'picwell_id': picwell_id,
+        'state_fips': '42',
+        'benefits': {'categories': {'12': {'in_network': {'copay': {'max': copay}}}}},
+        'oop_limits': {'in_network': {'amount': 1500, 'period': 365, 'categories': ['12']}},
+    }
+
+
+_PERSON = {
+    'uid': 'u1',
+    'medical_claims': [{'benefit_category': '12', 'cost': 400.0, 'length_of_stay': 1,
+                        'admitted': '2015-01-05', 'discharged': '2015-01-05'}],
+}
+
+_PLAN_INDEXES = {None: PlanIndex([_make_plan('100042', 20), _make_plan('200042', 500)])}
+
+
+def _run(run_options, blob_store=None, offload_bytes=None):
+    return run_detailed(_PERSON, _PLAN_INDEXES, 2015, dict(run_options, engine='scalar'),
+                        logging.getLogger(), datetime.now(), blob_store, offload_bytes)
+
+
+def test_responses_over_the_limit_are_offloaded(tmpdir):
+    blob_store = LocalBlobStore(str(tmpdir))
+
+    res = _run({}, blob_store, offload_bytes=100000)
+    costs = json.loads(res['message'])
+    assert [(cost['picwell_id'], cost['oop']) for cost in costs] == [('100042', 20.0),
+                                                                     ('200042', 400.0)]
+
+    # The limit applies to the whole response that Lambda encodes, which is larger than its
+    # body:
+    response_bytes = len(json.dumps(respond_with_result(res)))
+    assert len(json.dumps(res['message'])) < response_bytes
+
+    res = _run({}, blob_store, offload_bytes=response_bytes)
+    assert json.loads(res['message']) == costs
+
+    res = _run({}, blob_store, offload_bytes=response_bytes - 1)
+    pointer = json.loads(res['message'])
+    assert pointer['status'] == 'offloaded' and pointer['count'] == 2
+
+    with gzip.open(pointer['location'][len('file://'):]) as f:
+        assert [json.loads(line) for line in f] == costs
+
+
+def test_columnar_and_gzipped_responses_are_encoded_once():
+    res = _run({'format': 'columnar', 'fields': ['oop']})
+    assert res['encoded'] and not res['gzipped']
+    assert json.loads(res['message']) == {'uid': 'u1', 'picwell_ids': ['100042', '200042'],
+                                          'fields': {'oop': [20.0, 400.0]}}
+
+    res = _run({'format': 'columnar', 'fields': ['oop'], 'compress': 'true'})
+    assert res['encoded'] and res['gzipped']
+    with gzip.GzipFile(fileobj=StringIO(base64.b64decode(res['message']))) as f:
+        assert json.loads(f.read())['fields'] == {'oop': [20.0, 400.0]}
+
+    # Query strings give flags as strings:
+    assert _run({'compress': 'false'}) == _run({})
+    assert _run({'compress': 'maybe'})['statusCode'] == '500'
@@ -0,0 +1,115 @@
+import copy
+import logging
+
+import pytest
+
+from calc.compiler import compile_plans
+from engine import (
+    PROCESS,
+    SCALAR,
+    CostModel,
+    PoolEngine,
+    ProcessEngine,
+    ScalarEngine,
+    WorkloadShape,
+    select_engine,
+)
+
+
+def _make_plan(copay, picwell_id='100042'):
+    return {
+        'picwell_id': picwell_id,
+        'state_fips': '42',
+        'benefits': {'categories': {'12': {'in_network': {'copay': {'max': copay}}}}},
+        'oop_limits': {'in_network': {'amount': 1500, 'period': 365, 'categories': ['12']}},
+    }
+
+
+_CLAIMS = [
+    {'benefit_category': '12', 'cost': 400.0, 'length_of_stay': 1,
+     'admitted': '2015-01-05', 'discharged': '2015-01-05'},
+]
+
+
+def test_the_pool_prices_reloaded_plans_with_their_new_benefits():
+    plan = _make_plan(20)
+    engine = PoolEngine(2, [plan])
+    try:
+        assert engine.calculate(copy.deepcopy(_CLAIMS), [plan], oop_only=True) == [20.0]
+
+        # The same picwell_id and benefits version, reloaded with a different copay:
+        assert engine.calculate(copy.deepcopy(_CLAIMS), [_make_plan(500)],
+                                oop_only=True) == [400.0]
+
+    finally:
+        engine.close()
+
+
+def _timing_record(engine_name, work, seconds, n_months=1):
+    return {
+        'engine': engine_name,
+        'shape': WorkloadShape(n_claims=work / n_months, part_a_share=0.0, n_plans=1,
+                               tier_depth=0.0, n_months=n_months).to_dict(),
+        'seconds': seconds,
+    }
+
+
+def test_the_cost_model_is_fitted_per_engine(tmpdir):
+    records = [_timing_record(SCALAR, work, 0.01 + 2e-5 * work) for work in (100, 1000, 10000)]
+    # The setup is paid for each month:
+    records.append(_timing_record(SCALAR, 12000, 12 * 0.01 + 2e-5 * 12000, n_months=12))
+    # A single amount of work does not tell the setup from the cost per unit:
+    records.append(_timing_record(PROCESS, 1000, 1.0))
+
+    cost_model = CostModel.fit(records)
+    coefficients = cost_model.coefficients
+    assert coefficients[SCALAR] == (pytest.approx(0.01), pytest.approx(2e-5))
+    assert coefficients[PROCESS] == CostModel().coefficients[PROCESS]
+
+    # The fitted coefficients are packaged in a file, over the default ones:
+    file_name = str(tmpdir.join('cost_model.json'))
+    assert CostModel.load(file_name).coefficients == CostModel().coefficients
+
+    CostModel({SCALAR: coefficients[SCALAR]}).save(file_name)
+    assert CostModel.load(file_name).coefficients == dict(CostModel().coefficients,
+                                                          **{SCALAR: coefficients[SCALAR]})
+
+
+def test_engines_are_selected_at_the_crossover_of_their_predictions():
+    # The default setup of the process engine pays off from 0.03 / (1.3e-5 - 0.7e-5) = 5000 units
+    # of work; here 50 claims a month against each plan:
+    claims = _CLAIMS * 50
+    logger = logging.getLogger()
+
+    engine, shape = select_engine(claims, [_make_plan(20)] * 99, 1, {}, logger)
+    assert shape.work == 4950 and engine.name == SCALAR
+
+    engine, shape = select_engine(claims, [_make_plan(20)] * 101, 1, {}, logger)
+    assert shape.work == 5050 and engine.name == PROCESS
+
+    # The request can still ask for an engine:
+    engine, _ = select_engine(claims, [_make_plan(20)] * 101, 1, {'engine': SCALAR}, logger)
+    assert engine.name == SCALAR
+
+
+@pytest.mark.parametrize('engine', [ScalarEngine(), ProcessEngine(2)])
+@pytest.mark.parametrize('trends', [None, [0.0, 0.1]])
+def test_equivalent_plans_share_copies_of_one_calculation(engine, trends):
+    plans, errors = compile_plans([_make_plan(copay, picwell_id) for copay, picwell_id in
+                                   ((20, '100042'), (20, '200042'), (500, '300042'),
+                                    (20, '400042'))])
+    assert not errors
+
+    results = engine.calculate(copy.deepcopy(_CLAIMS), plans, trends=trends)
+
+    # The same as calculating each plan on its own:
+    for plan, result in zip(plans, results):
+        own_plan = {key: value for key, value in plan.iteritems() if key != 'equivalence_class'}
+        assert result == ScalarEngine().calculate(copy.deepcopy(_CLAIMS), [own_plan],
+                                                  trends=trends)[0]
+
+    # The plans of a class can each change their results:
+    assert results[0] == results[1] and results[0] is not results[1]
+    costs = results[0] if trends is None else results[0][0]
+    costs['oop'] = None
+    assert results[1] != results[0] and results[3] != results[0]
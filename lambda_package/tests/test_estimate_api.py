@@ -0,0 +1,48 @@
+import json
+import logging
+from datetime import datetime
+
+from calc.surface import build_response_surface
+from estimate_api import run_estimate
+
+
+def _make_plan(picwell_id, coinsurance):
+    return {
+        'picwell_id': picwell_id,
+        'state_fips': '42',
+        'benefits': {'categories': {'12': {'in_network': {'coinsurance': {'max': coinsurance}}}}},
+        'oop_limits': {'in_network': {'amount': 1500, 'period': 365, 'categories': ['12']}},
+    }
+
+
+_SURFACES = [build_response_surface(_make_plan(picwell_id, coinsurance), 2015)
+             for picwell_id, coinsurance in (('100042', 50), ('200042', 10), ('300042', 30))]
+
+
+class _Invoker(object):
+    def __init__(self):
+        self.requests = []
+
+    def invoke_async(self, run_options):
+        self.requests.append(run_options)
+        return True
+
+
+def _run(run_options, invoker):
+    return json.loads(run_estimate({'uid': 'u1'}, _SURFACES, 2015, run_options, invoker,
+                                   logging.getLogger(), datetime.now())['message'])
+
+
+def test_plans_are_ranked_by_estimate_and_the_exact_batch_is_started():
+    invoker = _Invoker()
+    result = _run({'uid': 'u1', 'states': ['42'], 'spend': {'12': [1000.0, 1]}, 'top': 2},
+                  invoker)
+
+    assert [(plan['picwell_id'], plan['oop']) for plan in result['plans']] == [
+        ('200042', 100.0), ('300042', 300.0)]
+    assert result['batch_started']
+    assert invoker.requests == [{'uid': 'u1', 'states': ['42'], 'service': 'batch'}]
+
+    result = _run({'uid': 'u1', 'spend': {'12': 1000.0}, 'start_batch': 'false'}, invoker)
+    assert len(result['plans']) == 3 and not result['batch_started']
+    assert len(invoker.requests) == 1
@@ -1,5 +1,5 @@
 import pytest
-from lambda_package.ma_calculator_wrapper import main
+from ma_calculator_wrapper import main
 
 def test_single_calculation():
     run_options = {
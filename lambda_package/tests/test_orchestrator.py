@@ -0,0 +1,91 @@
+import json
+import logging
+from datetime import datetime
+
+from invoker import LocalInvoker
+from orchestrator import (
+    partition_work,
+    run_orchestrated,
+)
+
+
+class _PlanIndex(object):
+    def __init__(self, plans_by_state):
+        self._plans_by_state = plans_by_state
+
+    @property
+    def states(self):
+        return self._plans_by_state.keys()
+
+    def in_state(self, state):
+        return self._plans_by_state.get(state, [])
+
+
+def _plans(n_plans):
+    return [{'picwell_id': index, 'benefits': {'categories': {}}} for index in xrange(n_plans)]
+
+
+_MONTHS = [str(month).zfill(2) for month in xrange(1, 13)]
+
+
+def test_partition_covers_every_state_and_month_once():
+    state_costs = {'06': 400.0, '42': 100.0, '15': 5.0, '11': 3.0, '10': 2.0}
+
+    units = partition_work(state_costs, _MONTHS, max_units=10)
+
+    pairs = [(state, month) for states, months in units for state in states for month in months]
+    assert sorted(pairs) == sorted((state, month) for state in state_costs for month in _MONTHS)
+
+    # The largest state is split by months, and the small ones are packed together:
+    assert len([states for states, _ in units if '06' in states]) > 1
+    assert any(set(states) >= {'15', '11', '10'} for states, _ in units)
+
+
+def test_orchestrator_aggregates_unit_statuses():
+    plan_indexes = {None: _PlanIndex({'42': _plans(20), '15': _plans(2)})}
+    requests = []
+
+    def handler(event, context):
+        run_options = event['queryStringParameters']
+        requests.append(run_options)
+        if '15' in run_options['states'] and 'fail' in run_options:
+            return {'statusCode': '400', 'body': 'failed'}
+
+        message = {'status': 'complete', 'uids': 1, 'elapsed': 0.1}
+        if '15' in run_options['states'] and 'missing' in run_options:
+            message['failed'] = [['1', run_options['months'], 'No user data located']]
+
+        return {'statusCode': '200', 'body': json.dumps(json.dumps(message))}
+
+    run_options = {'service': 'orchestrate', 'uid': '1', 'max_units': 4}
+    result = run_orchestrated(plan_indexes, run_options, LocalInvoker(handler),
+                              logging.getLogger(), datetime.now())
+
+    assert result['statusCode'] == '200'
+    assert json.loads(result['message'])['status'] == 'complete'
+    assert all(request['service'] == 'batch' and request['uid'] == '1' and
+               'max_units' not in request for request in requests)
+
+    result = run_orchestrated(plan_indexes, dict(run_options, fail=True), LocalInvoker(handler),
+                              logging.getLogger(), datetime.now())
+
+    assert json.loads(result['message'])['status'] == 'failed'
+
+    # A unit that could not calculate someone is not complete:
+    result = run_orchestrated(plan_indexes, dict(run_options, missing=True),
+                              LocalInvoker(handler), logging.getLogger(), datetime.now())
+
+    message = json.loads(result['message'])
+    assert message['status'] == 'failed'
+    failed_units = [unit for unit in message['units'] if unit['status'] == 'failed']
+    assert failed_units and all(unit['details']['failed'][0][2] == 'No user data located'
+                                for unit in failed_units)
+
+
+def test_invalid_max_units_are_rejected():
+    plan_indexes = {None: _PlanIndex({'42': _plans(2)})}
+
+    for max_units in (0, -1, 'many'):
+        result = run_orchestrated(plan_indexes, {'uid': '1', 'max_units': max_units},
+                                  LocalInvoker(None), logging.getLogger(), datetime.now())
+        assert result['statusCode'] == '500' and '"max_units"' in result['message']
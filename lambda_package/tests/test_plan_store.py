@@ -0,0 +1,45 @@
+import copy
+import json
+
+from plan_store import PlanCompactor
+
+
+def _make_plan(picwell_id, version):
+    return json.loads(json.dumps({
+        'picwell_id': picwell_id,
+        'benefits_version': version,
+        'benefits': {
+            'categories': {
+                '12': {'in_network': {'copay': {'max': 20.0, 'per_day': False}}},
+                '13': {'in_network': {'copay': {'max': 20.0, 'per_day': False}}},
+                '14': {'in_network': {'copay': {'max': 1, 'per_day': True}}},
+                '15': {'in_network': {'copay': {'max': 1.0, 'per_day': 1}}},
+                '16': {'in_network': {'copay': {'max': -0.0, 'per_day': False}}},
+            },
+        },
+        'oop_limits': {'in_network': {'amount': 3400.0, 'categories': ['12', '13']}},
+    }))
+
+
+def test_plans_share_equal_subtrees_and_stay_equal():
+    plans = [_make_plan(1001, None), _make_plan(1002, None), _make_plan(1001, '2018')]
+    originals = copy.deepcopy(plans)
+
+    compactor = PlanCompactor()
+    bytes_saved = compactor.compact(plans[:2]) + compactor.compact(plans[2:])
+
+    assert plans == originals
+    assert bytes_saved > 0 and compactor.bytes_saved == bytes_saved
+
+    categories = [plan['benefits']['categories'] for plan in plans]
+    assert categories[0] is categories[1] is categories[2]
+    assert categories[0]['12'] is categories[0]['13']
+    assert plans[0]['oop_limits'] is plans[2]['oop_limits']
+
+    # Equal but different values are not merged:
+    assert type(categories[0]['14']['in_network']['copay']['max']) is int
+    assert type(categories[0]['15']['in_network']['copay']['per_day']) is int
+    assert str(categories[0]['16']['in_network']['copay']['max']) == '-0.0'
+
+    # The top level of each plan stays its own:
+    assert plans[0] is not plans[2] and plans[2]['benefits_version'] == '2018'
@@ -0,0 +1,36 @@
+import json
+import threading
+import urllib2
+
+import server
+
+
+def test_requests_are_calculated_with_the_engine_they_ask_for(monkeypatch):
+    calculated = []
+    invokers = []
+
+    def main(run_options, aws_options, invoker=None):
+        calculated.append(run_options)
+        invokers.append(invoker)
+        return {'statusCode': '200', 'message': 'batch calculation complete'}
+
+    monkeypatch.setattr(server, 'main', main)
+    calculator_server = server.CalculatorServer(('localhost', 0), {}, 1)
+    thread = threading.Thread(target=calculator_server.serve_forever)
+    thread.start()
+    try:
+        url = 'http://localhost:{}'.format(calculator_server.server_address[1])
+        for run_options in ({'uid': '1'}, {'uid': '1', 'engine': 'scalar'}):
+            response = urllib2.urlopen(url, json.dumps(run_options))
+            assert json.loads(response.read()) == 'batch calculation complete'
+
+    finally:
+        calculator_server.shutdown()
+        calculator_server.server_close()
+        thread.join()
+
+    # The cost model chooses the engine unless a request asks for one:
+    assert calculated == [{'uid': '1'}, {'uid': '1', 'engine': 'scalar'}]
+
+    # The work that requests start is calculated by the server too:
+    assert invokers == [calculator_server.invoker] * 2
@@ -0,0 +1,68 @@
+import logging
+import threading
+import time
+
+from single_flight import (
+    fingerprint,
+    MemoryLeaseStore,
+    SingleFlight,
+)
+
+
+def test_fingerprint_ignores_order_and_uid():
+    assert (fingerprint({'uid': '1', 'states': ['42', '15'], 'months': [1]}) ==
+            fingerprint({'uid': '2', 'states': ['15', '42'], 'months': ['01'], 'engine': 'scalar'}))
+    assert fingerprint({'months': ['01']}) != fingerprint({'months': ['02']})
+
+
+def test_concurrent_duplicates_share_one_calculation():
+    single_flight = SingleFlight(MemoryLeaseStore(), poll_seconds=0.01)
+    calls = []
+
+    def calculate():
+        calls.append(1)
+        time.sleep(0.1)
+        return {'statusCode': '200', 'message': 'batch calculation complete'}
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+        single_flight.run('1', {'months': ['01']}, calculate, logging.getLogger())))
+        for _ in xrange(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1
+    assert results == [{'statusCode': '200', 'message': 'batch calculation complete'}] * 4
+
+    # A duplicate can also return right away while the request is in flight:
+    store = MemoryLeaseStore()
+    store.acquire('1:' + fingerprint({}), 'other', 60)
+    result = SingleFlight(store).run('1', {'on_duplicate': 'return'}, calculate,
+                                     logging.getLogger())
+    assert '"in_flight"' in result['message']
+    assert len(calls) == 1
+
+
+def test_failed_calculations_are_retried():
+    single_flight = SingleFlight(MemoryLeaseStore())
+    logger = logging.getLogger()
+    results = iter([{'statusCode': '500', 'message': 'error'},
+                    {'statusCode': '200', 'message': 'done'}])
+
+    assert single_flight.run('1', {}, lambda: next(results), logger)['message'] == 'error'
+    assert single_flight.run('1', {}, lambda: next(results), logger)['message'] == 'done'
+
+
+def test_results_that_cannot_be_kept_are_still_returned():
+    class _FullLeaseStore(MemoryLeaseStore):
+        def complete(self, key, owner, result, seconds):
+            raise ValueError('too large')
+
+    store = _FullLeaseStore()
+    result = SingleFlight(store).run('1', {}, lambda: {'statusCode': '200', 'message': 'done'},
+                                     logging.getLogger())
+
+    assert result['message'] == 'done'
+    assert store.get('1:' + fingerprint({})) is None
@@ -0,0 +1,24 @@
+from snapshot import (
+    BenefitsSnapshot,
+    write_snapshot,
+)
+
+
+def test_snapshot_materializes_the_requested_plans(tmpdir):
+    plans = [
+        {'picwell_id': 1, 'state_fips': '42', 'benefits': {'categories': {'12': {'copay': 20.0}}}},
+        {'picwell_id': 2, 'state_fips': '15', 'benefits': {'categories': {}}, 'name': u'Plan \xe9'},
+        {'picwell_id': 3, 'state_fips': '42', 'benefits': {'categories': {}}},
+    ]
+
+    path = str(tmpdir.join('benefits.snap'))
+    with open(path, 'wb') as f:
+        write_snapshot(plans, f)
+
+    snapshot = BenefitsSnapshot(path)
+
+    assert sorted(snapshot.states) == ['15', '42']
+    assert snapshot.in_state('42') == [plans[0], plans[2]]
+    assert snapshot.find(['2', 4]) == [plans[1]]
+    assert snapshot.has_pid(3) and not snapshot.has_state('06')
+    assert sorted(snapshot.plans) == sorted(plans)
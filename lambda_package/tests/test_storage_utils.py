@@ -0,0 +1,131 @@
+import io
+import json
+import os
+import threading
+import time
+
+import pytest
+from botocore.exceptions import (
+    ClientError,
+    NoCredentialsError,
+)
+
+from blob_store import LocalBlobStore
+import storage_utils
+
+
+def _client_error(code, status_code):
+    return ClientError({'Error': {'Code': code},
+                        'ResponseMetadata': {'HTTPStatusCode': status_code}}, 'GetObject')
+
+
+def test_fetch_all_is_bounded_ordered_and_retries_transient_errors(monkeypatch):
+    monkeypatch.setattr(storage_utils, '_RETRY_BASE_SECONDS', 0.001)
+
+    lock = threading.Lock()
+    running = [0]
+    max_running = [0]
+    attempts = {}
+
+    def fetch(key):
+        with lock:
+            running[0] += 1
+            max_running[0] = max(max_running[0], running[0])
+            attempts[key] = attempts.get(key, 0) + 1
+
+        # Later keys finish first:
+        time.sleep(0.001 * (20 - key))
+        with lock:
+            running[0] -= 1
+
+        if key % 5 == 0 and attempts[key] == 1:
+            raise _client_error('SlowDown', 503)
+        return key * 10
+
+    results, latencies = storage_utils.fetch_all(fetch, range(20), max_workers=4)
+
+    assert results == [key * 10 for key in range(20)]
+    assert sorted(latencies) == range(20)
+    assert max_running[0] <= 4
+    assert attempts[5] == 2 and attempts[6] == 1
+
+
+@pytest.mark.parametrize('error', [_client_error('AccessDenied', 403), NoCredentialsError(),
+                                   storage_utils.ClaimsNotFound('No user data located')])
+def test_fetch_all_does_not_retry_errors_that_are_not_transient(error):
+    attempts = []
+
+    def fetch(key):
+        attempts.append(key)
+        raise error
+
+    with pytest.raises(type(error)):
+        storage_utils.fetch_all(fetch, ['42'])
+
+    assert attempts == ['42']
+
+
+def test_fetch_all_does_not_retry_contents_that_cannot_be_parsed():
+    attempts = []
+
+    def fetch(key):
+        attempts.append(key)
+        return json.loads('{"uid": ')
+
+    with pytest.raises(ValueError):
+        storage_utils.fetch_all(fetch, ['u1'])
+
+    assert attempts == ['u1']
+
+
+def test_local_benefits_are_read_by_pid(tmpdir, monkeypatch):
+    # Every plan in its own range:
+    monkeypatch.setattr(storage_utils, '_MAX_RANGE_GAP', -1)
+
+    plans_by_state = {state: [{'picwell_id': '{}{}'.format(n, state), 'state_fips': state,
+                               'name': u'Plan \xe9 {}'.format(n)} for n in xrange(100, 110)]
+                      for state in ('15', '42')}
+    client = storage_utils.LocalBenefitsClient(str(tmpdir))
+    client.put_states(plans_by_state)
+
+    plans = client.get(['10542', '99942', '10015', '10842'])
+    assert plans == [plans_by_state['42'][5], plans_by_state['15'][0], plans_by_state['42'][8]]
+
+    pid_index = {'pids': {'10542': ('42.json', 50, 10), '10842': ('42.json', 80, 10),
+                          '10015': ('15.json', 0, 10)}}
+    assert len(storage_utils._get_plan_ranges(pid_index, ['10542', '10842', '10015'])) == 3
+
+    monkeypatch.setattr(storage_utils, '_MAX_RANGE_GAP', 20)
+    assert storage_utils._get_plan_ranges(pid_index, ['10542', '10842', '10015']) == [
+        ('15.json', 0, 10, (('10015', 0, 10),)),
+        ('42.json', 50, 90, (('10542', 50, 10), ('10842', 80, 10))),
+    ]
+
+
+def test_json_lines_are_decoded_across_chunks_and_read_only_as_needed(monkeypatch):
+    # Multi-byte characters and lines are split across chunks:
+    monkeypatch.setattr(storage_utils, '_READ_CHUNK_BYTES', 3)
+
+    records = [{'uid': n, 'name': u'\xe9\u20ac' * n} for n in xrange(5)]
+    data = '\n'.join(json.dumps(record, ensure_ascii=False).encode('utf-8')
+                      for record in records) + '\n\n'
+
+    assert list(storage_utils._iter_json_lines(io.BytesIO(data))) == records
+    assert list(storage_utils._iter_json_lines(io.BytesIO(data.rstrip()))) == records
+
+    body = io.BytesIO(data)
+    assert list(storage_utils._iter_json_lines(body, limit=2)) == records[:2]
+    assert body.closed
+
+
+def test_only_the_first_claims_record_is_read(tmpdir, monkeypatch):
+    monkeypatch.setattr(storage_utils, '_READ_CHUNK_BYTES', 1024)
+
+    with open(str(tmpdir.join('u1.json')), 'w') as f:
+        f.writelines(json.dumps({'uid': 'u1', 'claims': [{'cost': n}] * 50}) + '\n'
+                     for n in xrange(100))
+
+    client = storage_utils.ClaimsClient(None, blob_store=LocalBlobStore(str(tmpdir)))
+    assert client.get('u1') == {'uid': 'u1', 'claims': [{'cost': 0}] * 50}
+    assert 0 < client.bytes_read <= 2 * 1024 < client.bytes_stored == os.path.getsize(
+        str(tmpdir.join('u1.json')))
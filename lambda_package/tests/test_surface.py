@@ -0,0 +1,56 @@
+import pytest
+
+from calc.calculator import calculate_oop
+from calc.surface import (
+    SPEND_BUCKETS,
+    SURFACE_CATEGORIES,
+    build_response_surface,
+    estimate_oop,
+    summarize_spend,
+)
+
+_PLAN = {
+    'picwell_id': 100042,
+    'state_fips': 42,
+    'benefits': {'categories': {'12': {'in_network': {'coinsurance': {'max': 20}}}}},
+    'deductibles': {'in_network': {'amount': 200, 'period': 365, 'categories': ['12']}},
+    'oop_limits': {'in_network': {'amount': 1500, 'period': 365, 'categories': ['12']}},
+}
+
+
+def _claims(spend, n_claims):
+    return [{'benefit_category': '12', 'cost': spend / n_claims, 'length_of_stay': 1,
+             'admitted': '2015-07-{:02d}'.format(day), 'discharged': '2015-07-{:02d}'.format(day)}
+            for day in xrange(1, n_claims + 1)]
+
+
+def test_surfaces_tabulate_the_oop_of_a_claim_at_each_bucket():
+    surface = build_response_surface(_PLAN, 2015)
+
+    assert (surface['picwell_id'], surface['state_fips']) == ('100042', '42')
+    assert (surface['oop_limit'], surface['deductible'], surface['msa_deposit']) == (1500.0, 200.0,
+                                                                                     0.0)
+    assert sorted(surface['categories']) == sorted(SURFACE_CATEGORIES)
+
+    # The deductible, then 20% coinsurance up to the OOP limit:
+    covered = [value[0] for value in surface['categories']['12']]
+    assert len(covered) == len(SPEND_BUCKETS)
+    assert covered[:5] == [0.0, 50.0, 100.0, 210.0, 260.0] and covered[-1] == 1500.0
+
+
+@pytest.mark.parametrize('spend, n_claims', [
+    (75.0, 1), (500.0, 1), (3000.0, 1), (3000.0, 3), (20000.0, 2), (300000.0, 1),
+])
+def test_estimates_are_within_their_bounds_of_the_exact_oop(spend, n_claims):
+    surface = build_response_surface(_PLAN, 2015)
+    claims = _claims(spend, n_claims)
+    exact = calculate_oop(claims, _PLAN, force_network='in_network',
+                          truncate_claims_at_year_boundary=False)['oop']
+
+    estimate, lower, upper = estimate_oop(surface, summarize_spend(claims))
+    assert lower <= estimate <= upper
+    assert lower <= exact <= upper
+
+    # A single claim is interpolated exactly between buckets on the same linear piece:
+    if n_claims == 1 and spend < 1000.0:
+        assert estimate == pytest.approx(exact)
@@ -0,0 +1,20 @@
+import pytest
+
+from utils import (
+    get_flag,
+    versioned_state,
+)
+
+
+def test_versions_other_than_the_default_qualify_the_state():
+    assert versioned_state('42', None) == '42'
+    assert versioned_state('42', '2018') == '42:2018'
+
+
+def test_flags_are_parsed_from_query_strings():
+    assert get_flag({'inline': 'true'}, 'inline') and get_flag({'inline': True}, 'inline')
+    assert not get_flag({'inline': 'False'}, 'inline') and not get_flag({}, 'inline')
+    assert get_flag({}, 'start_batch', default=True)
+
+    with pytest.raises(ValueError):
+        get_flag({'inline': 'maybe'}, 'inline')
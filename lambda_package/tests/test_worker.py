@@ -0,0 +1,63 @@
+from worker import (
+    MicroBatchWorker,
+    SQLiteQueue,
+)
+
+
+def test_requests_are_calculated_in_micro_batches(tmpdir):
+    queue = SQLiteQueue(str(tmpdir.join('queue.db')))
+    for uid in ('1', '2', '3'):
+        queue.put({'uid': uid, 'states': ['42'], 'months': [1]})
+    queue.put({'uid': '4', 'states': ['42'], 'months': ['01', '01']})
+    queue.put({'uid': '5', 'states': ['15']})
+
+    calculated = []
+
+    def calculate(run_options):
+        calculated.append(run_options)
+        return {'statusCode': '200', 'message': 'batch calculation complete'}
+
+    worker = MicroBatchWorker(queue, calculate, batch_size=4, max_wait=60.0)
+
+    # A full micro-batch is calculated right away, and the others wait to fill:
+    assert worker.poll() == (4, 4)
+    assert calculated == [{'service': 'batch', 'states': ['42'], 'months': [1],
+                           'uids': ['1', '2', '3', '4']}]
+    assert worker.poll() == (1, 0)
+    assert len(queue) == 1
+
+    assert worker.poll(flush_all=True) == (0, 1)
+    assert calculated[1]['uids'] == ['5']
+    assert len(queue) == 0
+
+
+def test_failed_micro_batches_stay_in_the_queue(tmpdir):
+    queue = SQLiteQueue(str(tmpdir.join('queue.db')), visibility_timeout=0)
+    queue.put({'uid': '1'})
+
+    worker = MicroBatchWorker(queue, lambda run_options: {'statusCode': '500', 'message': 'error'},
+                              max_wait=0.0)
+
+    assert worker.poll() == (1, 0)
+    assert len(queue) == 1
+
+
+def test_only_the_requests_of_calculated_uids_are_deleted(tmpdir):
+    queue = SQLiteQueue(str(tmpdir.join('queue.db')), visibility_timeout=0)
+    for uid in ('1', '2', '1', '3'):
+        queue.put({'uid': uid})
+
+    calculated = []
+
+    def calculate(run_options):
+        calculated.append(run_options['uids'])
+        return {'statusCode': '200', 'message': 'batch calculation complete',
+                'failed_uids': ['3']}
+
+    worker = MicroBatchWorker(queue, calculate, batch_size=4, max_wait=60.0)
+
+    # Both requests for uid 1 are calculated once, and the request for uid 3 is received again:
+    assert worker.poll() == (4, 3)
+    assert calculated == [['1', '2', '3']]
+    assert len(queue) == 1
+    assert [run_options['uid'] for _, run_options in queue.receive(10)] == ['3']
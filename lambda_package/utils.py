@@ -1,3 +1,6 @@
+import json
+
+
 def succeed_with_message(message):
     return {
         'statusCode': '200',
@@ -5,6 +8,17 @@ def succeed_with_message(message):
     }
 
 
+def succeed_with_body(body, gzipped=False):
+    # The message is the response body as is: JSON, or gzip-compressed JSON in base64. It is
+    # not encoded again by respond():
+    return {
+        'statusCode': '200',
+        'message': body,
+        'encoded': True,
+        'gzipped': gzipped,
+    }
+
+
 def fail_with_message(message):
     return {
         'statusCode': '500',
@@ -12,6 +26,32 @@ def fail_with_message(message):
     }
 
 
+def respond(err, res=None, encoded=False, gzipped=False):
+    response = {
+        'statusCode': '400' if err else '200',
+        'body': err.message if err else (res if encoded else json.dumps(res)),
+        'headers': {
+            'Content-Type': 'application/json',
+        },
+    }
+
+    # A gzipped body is sent in base64 (see succeed_with_body()):
+    if gzipped and not err:
+        response['headers']['Content-Encoding'] = 'gzip'
+        response['isBase64Encoded'] = True
+
+    return response
+
+
+def respond_with_result(res):
+    """ HTTP response for the result of main(). """
+    if res['statusCode'] != '200':
+        return respond(ValueError(res['message']), res['message'])
+
+    return respond(None, res['message'],
+                   encoded=res.get('encoded', False), gzipped=res.get('gzipped', False))
+
+
 def filter_and_sort_claims(claims, claim_year, start_month):
     start_date = '{}-{}-01'.format(claim_year, start_month)
     end_date = '{}-12-31'.format(claim_year)
@@ -24,3 +64,27 @@ def filter_and_sort_claims(claims, claim_year, start_month):
     # return sorted(filtered_claims, key=lambda claim: claim['admitted'])
 
     return filtered_claims
+
+
+def versioned_state(state, version):
+    # Cost items for a benefits version other than the default are stored under a
+    # version-qualified state key (e.g. '42:2019'):
+    return state if version is None else '{}:{}'.format(state, version)
+
+
+def get_flag(run_options, name, default=False):
+    """ A boolean run option, or the default if not given. Query strings give it as a string,
+    e.g. 'true' or 'false'.
+
+    :raises: ValueError if the option is not a boolean.
+    """
+    value = run_options.get(name, default)
+    if isinstance(value, basestring):
+        if value.lower() in ('true', '1'):
+            return True
+        elif value.lower() in ('false', '0', ''):
+            return False
+
+        raise ValueError('"{}" should be true or false: {}'.format(name, value))
+
+    return bool(value)
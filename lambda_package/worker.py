@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+"""
+Calculates queued batch requests in micro-batches, for bulk recomputes.
+
+Each queued message holds the run options of a batch request for a single uid. Requests with the
+same options apart from the uid (the same states, months, etc.) are grouped into a micro-batch,
+which is calculated as a single multi-uid batch request: the claims are fetched concurrently, the
+plans already in memory are reused, and all cost items go to DynamoDB in shared batch writes.
+
+A micro-batch is calculated once it has --batch-size requests, or once its first request has
+waited --max-wait seconds. Requests for the same uid in a micro-batch are calculated once.
+Messages are deleted from the queue only after their uid is calculated; the messages of a failed
+micro-batch, or of uids whose claims could not be fetched, become visible again after the
+visibility timeout of the queue.
+
+SQSQueue reads an SQS queue; SQLiteQueue is a local stand-in with the same interface.
+"""
+from __future__ import print_function
+
+import json
+import logging
+import sqlite3
+import time
+
+import boto3
+
+logger = logging.getLogger()
+
+_DEFAULT_BATCH_SIZE = 25
+_DEFAULT_MAX_WAIT = 0.3
+_DEFAULT_VISIBILITY_TIMEOUT = 300
+
+
+class SQLiteQueue(object):
+    """ A local queue of run options in a SQLite database. """
+
+    def __init__(self, path, visibility_timeout=_DEFAULT_VISIBILITY_TIMEOUT):
+        self._connection = sqlite3.connect(path, isolation_level=None)
+        self._connection.execute('CREATE TABLE IF NOT EXISTS requests ('
+                                 'id INTEGER PRIMARY KEY, body TEXT, received REAL)')
+        self._visibility_timeout = visibility_timeout
+
+    def put(self, run_options):
+        self._connection.execute('INSERT INTO requests (body) VALUES (?)',
+                                 (json.dumps(run_options),))
+
+    def receive(self, max_messages):
+        """
+        :return: list of (message ID, run options), hidden from other receivers until they are
+            deleted or the visibility timeout passes.
+        """
+        now = time.time()
+
+        self._connection.execute('BEGIN IMMEDIATE')
+        try:
+            rows = self._connection.execute(
+                'SELECT id, body FROM requests WHERE received IS NULL OR received < ? '
+                'ORDER BY id LIMIT ?', (now - self._visibility_timeout, max_messages)).fetchall()
+            self._connection.executemany('UPDATE requests SET received = ? WHERE id = ?',
+                                         [(now, message_id) for message_id, _ in rows])
+            self._connection.execute('COMMIT')
+
+        except Exception:
+            self._connection.execute('ROLLBACK')
+            raise
+
+        return [(message_id, json.loads(body)) for message_id, body in rows]
+
+    def delete(self, message_ids):
+        self._connection.executemany('DELETE FROM requests WHERE id = ?',
+                                     [(message_id,) for message_id in message_ids])
+
+    def __len__(self):
+        return self._connection.execute('SELECT COUNT(*) FROM requests').fetchone()[0]
+
+
+class SQSQueue(object):
+    """ An SQS queue of run options. """
+
+    # SQS limits:
+    _MAX_MESSAGES = 10
+    _WAIT_SECONDS = 1
+
+    def __init__(self, queue_url, aws_options):
+        session = boto3.Session(**aws_options)
+        self._client = session.client('sqs')
+        self._queue_url = queue_url
+
+    def put(self, run_options):
+        self._client.send_message(QueueUrl=self._queue_url, MessageBody=json.dumps(run_options))
+
+    def receive(self, max_messages):
+        response = self._client.receive_message(
+            QueueUrl=self._queue_url,
+            MaxNumberOfMessages=min(max_messages, SQSQueue._MAX_MESSAGES),
+            WaitTimeSeconds=SQSQueue._WAIT_SECONDS,
+        )
+
+        return [(message['ReceiptHandle'], json.loads(message['Body']))
+                for message in response.get('Messages', [])]
+
+    def delete(self, message_ids):
+        message_ids = list(message_ids)
+        for start in xrange(0, len(message_ids), SQSQueue._MAX_MESSAGES):
+            self._client.delete_message_batch(
+                QueueUrl=self._queue_url,
+                Entries=[{'Id': str(index), 'ReceiptHandle': receipt_handle}
+                         for index, receipt_handle
+                         in enumerate(message_ids[start:start + SQSQueue._MAX_MESSAGES])])
+
+
+def _get_batch_key(run_options):
+    # Requests are grouped by everything but the uid:
+    options = {key: value for key, value in run_options.iteritems() if key != 'uid'}
+    if 'states' in options:
+        options['states'] = sorted(set(str(state) for state in options['states']))
+    if 'months' in options:
+        options['months'] = sorted(set(str(month).zfill(2) for month in options['months']))
+
+    return json.dumps(options, sort_keys=True)
+
+
+class _MicroBatch(object):
+    __slots__ = ('run_options', 'started', 'n_messages', 'uids', 'message_ids_by_uid')
+
+    def __init__(self, run_options, started):
+        self.run_options = {key: value for key, value in run_options.iteritems()
+                            if key != 'uid'}
+        self.started = started
+        self.n_messages = 0
+        # Distinct uids in the order received:
+        self.uids = []
+        self.message_ids_by_uid = {}
+
+    def add(self, uid, message_id):
+        if uid not in self.message_ids_by_uid:
+            self.uids.append(uid)
+            self.message_ids_by_uid[uid] = []
+
+        self.message_ids_by_uid[uid].append(message_id)
+        self.n_messages += 1
+
+
+class MicroBatchWorker(object):
+    """
+    :param queue: SQSQueue or SQLiteQueue of the run options of batch requests for single uids.
+    :param calculate: function that calculates the run options of a batch request, e.g.
+        lambda run_options: main(run_options, aws_options).
+    """
+
+    def __init__(self, queue, calculate, batch_size=_DEFAULT_BATCH_SIZE,
+                 max_wait=_DEFAULT_MAX_WAIT):
+        self._queue = queue
+        self._calculate = calculate
+        self._batch_size = batch_size
+        self._max_wait = max_wait
+        self._pending = {}
+
+    def _flush(self, batch):
+        run_options = dict(batch.run_options, service='batch', uids=batch.uids)
+
+        try:
+            res = self._calculate(run_options)
+
+        except Exception as e:
+            res = {'statusCode': '500', 'message': str(e)}
+
+        if res['statusCode'] != '200':
+            # The messages are received again after the visibility timeout:
+            logger.error('Micro-batch of {} uids failed: {}'.format(len(batch.uids),
+                                                                   res['message']))
+            return 0
+
+        # So are the messages of the uids that could not be calculated:
+        failed_uids = set(res.get('failed_uids', []))
+        if failed_uids:
+            logger.error('{} of {} uids of a micro-batch failed: {}'.format(
+                len(failed_uids), len(batch.uids), ', '.join(sorted(failed_uids))))
+
+        message_ids = [message_id for uid in batch.uids if uid not in failed_uids
+                       for message_id in batch.message_ids_by_uid[uid]]
+        self._queue.delete(message_ids)
+        return len(message_ids)
+
+    def poll(self, flush_all=False):
+        """ Receives waiting requests and calculates the micro-batches that are due.
+
+        :return: (number of requests received, number of requests calculated)
+        """
+        messages = self._queue.receive(self._batch_size)
+
+        now = time.time()
+        for message_id, run_options in messages:
+            if run_options.get('service', 'batch') != 'batch' or 'uid' not in run_options:
+                logger.error('Dropping a request that is not a batch request for a uid: '
+                             '{}'.format(run_options))
+                self._queue.delete([message_id])
+                continue
+
+            key = _get_batch_key(run_options)
+            if key not in self._pending:
+                self._pending[key] = _MicroBatch(run_options, now)
+
+            self._pending[key].add(run_options['uid'], message_id)
+
+        due_keys = [key for key, batch in self._pending.iteritems()
+                    if (flush_all or batch.n_messages >= self._batch_size or
+                        now - batch.started >= self._max_wait)]
+
+        n_calculated = sum(self._flush(self._pending.pop(key)) for key in due_keys)
+
+        return len(messages), n_calculated
+
+    def run(self, idle_seconds=0.05):
+        while True:
+            n_received, _ = self.poll()
+            if not n_received:
+                time.sleep(idle_seconds)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    from ma_calculator_wrapper import main
+
+    parser = ArgumentParser(description="Medicare Advantage OOP Cost Calculator queue worker")
+    parser.add_argument('queue', help='SQS queue URL, or path to a SQLite queue')
+    parser.add_argument('--batch-size', type=int, default=_DEFAULT_BATCH_SIZE)
+    parser.add_argument('--max-wait', type=float, default=_DEFAULT_MAX_WAIT,
+                        help='seconds that a request waits for its micro-batch to fill')
+    parser.add_argument('--profile', default=None, help='AWS profile name')
+    args = parser.parse_args()
+
+    aws_options = {
+        'region_name': 'us-east-1',
+        'profile_name': args.profile,
+    }
+
+    queue = (SQSQueue(args.queue, aws_options) if args.queue.startswith('https://')
+             else SQLiteQueue(args.queue))
+
+    worker = MicroBatchWorker(queue, lambda run_options: main(run_options, aws_options),
+                              args.batch_size, args.max_wait)
+    print('Waiting for requests...')
+    worker.run()
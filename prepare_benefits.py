@@ -10,9 +10,13 @@ get_ipython().magic(u'load_ext autotime')
 
 import json
 import os
+import sys
 
 from etltools import s3
 
+sys.path.append('lambda_client')
+from storage_utils import BenefitsClient, LocalBenefitsClient
+
 
 # In[3]:
 
@@ -56,10 +60,15 @@ for state, filtered_plans in plans_by_state.iteritems():
 
 # In[8]:
 
-# Write to s3:
-for state, filtered_plans in plans_by_state.iteritems():
-    file_name = os.path.join(benefit_dir, '{}.json'.format(state))
-    s3.write_json(filtered_plans, file_name)
+# Write the state files, with the index of the offset of each plan in them (see
+# BenefitsClient.get()):
+if benefit_dir.startswith('s3://'):
+    bucket, path = benefit_dir[len('s3://'):].split('/', 1)
+    client = BenefitsClient({'region_name': 'us-east-1'}, s3_bucket=bucket, s3_path=path)
+else:
+    client = LocalBenefitsClient(benefit_dir)
+
+client.put_states(plans_by_state)
 
 
 # In[ ]:
@@ -0,0 +1,43 @@
+"""
+Precompute the OOP response surfaces used by the 'estimate' service, and write them by state
+in the same layout as the benefits (one JSON file per state FIPS code).
+
+Run like this:
+    python prepare_surfaces.py s3://picwell.sandbox.medicare/ma_benefits/cms_2018_pbps_20171005.json s3://picwell.sandbox.analytics/junghoon/lambda_calculator_surfaces 2015
+"""
+
+import argparse
+import os
+import sys
+
+from etltools import s3
+
+sys.path.append('lambda_package')
+from calc.surface import build_response_surface
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
+                                     description=__doc__)
+
+    parser.add_argument('json_file', type=str, help='JSON MA benefit file')
+    parser.add_argument('surface_dir', type=str, help='directory to write surfaces to')
+    parser.add_argument('claims_year', type=str, help='CLAIMS_YEAR in lambda.cfg')
+
+    args = parser.parse_args()
+
+    plans = s3.read_json(args.json_file)
+    print '{} plans read'.format(len(plans))
+
+    surfaces_by_state = {}
+    for plan in plans:
+        surface = build_response_surface(plan, args.claims_year)
+        # Same split as prepare_benefits.py:
+        state = str(plan['picwell_id'])[-2:]
+        surfaces_by_state.setdefault(state, []).append(surface)
+
+    for state, surfaces in surfaces_by_state.iteritems():
+        file_name = os.path.join(args.surface_dir, '{}.json'.format(state))
+        s3.write_json(surfaces, file_name)
+        print '{}: {} surfaces'.format(state, len(surfaces))
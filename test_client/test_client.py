@@ -1,6 +1,11 @@
 from __future__ import absolute_import
 
+import base64
+import gzip
 import json
+import urllib2
+from StringIO import StringIO
+
 import boto3
 
 from .invocation_types import InvocationType
@@ -70,7 +75,8 @@ class LambdaCalculatorTestClient(object):
         return self._calculate_with_invocation_type(uid, months=months, states=states,
                                                     invocation_type=InvocationType.Event)
 
-    def calculate_breakdown(self, uid, pids=[], month='01'):
+    def calculate_breakdown(self, uid, pids=[], month='01', format=None, fields=None,
+                            compress=False):
         request = {
             'httpMethod': 'GET',
             'queryStringParameters': {
@@ -83,6 +89,16 @@ class LambdaCalculatorTestClient(object):
         if pids:
             request['queryStringParameters']['pids'] = pids
 
+        # See run_detailed() for the columnar format:
+        if format:
+            request['queryStringParameters']['format'] = format
+
+        if fields:
+            request['queryStringParameters']['fields'] = fields
+
+        if compress:
+            request['queryStringParameters']['compress'] = True
+
         encoded_payload = bytes(json.dumps(request)).encode('utf-8')
         response = self._client.invoke(
             FunctionName='ma_calculator',
@@ -91,9 +107,38 @@ class LambdaCalculatorTestClient(object):
             Payload=encoded_payload,
         )
 
-        # TODO: there must be a better way to process the response than this.
         if response['StatusCode'] != 200:
             raise Exception(json.loads(response['Payload'].read())['body'])
-        else:
-            return json.loads(json.loads(response['Payload'].read())['body'])
 
+        payload = json.loads(response['Payload'].read())
+        body = payload['body']
+        if payload.get('isBase64Encoded', False):
+            body = gzip.GzipFile(fileobj=StringIO(base64.b64decode(body))).read()
+
+        # Only the default format without compression encodes the costs twice:
+        if (format or 'rows') == 'rows' and not compress:
+            body = json.loads(body)
+
+        result = json.loads(body)
+
+        # Results too large to return are offloaded as gzipped NDJSON, a row per plan, which is
+        # returned in the requested format:
+        if isinstance(result, dict) and result.get('status') == 'offloaded':
+            offloaded = gzip.GzipFile(fileobj=StringIO(urllib2.urlopen(result['url']).read()))
+            rows = [json.loads(line) for line in offloaded]
+
+            return self._to_columns(uid, rows, fields) if format == 'columnar' else rows
+
+        return result
+
+    @staticmethod
+    def _to_columns(uid, rows, fields=None):
+        # The columnar format of run_detailed(); offloaded rows have the requested fields as keys:
+        if fields is None:
+            fields = sorted(set(key for row in rows for key in row) - {'uid', 'picwell_id'})
+
+        return {
+            'uid': uid,
+            'picwell_ids': [row['picwell_id'] for row in rows],
+            'fields': {field: [row.get(field) for row in rows] for field in fields},
+        }